@@ -0,0 +1,151 @@
+import math
+
+import numpy as np
+
+MODELS = ('flat', 'wait_martingale')
+# Objectives computed from nothing but the statistics estimated_statistics provides
+ESTIMATED_OBJECTIVES = ('metric', 'profit')
+
+
+def win_probability(payout):
+    """Probability that a game busts at or above the payout
+
+    Follows GameResults.generate_games: the bust is floor(100 / (1 - X)) / 101 rounded to cents for a
+    uniform X, so it reaches the payout when floor(100 / (1 - X)) >= ceil(101 * (payout - 0.005)).
+    """
+    payout = round(payout, 2)
+    if payout <= 1:
+        return 1.0
+    return min(1.0, 100 / math.ceil(101 * (payout - 0.005)))
+
+
+def chain_bets(base_bet, multiplier, balance, max_levels):
+    """Bets of a losing chain, as placed by the engine, until the next one can't be covered by the balance"""
+    bets = []
+    total = 0
+    bet_value = base_bet
+    while len(bets) < max_levels:
+        bet = max(100, round(bet_value / 100) * 100)
+        if total + bet > balance:
+            break
+        bets.append(bet)
+        total += bet
+        bet_value *= multiplier
+    return bets
+
+
+def wait_martingale(payout, base_bet, wait, multiplier, initial_balance, num_games):
+    """Expected outcome of waiting for `wait` games below the payout, then betting until a win
+
+    The state is the number of games in a row below the payout: below `wait` nothing is bet, from
+    there on the bet grows by `multiplier` after every loss and a win starts over. The chain of bets
+    is sized against the initial balance, exact when every win recovers the chain's losses and an
+    approximation otherwise. Running out of balance is an absorbing ruin state.
+
+    :return: A dictionary of the win probability, the expected profit (also as Statistics counts it),
+        wagered amount and games played over num_games, the probability of ruin, the probability
+        that the wait streak happens at all, and the metric of Statistics.get_metric
+        computed from the expectations. Statistics counts the whole payout of a win as profit, the
+        metric does the same so estimates rank candidates like simulations do.
+    """
+    win = win_probability(payout)
+    bets = np.array(chain_bets(base_bet, multiplier, initial_balance, num_games), dtype=np.float64)
+    wait = max(0, int(wait))
+    levels = len(bets)
+    num_states = wait + levels + 1
+    ruin = num_states - 1
+
+    transitions = np.zeros((num_states, num_states))
+    for state in range(wait + levels):
+        transitions[state, 0] += win
+        transitions[state, state + 1] += 1 - win
+    transitions[ruin, ruin] = 1.0
+
+    # Per state expectations of a single game, only the betting states bet
+    wagered = np.zeros(num_states)
+    wagered[wait:wait + levels] = bets
+    profit = wagered * (win * (round(payout, 2) - 1) - (1 - win))
+    statistics_profit = wagered * (win * round(payout, 2) - (1 - win))
+    played = (wagered > 0).astype(np.float64)
+
+    distribution = np.zeros(num_states)
+    distribution[0] = 1.0
+    expected_profit = expected_statistics_profit = expected_wagered = expected_played = 0.0
+    for _ in range(num_games):
+        expected_profit += distribution @ profit
+        expected_statistics_profit += distribution @ statistics_profit
+        expected_wagered += distribution @ wagered
+        expected_played += distribution @ played
+        distribution = distribution @ transitions
+
+    if expected_wagered > 0 and expected_played > 0:
+        metric = expected_statistics_profit / math.sqrt(expected_wagered * expected_played)
+    else:
+        metric = float('inf')
+    return {
+        'win_probability': win,
+        'expected_profit': float(expected_profit),
+        'expected_statistics_profit': float(expected_statistics_profit),
+        'expected_wagered': float(expected_wagered),
+        'expected_played': float(expected_played),
+        'ruin_probability': float(distribution[ruin]) if levels else 1.0,
+        'bet_probability': longest_streak_probability(win, num_games, wait),
+        'metric': float(metric),
+    }
+
+
+def estimated_statistics(estimated, initial_balance):
+    """The expectations of an estimate as the statistics objectives are computed from"""
+    return {
+        'starting_balance': initial_balance,
+        'profit': estimated['expected_statistics_profit'],
+        'total_wagered': estimated['expected_wagered'],
+        'games_played': estimated['expected_played'],
+    }
+
+
+def longest_streak_probability(win, num_games, length):
+    """Probability of at least `length` games in a row below the payout within num_games"""
+    if length <= 0:
+        return 1.0
+    # Distribution over the current streak, the last state absorbs streaks that reached the length
+    distribution = np.zeros(length + 1)
+    distribution[0] = 1.0
+    for _ in range(num_games):
+        next_distribution = np.zeros(length + 1)
+        next_distribution[0] = distribution[:length].sum() * win
+        next_distribution[1:length + 1] = distribution[:length] * (1 - win)
+        next_distribution[length] += distribution[length]
+        distribution = next_distribution
+    return float(distribution[length])
+
+
+def resolve(structure, config, name, default=None):
+    """Resolves a field of a structure declaration, either the name of a config parameter or a constant"""
+    value = structure.get(name, default)
+    if isinstance(value, str) and value in config:
+        return config[value]['value']
+    return value
+
+
+def estimate(script_obj, params, initial_balance, num_games):
+    """Analytical estimate of a candidate, None if the script doesn't declare a supported structure
+
+    Scripts declare their structure in a comment such as
+    `// @hyperopt {"model": "wait_martingale", "payout": "payout", "base_bet": "baseBet", "wait": "waitNum", "multiplier": "recover"}`
+    where every field is a config parameter or a constant. A "recover" multiplier is payout / (payout - 1),
+    the smallest one whose win recovers the chain's losses.
+    """
+    structure = getattr(script_obj, 'structure', None)
+    if not structure or structure.get('model') not in MODELS:
+        return None
+    config = script_obj.get_config(params)
+    payout = float(resolve(structure, config, 'payout'))
+    base_bet = float(resolve(structure, config, 'base_bet'))
+    if structure['model'] == 'flat':
+        wait, multiplier = 0, 1.0
+    else:
+        wait = resolve(structure, config, 'wait', 0)
+        multiplier = resolve(structure, config, 'multiplier', 'recover')
+        multiplier = payout / (payout - 1) if multiplier == 'recover' else float(multiplier)
+    return wait_martingale(payout, base_bet, wait, multiplier, initial_balance, num_games)
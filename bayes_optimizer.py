@@ -0,0 +1,173 @@
+import copy
+import logging
+import math
+import random
+import time
+
+import numpy as np
+
+np.int = np.int64 # Fix for a bug in skopt, set before it is imported
+
+from skopt import Optimizer as SkoptOptimizer
+from skopt.space import Categorical, Integer, Real
+
+from evaluation import EvaluationService, run_ask_tell
+from storage import Storage
+from telemetry import telemetry
+
+
+class BayesOptimizer:
+    def __init__(self, script_obj, initial_balance, game_results, parameter_names, space, optimization_id=None, backend=None):
+        self.script_obj = script_obj
+        self.initial_balance = initial_balance
+        self.game_results = game_results
+        self.parameter_names = parameter_names
+        self.space = space
+
+        self.batch_size = 8  # Points proposed per round, should be at least the number of workers
+        self.max_iter = 25  # Number of rounds
+        self.num_initial_points = 16  # Random points before the surrogate takes over
+        self.base_estimator = 'GP'  # 'GP' for a gaussian process, 'ET' or 'RF' for a tree ensemble
+        self.acq_func = 'EI'
+        self.liar_strategy = 'cl_min'  # Constant liar used to propose several points at once
+
+        self.storage = Storage('optimizations.db')
+        self.optimization_id = optimization_id or self.generate_optimization_id()
+        self.service = EvaluationService(self.script_obj, self.initial_balance, self.game_results, backend=backend, storage=self.storage, optimization_id=self.optimization_id, space=self.space)
+        self.current_iteration = 0
+        self.gbest_value = float('inf')
+        self.gbest_position = {key: 0.0 for key in self.parameter_names}
+        self.observations = []
+        self.dimensions = [self.build_dimension(param_name) for param_name in self.parameter_names]
+        self.optimizer = SkoptOptimizer(
+            self.dimensions,
+            base_estimator=self.base_estimator,
+            acq_func=self.acq_func,
+            n_initial_points=self.num_initial_points,
+        )
+        self.load_optimization_state()
+
+    def generate_optimization_id(self):
+        while True:
+            optimization_id = f"opt_{int(time.time() * 1000)}_{random.randint(1000, 9999)}"
+            if not self.storage.optimization_exists(optimization_id):
+                return optimization_id
+
+    def build_dimension(self, param_name):
+        param_details = self.space.get(param_name, {})
+        param_type = param_details.get('type')
+        param_range = param_details.get('range')
+
+        if param_type in ('balance', 'number', 'integer', 'continuous'):
+            if param_type in ('balance', 'integer') or param_details.get('is_integer'):
+                return Integer(math.ceil(param_range[0]), math.floor(param_range[1]), name=param_name)
+            return Real(param_range[0], param_range[1], name=param_name)
+        elif param_type in ('payout', 'multiplier'):
+            return Real(param_range[0], param_range[1], prior='log-uniform', name=param_name)
+        elif param_type == 'checkbox':
+            return Categorical([True, False], name=param_name)
+        elif param_type in ('radio', 'categorical'):
+            return Categorical(list(param_range), name=param_name)
+        else:
+            raise ValueError(f"Unknown parameter type: {param_type}")
+
+    def decode(self, point):
+        params = {}
+        for param_name, value in zip(self.parameter_names, point):
+            if self.space[param_name]['type'] == 'balance':
+                # Same rounding as PSOptimizer.enforce_constraint
+                param_range = self.space[param_name]['range']
+                value = max(min(round(int(value) / 100) * 100, param_range[1]), param_range[0])
+            elif isinstance(value, float) and self.space[param_name]['type'] in ('payout', 'multiplier'):
+                value = round(value, 2)
+            params[param_name] = value.item() if hasattr(value, 'item') else value
+        return params
+
+    def encode(self, params):
+        point = []
+        for param_name, dimension in zip(self.parameter_names, self.dimensions):
+            value = params[param_name]
+            if isinstance(dimension, Integer):
+                value = int(min(max(round(value), dimension.low), dimension.high))
+            elif isinstance(dimension, Real):
+                value = float(min(max(value, dimension.low), dimension.high))
+            point.append(value)
+        return point
+
+    def load_optimization_state(self):
+        loaded_state = self.storage.load_optimization(self.optimization_id)
+        if not loaded_state:
+            return
+        self.current_iteration = loaded_state['current_iteration']
+        # Replay every stored observation so the surrogate resumes where it left off
+        evaluations = self.storage.load_evaluations(self.optimization_id)
+        if evaluations:
+            self.tell([evaluation['parameters'] for evaluation in evaluations], [evaluation['fitness'] for evaluation in evaluations])
+        logging.info(f"Resumed optimization {self.optimization_id} with {len(evaluations)} observations")
+
+    def save_optimization_state(self, status="in_progress"):
+        optimization_data = {
+            "optimization_id": self.optimization_id,
+            "script_obj": self.script_obj,
+            "initial_balance": self.initial_balance,
+            "num_particles": self.batch_size,
+            "max_iter": self.max_iter,
+            "c1": None,
+            "c2": None,
+            "w": None,
+            "damping": None,
+            "gbest_value": self.gbest_value,
+            "gbest_position": self.gbest_position,
+            "status": status,
+            "current_iteration": self.current_iteration
+        }
+        # Queued behind the evaluations of the round so a round only counts as done once they are stored
+        self.service.write(Storage.save_optimization, copy.deepcopy(optimization_data))
+
+    def failure_value(self):
+        # The surrogate can't fit infinite values, so failed runs are told as slightly worse than the worst finite run
+        finite = [fitness for _, fitness in self.observations if math.isfinite(fitness)]
+        if not finite:
+            return 1.0
+        return max(finite) + abs(max(finite) - min(finite)) + 1e-6
+
+    def ask(self):
+        points = self.optimizer.ask(n_points=self.batch_size, strategy=self.liar_strategy)
+        return [self.decode(point) for point in points]
+
+    def tell(self, candidates, fitnesses):
+        for params, fitness in zip(candidates, fitnesses):
+            self.observations.append((params, fitness))
+            if fitness < self.gbest_value:
+                self.gbest_value = fitness
+                self.gbest_position = dict(params)
+        failure_value = self.failure_value()
+        points = [self.encode(params) for params in candidates]
+        values = [fitness if math.isfinite(fitness) else failure_value for fitness in fitnesses]
+        self.optimizer.tell(points, values)
+
+    async def optimize(self):
+        telemetry.start('BayesOptimizer', self.optimization_id, (self.max_iter - self.current_iteration) * self.batch_size, self.service.num_workers)
+
+        def on_iteration(iteration):
+            telemetry.set_gbest(self.gbest_value, self.gbest_position)
+            self.current_iteration = iteration + 1
+            self.save_optimization_state()
+            logging.info(f"Current best fitness: {self.gbest_value}")
+
+        # The optimization row has to exist before any evaluation referencing it is stored
+        self.save_optimization_state()
+        await run_ask_tell(self, self.service, self.current_iteration, self.max_iter, on_iteration)
+
+        self.save_final_result()
+        await self.service.flush()
+        logging.info(f"Optimization complete. Best position: {self.gbest_position}, Best value: {self.gbest_value}")
+        top_5_results = sorted(self.observations, key=lambda observation: observation[1])[:5]
+        return {
+            'best_parameters': self.gbest_position,
+            'best_metric': self.gbest_value,
+            'top_5_results': [(rank, {'parameters': params, 'metric': fitness}) for rank, (params, fitness) in enumerate(top_5_results)]
+        }
+
+    def save_final_result(self):
+        self.save_optimization_state(status="completed")
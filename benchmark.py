@@ -0,0 +1,433 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from statistics import median
+from types import SimpleNamespace
+
+import numpy as np
+
+from bust_index import BustIndex
+from cluster import ClusterBackend, start_local_workers
+from engine import Engine, History, UserInfo
+from metrics import Statistics
+from script import Script
+from simulator import GameResults, Simulator
+from storage import Storage
+from workers import WorkerPool, current_rss_mb
+
+SEED_HASH = 'b7c7b0b1e9c1f5f1fbc1d5e0ae1bfe4e9bf7be0a0ac8a4b1c5c4b91c3a1f2a7e'
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def decorator(func):
+        BENCHMARKS[name] = func
+        return func
+    return decorator
+
+
+def random_example_params():
+    return {
+        'baseBet': random.randint(1, 100),
+        'payout': round(random.uniform(1.5, 3.0), 2),
+        'waitNum': random.randint(1, 10),
+    }
+
+
+def time_repeated(func, repeat):
+    """Returns the median wall time of calling func repeat times"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return median(timings)
+
+
+async def time_repeated_async(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await func()
+        timings.append(time.perf_counter() - start)
+    return median(timings)
+
+
+def make_game_results(num_sets, num_games):
+    return GameResults(1.98, num_sets, num_games, seed=0)
+
+
+@benchmark('generate_games')
+async def bench_generate_games(args):
+    game_results = GameResults.__new__(GameResults)
+    seconds = time_repeated(lambda: game_results.generate_games(SEED_HASH, args.games), args.repeat)
+    return {'games': args.games, 'seconds': seconds, 'games_per_second': args.games / seconds}
+
+
+@benchmark('generate_sim_results')
+async def bench_generate_sim_results(args):
+    game_results = GameResults.__new__(GameResults)
+    game_results.rng = random.Random(0)
+    game_results.required_median = 1.98
+    game_results.num_games = args.games
+    seconds = time_repeated(game_results.generate_sim_results, args.repeat)
+    return {'games': args.games, 'seconds_per_set': seconds}
+
+
+@benchmark('engine_next_game')
+async def bench_engine_next_game(args):
+    games = GameResults.generate_games(SEED_HASH, args.games)
+
+    async def play():
+        engine = Engine(UserInfo("Player", 10 ** 12))
+        engine.on('GAME_STARTING', lambda: engine.bet(100, 2))
+        engine.on('GAME_ENDED', lambda: None)
+        for game in games:
+            await engine._nextGame(game)
+
+    seconds = await time_repeated_async(play, args.repeat)
+    # Every game emits starting, bet placed, started and ended, plus cashed out when the bet wins
+    events = sum(5 if game['bust'] >= 2 else 4 for game in games)
+    return {'games': args.games, 'events': events, 'seconds': seconds, 'games_per_second': args.games / seconds, 'events_per_second': events / seconds}
+
+
+@benchmark('bust_index')
+async def bench_bust_index(args):
+    games = GameResults.generate_games(SEED_HASH, args.games)
+    payouts = [round(1.5 + 0.01 * step, 2) for step in range(150)]
+
+    def build_and_query():
+        index = BustIndex(games)
+        for payout in payouts:
+            index.since(payout)
+            index.longest_streak(payout)
+
+    seconds = time_repeated(build_and_query, args.repeat)
+    return {'games': args.games, 'payouts': len(payouts), 'seconds': seconds, 'payouts_per_second': len(payouts) / seconds}
+
+
+@benchmark('simulator_run')
+async def bench_simulator_run(args):
+    script_obj = Script(args.script)
+    simulator = Simulator(script_obj)
+    game_results = make_game_results(args.sets, args.games)
+    random.seed(1)
+    params = [random_example_params() for _ in range(args.repeat)]
+    failed = 0
+    start = time.perf_counter()
+    for script_params in params:
+        try:
+            await simulator.run(args.balance, game_results, script_params)
+        except Exception:
+            # Random parameters can make the script throw, the throughput only counts completed evaluations
+            failed += 1
+    seconds = time.perf_counter() - start
+    evaluations = len(params) - failed
+    return {'evaluations': evaluations, 'failed': failed, 'sets': args.sets, 'games': args.games, 'seconds': seconds, 'evaluations_per_second': evaluations / seconds}
+
+
+@benchmark('simulator_bankrolls')
+async def bench_simulator_bankrolls(args):
+    simulator = Simulator(Script(args.script))
+    game_results = make_game_results(args.sets, args.games)
+    # Large enough that every bankroll survives and the whole sets are simulated
+    balances = [args.balance * 10 ** power for power in range(3, 8)]
+    script_params = {'baseBet': 100, 'payout': 2.0, 'waitNum': 2}
+
+    async def independent():
+        for initial_balance in balances:
+            await simulator.run(initial_balance, game_results, script_params)
+
+    shared_seconds = await time_repeated_async(lambda: simulator.run_bankrolls(balances, game_results, script_params), args.repeat)
+    independent_seconds = await time_repeated_async(independent, args.repeat)
+    return {'bankrolls': len(balances), 'shared_seconds': shared_seconds, 'independent_seconds': independent_seconds, 'speedup': independent_seconds / shared_seconds}
+
+
+@benchmark('statistics_update')
+async def bench_statistics_update(args):
+    games = GameResults.generate_games(SEED_HASH, args.games)
+    history = []
+    for index, game in enumerate(games):
+        wager = 100 if index % 2 else None
+        cashed_at = 2 if wager is not None and game['bust'] >= 2 else None
+        history.append({'id': game['id'], 'hash': game['hash'], 'bust': game['bust'], 'wager': wager, 'payout': 2 if wager else None, 'cashedAt': cashed_at})
+
+    def update_all():
+        engine = SimpleNamespace(history=History(1), _userInfo=UserInfo("Player", 10 ** 8))
+        statistics = Statistics(10 ** 8)
+        for entry in history:
+            engine.history.append(entry)
+            statistics.update(engine)
+
+    seconds = time_repeated(update_all, args.repeat)
+    return {'updates': len(history), 'seconds': seconds, 'updates_per_second': len(history) / seconds}
+
+
+@benchmark('storage_save_iteration')
+async def bench_storage_save_iteration(args):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        storage = Storage(os.path.join(temp_dir, 'benchmark.db'))
+        particles = [
+            {'position': random_example_params(), 'velocity': random_example_params(), 'pbest_position': random_example_params(), 'pbest_value': random.random()}
+            for _ in range(30)
+        ]
+        latencies = []
+        for iteration in range(args.repeat * 10):
+            start = time.perf_counter()
+            storage.save_iteration_state('benchmark', {'iteration': iteration, 'particles': particles, 'gbest_position': particles[0]['position'], 'gbest_value': 0.0})
+            latencies.append(time.perf_counter() - start)
+        storage.close()
+    return {'saves': len(latencies), 'median_seconds': median(latencies), 'max_seconds': max(latencies)}
+
+
+@benchmark('pso_iteration')
+async def bench_pso_iteration(args):
+    from ps_optimizer import PSOptimizer
+
+    script_obj = Script(os.path.abspath(args.script))
+    game_results = make_game_results(args.sets, args.games)
+    space = {
+        'baseBet': {'range': (1, 100), 'type': 'balance'},
+        'payout': {'range': (1.5, 3.0), 'type': 'payout'},
+        'waitNum': {'range': (1, 10), 'type': 'number', 'is_integer': True},
+    }
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # PSOptimizer keeps its storage in the working directory
+        os.chdir(temp_dir)
+        try:
+            random.seed(2)
+            np.random.seed(2)
+            optimizer = PSOptimizer(script_obj, args.balance, game_results, list(space.keys()), space)
+            optimizer.num_particles = args.particles
+            optimizer.initialize_particles()
+            timings = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                await optimizer.update_particles()
+                optimizer.save_optimization_state()
+                await optimizer.service.flush()
+                timings.append(time.perf_counter() - start)
+            optimizer.service.close()
+            optimizer.storage.close()
+        finally:
+            os.chdir(cwd)
+    return {'particles': args.particles, 'median_iteration_seconds': median(timings), 'evaluations_per_second': args.particles / median(timings)}
+
+
+# What a process imports before it can work: a spawned worker re-imports the main module of its parent
+STARTUP_IMPORTS = {
+    'interpreter': 'pass',
+    'main': 'import main',
+    'worker': 'import main, workers, simulator',
+    'scheduler_worker': 'import scheduler, workers, simulator',
+}
+
+
+@benchmark('startup')
+async def bench_startup(args):
+    results = {}
+    for name, statement in STARTUP_IMPORTS.items():
+        seconds = time_repeated(lambda: subprocess.run([sys.executable, '-c', statement], check=True), args.repeat)
+        results[f"{name}_seconds"] = seconds
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run_benchmarks(args):
+    names = args.only or list(BENCHMARKS.keys())
+    results = {}
+    for name in names:
+        print(f"Running {name}...", file=sys.stderr)
+        results[name] = await BENCHMARKS[name](args)
+    return {
+        'revision': git_revision(),
+        'label': args.label,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'settings': {'games': args.games, 'sets': args.sets, 'repeat': args.repeat, 'particles': args.particles},
+        'benchmarks': results,
+    }
+
+
+def compare_results(baseline, current, threshold):
+    """Compares two benchmark result files, returns the list of regressed metrics"""
+    regressions = []
+    for name, metrics in current['benchmarks'].items():
+        baseline_metrics = baseline['benchmarks'].get(name)
+        if baseline_metrics is None:
+            continue
+        for metric, value in metrics.items():
+            old_value = baseline_metrics.get(metric)
+            # Only rates and timings are comparable, the rest are benchmark settings
+            if not old_value or not (metric.endswith('_per_second') or metric.endswith('seconds')):
+                continue
+            change = (value - old_value) / old_value
+            regressed = change < -threshold if metric.endswith('_per_second') else change > threshold
+            print(f"{name}.{metric}: {old_value:.6g} -> {value:.6g} ({change * 100:+.1f}%){' REGRESSION' if regressed else ''}")
+            if regressed:
+                regressions.append(f"{name}.{metric}")
+    return regressions
+
+
+async def soak(script_path, num_evaluations, num_workers, num_games, max_evaluations, max_rss_mb, max_growth_mb):
+    """Runs thousands of evaluations through a worker pool and checks that memory stays bounded"""
+    script_obj = Script(script_path)
+    game_results = GameResults(1.98, 1, num_games)
+    pool = WorkerPool(num_workers, max_evaluations=max_evaluations, max_rss_mb=max_rss_mb)
+    batch_size = num_workers * 4
+
+    async def run_batch(count):
+        results = await asyncio.gather(*(
+            pool.evaluate(script_obj, 100000, game_results, random_example_params()) for _ in range(count)
+        ), return_exceptions=True)
+        return sum(1 for result in results if isinstance(result, Exception))
+
+    try:
+        # Warm up every worker before taking the memory baseline
+        errors = await run_batch(batch_size * 2)
+        baseline_worker_rss = max(stats['rss_mb'] for stats in pool.get_stats())
+        baseline_parent_rss = current_rss_mb()
+        peak_worker_rss = baseline_worker_rss
+        peak_parent_rss = baseline_parent_rss
+
+        start = time.perf_counter()
+        completed = 0
+        while completed < num_evaluations:
+            count = min(batch_size, num_evaluations - completed)
+            errors += await run_batch(count)
+            completed += count
+            peak_worker_rss = max(peak_worker_rss, max(stats['rss_mb'] for stats in pool.get_stats()))
+            peak_parent_rss = max(peak_parent_rss, current_rss_mb())
+        elapsed = time.perf_counter() - start
+        worker_stats = pool.get_stats()
+    finally:
+        pool.close()
+
+    return {
+        'evaluations': num_evaluations,
+        'errors': errors,
+        'elapsed_seconds': elapsed,
+        'evaluations_per_second': num_evaluations / elapsed,
+        'baseline_worker_rss_mb': baseline_worker_rss,
+        'peak_worker_rss_mb': peak_worker_rss,
+        'worker_rss_growth_mb': peak_worker_rss - baseline_worker_rss,
+        'baseline_parent_rss_mb': baseline_parent_rss,
+        'peak_parent_rss_mb': peak_parent_rss,
+        'parent_rss_growth_mb': peak_parent_rss - baseline_parent_rss,
+        'recycles': sum(stats['recycles'] for stats in worker_stats),
+        'bounded': peak_worker_rss - baseline_worker_rss <= max_growth_mb and peak_parent_rss - baseline_parent_rss <= max_growth_mb,
+    }
+
+
+async def cluster_scaling(script_path, worker_counts, num_evaluations, num_games):
+    """Measures cluster throughput with every number of workers, all running on this machine"""
+    script_obj = Script(script_path)
+    game_results = GameResults(1.98, 1, num_games, seed=0)
+    results = []
+    for num_workers in worker_counts:
+        with tempfile.TemporaryDirectory() as directory:
+            address = os.path.join(directory, 'cluster.sock')
+            authkey = os.urandom(16)
+            backend = ClusterBackend(address, authkey, num_workers)
+            processes = start_local_workers(address, authkey, num_workers)
+            try:
+                backend.wait_for_workers(timeout=60)
+                # Ship the context to every worker before timing
+                await asyncio.gather(*(backend.evaluate(script_obj, 100000, game_results, random_example_params()) for _ in range(num_workers)), return_exceptions=True)
+                start = time.perf_counter()
+                await asyncio.gather(*(backend.evaluate(script_obj, 100000, game_results, random_example_params()) for _ in range(num_evaluations)), return_exceptions=True)
+                elapsed = time.perf_counter() - start
+            finally:
+                backend.close()
+                for process in processes:
+                    process.join(timeout=5)
+        results.append({'workers': num_workers, 'evaluations_per_second': num_evaluations / elapsed})
+    for result in results:
+        result['speedup'] = result['evaluations_per_second'] / results[0]['evaluations_per_second']
+        result['efficiency'] = result['speedup'] * worker_counts[0] / result['workers']
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the simulator and optimizers.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Run the benchmark suite and save the results as JSON.')
+    run_parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS.keys()), help='Only run these benchmarks.')
+    run_parser.add_argument('--script', default='scripts/example.js', help='Path to the JavaScript file.')
+    run_parser.add_argument('--games', type=int, default=1000, help='Number of games per set.')
+    run_parser.add_argument('--sets', type=int, default=3, help='Number of game sets per evaluation.')
+    run_parser.add_argument('--balance', type=int, default=1000000, help='Initial balance in satoshis.')
+    run_parser.add_argument('--repeat', type=int, default=5, help='Number of repetitions per benchmark.')
+    run_parser.add_argument('--particles', type=int, default=10, help='Swarm size for the PSO benchmark.')
+    run_parser.add_argument('--label', help='Free-form label stored with the results.')
+    run_parser.add_argument('--output', default='bench_results.json', help='Where to write the JSON results.')
+    run_parser.add_argument('--compare', help='Baseline JSON results to compare against.')
+    run_parser.add_argument('--threshold', type=float, default=0.1, help='Relative change that counts as a regression.')
+
+    compare_parser = subparsers.add_parser('compare', help='Compare two saved benchmark results.')
+    compare_parser.add_argument('baseline', help='Baseline JSON results.')
+    compare_parser.add_argument('current', help='Current JSON results.')
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help='Relative change that counts as a regression.')
+
+    soak_parser = subparsers.add_parser('soak', help='Check that memory stays bounded over thousands of evaluations.')
+    soak_parser.add_argument('--script', default='scripts/example.js', help='Path to the JavaScript file.')
+    soak_parser.add_argument('--evaluations', type=int, default=5000, help='Number of evaluations to run.')
+    soak_parser.add_argument('--workers', type=int, default=2, help='Number of worker processes.')
+    soak_parser.add_argument('--games', type=int, default=200, help='Number of games per evaluation.')
+    soak_parser.add_argument('--worker-max-evals', type=int, default=500, help='Recycle a worker after this many evaluations.')
+    soak_parser.add_argument('--worker-max-rss', type=float, default=512, help='Recycle a worker once its memory exceeds this many MB.')
+    soak_parser.add_argument('--max-growth', type=float, default=64, help='Maximum allowed memory growth in MB after warm up.')
+
+    scaling_parser = subparsers.add_parser('scaling', help='Measure cluster throughput by number of workers on this machine.')
+    scaling_parser.add_argument('--script', default='scripts/example.js', help='Path to the JavaScript file.')
+    scaling_parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='Numbers of workers to measure. Defaults to 1 2 4.')
+    scaling_parser.add_argument('--evaluations', type=int, default=100, help='Number of timed evaluations per worker count.')
+    scaling_parser.add_argument('--games', type=int, default=1000, help='Number of games per evaluation.')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        results = asyncio.run(run_benchmarks(args))
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+        print(json.dumps(results['benchmarks'], indent=2))
+        if args.compare:
+            with open(args.compare, 'r', encoding='utf-8') as file:
+                baseline = json.load(file)
+            if compare_results(baseline, results, args.threshold):
+                sys.exit(1)
+    elif args.command == 'compare':
+        with open(args.baseline, 'r', encoding='utf-8') as file:
+            baseline = json.load(file)
+        with open(args.current, 'r', encoding='utf-8') as file:
+            current = json.load(file)
+        if compare_results(baseline, current, args.threshold):
+            sys.exit(1)
+    elif args.command == 'soak':
+        result = asyncio.run(soak(args.script, args.evaluations, args.workers, args.games, args.worker_max_evals, args.worker_max_rss, args.max_growth))
+        print(json.dumps(result, indent=2))
+        if not result['bounded']:
+            print(f"Memory growth exceeded {args.max_growth} MB", file=sys.stderr)
+            sys.exit(1)
+    elif args.command == 'scaling':
+        for result in asyncio.run(cluster_scaling(args.script, args.workers, args.evaluations, args.games)):
+            print(f"{result['workers']} workers: {result['evaluations_per_second']:.1f} evaluations/s, speedup {result['speedup']:.2f}x, efficiency {result['efficiency'] * 100:.0f}%")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+import logging
+import math
+import re
+import time
+
+TIME_UNITS = {
+    's': 1, 'sec': 1, 'second': 1, 'seconds': 1,
+    'm': 60, 'min': 60, 'minute': 60, 'minutes': 60,
+    'h': 3600, 'hr': 3600, 'hour': 3600, 'hours': 3600,
+    'd': 86400, 'day': 86400, 'days': 86400,
+}
+GAME_MULTIPLIERS = {'': 1, 'k': 10 ** 3, 'm': 10 ** 6, 'b': 10 ** 9, 'g': 10 ** 9}
+BUDGET_PATTERN = re.compile(r'^(?P<number>\d+(?:\.\d+)?)\s*(?P<unit>[a-z]*)\s*(?P<games>games?)?$')
+
+
+def parse_budget(text):
+    """Parses a budget like '2h', '90 minutes', '50M games' or both limits, '2h,50M games'
+
+    :return: A Budget
+    """
+    seconds = games = None
+    for part in text.split(','):
+        match = BUDGET_PATTERN.match(part.strip().lower())
+        if match is None:
+            raise ValueError(f"Invalid budget: {part.strip()}, use a duration like 2h or 90m, or a number of games like 50M games")
+        number, unit = float(match.group('number')), match.group('unit')
+        if match.group('games') or unit in ('game', 'games'):
+            multiplier = GAME_MULTIPLIERS.get('' if unit in ('game', 'games') else unit)
+            if multiplier is None:
+                raise ValueError(f"Invalid budget: {part.strip()}, games take a k, M or B suffix")
+            games = int(number * multiplier)
+        elif unit in TIME_UNITS:
+            seconds = number * TIME_UNITS[unit]
+        else:
+            raise ValueError(f"Invalid budget: {part.strip()}, durations take a unit like s, m, h or d")
+    return Budget(seconds=seconds, games=games)
+
+
+class Budget:
+    def __init__(self, seconds=None, games=None, reserve=0.05, min_iterations=10, min_particles=5, max_particles=None):
+        """Limits a run to a wall time and/or a number of simulated games instead of a number of iterations
+
+        The cost of a candidate is measured on every iteration. After the second one, the swarm is sized
+        so the budget covers about the optimizer's planned iterations, and when even the smallest swarm
+        gets fewer than min_iterations, candidates are evaluated sequentially so clearly worse ones stop
+        early. Iterations that wouldn't end before the budget does aren't started, so the last
+        checkpoint is written before the deadline.
+
+        :param seconds: Wall time of the run, None for no limit
+        :param games: Simulated games of the run, None for no limit
+        :param reserve: Share of the wall time kept for the final checkpoint and the flush of the writes
+        :param min_iterations: Iterations the swarm is shrunk to afford before the fidelity is lowered
+        :param min_particles: Smallest swarm
+        :param max_particles: Largest swarm, defaults to twice the swarm the optimizer starts with
+        """
+        if seconds is None and games is None:
+            raise ValueError("A budget needs a time or a games limit")
+        self.seconds = seconds
+        self.games = games
+        self.reserve = reserve
+        self.min_iterations = min_iterations
+        self.min_particles = min_particles
+        self.max_particles = max_particles
+        self.started = None
+        self.games_at_start = 0
+        self.planned_iterations = None
+        self.iterations = 0
+        self.evaluations = 0
+        # Cost of a requested candidate, smoothed over the iterations
+        self.seconds_per_candidate = None
+        self.games_per_candidate = None
+        self.last_candidates = None
+        self.resized = False
+        self.lowered_fidelity = False
+        self.stop_reason = None
+
+    def start(self, service, planned_iterations):
+        """Starts the clock, planned_iterations are those the optimizer would run without a budget"""
+        self.started = time.time()
+        self.planned_iterations = planned_iterations
+        self.games_at_start = service.stats['games']
+
+    def used(self, service):
+        """Returns (seconds, games) used since the start"""
+        return time.time() - self.started, service.stats['games'] - self.games_at_start
+
+    def remaining(self, service):
+        """Returns (seconds, games) left, infinite for a limit the budget doesn't have"""
+        seconds, games = self.used(service)
+        seconds_left = self.seconds * (1 - self.reserve) - seconds if self.seconds is not None else math.inf
+        games_left = self.games - games if self.games is not None else math.inf
+        return seconds_left, games_left
+
+    def affordable_candidates(self, service):
+        """The number of candidates the rest of the budget pays for at the measured cost"""
+        seconds_left, games_left = self.remaining(service)
+        affordable = math.inf
+        if self.seconds_per_candidate:
+            affordable = min(affordable, seconds_left / self.seconds_per_candidate)
+        if self.games_per_candidate:
+            affordable = min(affordable, games_left / self.games_per_candidate)
+        return max(0, affordable)
+
+    def fits_iteration(self, service):
+        """Whether another iteration ends within the budget, sets stop_reason when it doesn't"""
+        seconds_left, games_left = self.remaining(service)
+        if seconds_left <= 0 or games_left <= 0:
+            self.stop_reason = 'time' if seconds_left <= 0 else 'games'
+            return False
+        if self.last_candidates is None:
+            return True
+        if self.seconds_per_candidate and self.seconds_per_candidate * self.last_candidates > seconds_left:
+            self.stop_reason = 'time'
+            return False
+        if self.games_per_candidate and self.games_per_candidate * self.last_candidates > games_left:
+            self.stop_reason = 'games'
+            return False
+        return True
+
+    def record(self, seconds, games, num_candidates):
+        """Updates the measured cost with an iteration of num_candidates candidates"""
+        self.iterations += 1
+        self.evaluations += num_candidates
+        self.last_candidates = num_candidates
+        if num_candidates == 0:
+            return
+        seconds_per_candidate, games_per_candidate = seconds / num_candidates, games / num_candidates
+        # The first iteration also pays for starting the simulators, the second one replaces its estimate
+        if self.seconds_per_candidate is None or self.iterations == 2:
+            self.seconds_per_candidate, self.games_per_candidate = seconds_per_candidate, games_per_candidate
+        else:
+            # Recent iterations weigh more, the cost changes as the swarm converges
+            self.seconds_per_candidate = 0.5 * self.seconds_per_candidate + 0.5 * seconds_per_candidate
+            self.games_per_candidate = 0.5 * self.games_per_candidate + 0.5 * games_per_candidate
+
+    def plan(self, optimizer, service, iteration, max_iter):
+        """Adapts the swarm and the fidelity to the budget after an iteration
+
+        :param iteration: The number of iterations run, including this session's
+        :param max_iter: The iteration the run ends at so far
+        :return: The iteration the run ends at within the budget
+        """
+        size = self.last_candidates or 1
+        affordable = self.affordable_candidates(service)
+        calibrated = self.iterations >= 2
+        # Sized once the cost is known, iterations served from the cache don't measure it
+        if calibrated and not self.resized and hasattr(optimizer, 'resize') and math.isfinite(affordable):
+            self.resized = True
+            target = max(self.planned_iterations - self.iterations, 1)
+            new_size = min(max(int(affordable / target), self.min_particles), self.max_particles or 2 * size)
+            if new_size != size:
+                logging.info(f"Budget: resizing the swarm from {size} to {new_size} particles")
+                optimizer.resize(new_size)
+                size = self.last_candidates = new_size
+
+        if calibrated and not self.lowered_fidelity and affordable / size < self.min_iterations and service.sequential is None and len(service.game_results.result_sets) > 2:
+            self.lowered_fidelity = True
+            logging.info(f"Budget: {affordable / size:.1f} iterations affordable, evaluating candidates sequentially")
+            service.enable_sequential(min_sets=2)
+
+        if not math.isfinite(affordable):
+            return max_iter
+        if affordable < size:
+            self.fits_iteration(service)
+        return iteration + int(affordable // size)
+
+    def report(self, service):
+        """Budget utilization: the limits, what was used of them and why the run stopped"""
+        seconds, games = self.used(service)
+        return {
+            'seconds_limit': self.seconds,
+            'seconds_used': seconds,
+            'time_utilization': seconds / self.seconds if self.seconds else None,
+            'games_limit': self.games,
+            'games_used': games,
+            'games_utilization': games / self.games if self.games else None,
+            'iterations': self.iterations,
+            'evaluations': self.evaluations,
+            'seconds_per_candidate': self.seconds_per_candidate,
+            'games_per_candidate': self.games_per_candidate,
+            'swarm_size': self.last_candidates,
+            'sequential': self.lowered_fidelity,
+            'stop_reason': self.stop_reason or 'completed',
+        }
+
+    def format_report(self, service):
+        report = self.report(service)
+        lines = [f"Budget: {report['iterations']} iterations, {report['evaluations']} evaluations, stopped by {report['stop_reason']}"]
+        if report['seconds_limit'] is not None:
+            lines.append(f"  Time: {report['seconds_used']:.0f}s of {report['seconds_limit']:.0f}s ({report['time_utilization']:.1%})")
+        if report['games_limit'] is not None:
+            lines.append(f"  Games: {report['games_used']:.0f} of {report['games_limit']} ({report['games_utilization']:.1%})")
+        return '\n'.join(lines)
@@ -0,0 +1,97 @@
+from collections import OrderedDict
+
+import numpy as np
+
+
+class BustIndex:
+    def __init__(self, game_set):
+        """Precomputed views of a game set for strategy kernels that only look at busts
+
+        Built once per set, the per-threshold arrays are computed on first use and cached per payout
+        bucket. Buckets are cents, the resolution of both busts and payouts, so every payout in a
+        bucket gives exactly the same answers.
+
+        :param game_set: The games in the order they are played
+        """
+        self.busts = np.array([game['bust'] for game in game_set], dtype=np.float64)
+        self.sorted_busts = np.sort(self.busts)
+        self.num_games = len(self.busts)
+        self._thresholds = {}
+
+    @staticmethod
+    def bucket(payout):
+        return int(round(payout * 100))
+
+    def count_at_least(self, payout):
+        """Number of games that busted at or above the payout, O(log n)"""
+        return self.num_games - int(np.searchsorted(self.sorted_busts, self.bucket(payout) / 100, side='left'))
+
+    def probability_at_least(self, payout):
+        return self.count_at_least(payout) / self.num_games if self.num_games else 0.0
+
+    def _threshold(self, payout):
+        bucket = self.bucket(payout)
+        threshold = self._thresholds.get(bucket)
+        if threshold is None:
+            hits = self.busts >= bucket / 100
+            positions = np.arange(self.num_games)
+            # Games since the last hit, counting the game itself, 0 on a hit
+            last_hit = np.maximum.accumulate(np.where(hits, positions, -1))
+            misses_through = positions - last_hit
+            threshold = self._thresholds[bucket] = {
+                'hits': hits,
+                'prefix_hits': np.concatenate(([0], np.cumsum(hits))),
+                'since': np.concatenate(([0], misses_through[:-1])),
+                'misses_through': misses_through,
+            }
+        return threshold
+
+    def hits(self, payout):
+        """Boolean array of the games a bet at the payout would win"""
+        return self._threshold(payout)['hits']
+
+    def count_between(self, payout, start, end):
+        """Number of games in [start, end) that busted at or above the payout, O(1)"""
+        prefix_hits = self._threshold(payout)['prefix_hits']
+        return int(prefix_hits[end] - prefix_hits[start])
+
+    def since(self, payout):
+        """For every game, how many games in a row busted below the payout right before it
+
+        This is the `since` counter of scripts/example.js as seen when the game starts.
+        """
+        return self._threshold(payout)['since']
+
+    def streak_lengths(self, payout):
+        """Lengths of every run of consecutive games below the payout, in order"""
+        misses_through = self._threshold(payout)['misses_through']
+        # A run ends where the next game is a hit, or at the end of the set
+        run_ends = np.flatnonzero((misses_through > 0) & np.append(misses_through[1:] == 0, True))
+        return misses_through[run_ends]
+
+    def longest_streak(self, payout):
+        streaks = self.streak_lengths(payout)
+        return int(streaks.max()) if len(streaks) else 0
+
+
+_indexes = OrderedDict()
+MAX_CACHED_INDEXES = 64
+
+
+def bust_index(game_set):
+    """Returns the cached BustIndex of a game set
+
+    A set is identified by the hash of its last game and its length, the chain of hashes makes the
+    rest of the games follow from it.
+    """
+    if not game_set:
+        return BustIndex(game_set)
+    key = (game_set[-1]['hash'], len(game_set))
+    index = _indexes.get(key)
+    if index is None:
+        index = _indexes[key] = BustIndex(game_set)
+        if len(_indexes) > MAX_CACHED_INDEXES:
+            _indexes.popitem(last=False)
+    else:
+        _indexes.move_to_end(key)
+    return index
@@ -0,0 +1,345 @@
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Client, Listener
+
+from profiling import profiler
+from telemetry import telemetry
+from workers import context_key, current_rss_mb, simulate
+
+HEARTBEAT_INTERVAL = 2.0  # Seconds between heartbeats sent by a worker
+HEARTBEAT_TIMEOUT = 10.0  # Seconds of silence after which a worker counts as lost
+AUTHKEY_VARIABLE = 'HYPEROPT_CLUSTER_KEY'
+
+
+class WorkerLost(Exception):
+    pass
+
+
+def parse_address(address):
+    """Parses 'host:port' into a TCP address, anything else is the path of a Unix socket"""
+    host, separator, port = address.rpartition(':')
+    if separator and port.isdigit() and '/' not in address:
+        return (host or '127.0.0.1', int(port))
+    return address
+
+
+def get_authkey(authkey=None):
+    """Returns the shared secret workers authenticate with, from the argument or HYPEROPT_CLUSTER_KEY"""
+    authkey = authkey or os.environ.get(AUTHKEY_VARIABLE)
+    if not authkey:
+        raise ValueError(f"The cluster needs a shared secret, pass one or set {AUTHKEY_VARIABLE}")
+    return authkey.encode() if isinstance(authkey, str) else authkey
+
+
+def connect(address, authkey, timeout=30.0):
+    """Connects to a coordinator, retrying until it listens or the timeout passes"""
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return Client(parse_address(address), authkey=authkey)
+        except (ConnectionRefusedError, FileNotFoundError):
+            if time.time() >= deadline:
+                raise
+            time.sleep(0.5)
+
+
+def run_worker(address, authkey, heartbeat_interval=HEARTBEAT_INTERVAL, connect_timeout=30.0):
+    """Serves evaluations for a coordinator until it disconnects
+
+    Speaks the protocol of workers.py over a socket: contexts are shipped once per content hash,
+    then evaluated by key. A heartbeat thread keeps the coordinator informed during long simulations.
+    """
+    # Imported here so a coordinator doesn't need a V8 isolate
+    from simulator import Simulator
+
+    conn = connect(address, get_authkey(authkey), connect_timeout)
+    send_lock = threading.Lock()
+    stopped = threading.Event()
+
+    def send(message):
+        with send_lock:
+            conn.send(message)
+
+    def heartbeat():
+        while not stopped.wait(heartbeat_interval):
+            try:
+                send(('heartbeat',))
+            except (OSError, ValueError):
+                break
+
+    send(('hello', socket.gethostname(), os.getpid()))
+    threading.Thread(target=heartbeat, daemon=True).start()
+
+    contexts = {}
+    evaluations = 0
+    try:
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                break
+
+            if message[0] == 'stop':
+                break
+            elif message[0] == 'context':
+                _, key, (script_obj, initial_balance, game_results) = message
+                contexts[key] = (Simulator(script_obj), initial_balance, game_results)
+            elif message[0] == 'evaluate':
+                _, key, params, profiling_enabled, sequential = message
+                simulator, initial_balance, game_results = contexts[key]
+                evaluations += 1
+                profiler.enabled = profiling_enabled
+                profiler.reset()
+                result, error = simulate(simulator, initial_balance, game_results, params, sequential)
+                profile = profiler.snapshot() if profiling_enabled else None
+                send(('result', result, error, evaluations, current_rss_mb(), profile))
+    finally:
+        stopped.set()
+        conn.close()
+
+
+class RemoteWorker:
+    def __init__(self, conn, worker_id, host, pid):
+        """A worker connected to the coordinator, its messages are read on a background thread"""
+        self.conn = conn
+        self.worker_id = worker_id
+        self.host = host
+        self.pid = pid
+        self.contexts = set()
+        self.evaluations = 0
+        self.total_evaluations = 0
+        self.rss_mb = 0.0
+        self.alive = True
+        self.last_seen = time.time()
+        self.replies = queue.Queue()
+        self.send_lock = threading.Lock()
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _read(self):
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            self.last_seen = time.time()
+            if message[0] == 'result':
+                self.replies.put(message)
+        self.alive = False
+        self.replies.put(None)
+
+    def send(self, message):
+        with self.send_lock:
+            self.conn.send(message)
+
+    def request(self, key, context, params, sequential=None, heartbeat_timeout=HEARTBEAT_TIMEOUT):
+        try:
+            # Script and game sets are shipped once per worker, not with every evaluation
+            if key not in self.contexts:
+                self.send(('context', key, context))
+                self.contexts.add(key)
+            self.send(('evaluate', key, params, profiler.enabled, sequential))
+        except (OSError, ValueError) as e:
+            raise WorkerLost(f"Sending to worker {self.worker_id} failed: {e}") from e
+
+        while True:
+            try:
+                reply = self.replies.get(timeout=heartbeat_timeout / 2)
+            except queue.Empty:
+                if time.time() - self.last_seen > heartbeat_timeout:
+                    raise WorkerLost(f"No heartbeat from worker {self.worker_id} for {heartbeat_timeout} seconds")
+                continue
+            if reply is None:
+                raise WorkerLost(f"Worker {self.worker_id} disconnected")
+            _, result, error, evaluations, rss_mb, profile = reply
+            self.evaluations = evaluations
+            self.total_evaluations += 1
+            self.rss_mb = rss_mb
+            return result, error, profile
+
+    def close(self):
+        try:
+            self.send(('stop',))
+        except (OSError, ValueError):
+            pass
+        self.alive = False
+        self.conn.close()
+
+
+class ClusterBackend:
+    def __init__(self, address, authkey=None, num_workers=1, heartbeat_timeout=HEARTBEAT_TIMEOUT, max_attempts=3):
+        """Coordinator dispatching evaluations to workers that connect over TCP or a Unix socket
+
+        Workers may join at any time with `python cluster.py --connect ADDRESS`. An evaluation
+        on a worker that disconnects or misses its heartbeats is dispatched again on another one.
+        Messages are pickled, only run a cluster on a network you trust, with a secret shared by
+        the coordinator and its workers.
+
+        :param address: 'host:port' to listen on TCP, or the path of a Unix socket
+        :param authkey: The shared secret, defaults to HYPEROPT_CLUSTER_KEY
+        :param num_workers: Number of workers expected, what optimizers size their batches for
+        :param heartbeat_timeout: Seconds of silence after which a worker counts as lost
+        :param max_attempts: Workers an evaluation is tried on before it fails
+        """
+        self.address = address
+        self.num_workers = num_workers
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_attempts = max_attempts
+        self.listener = Listener(parse_address(address), authkey=get_authkey(authkey))
+        self.executor = ThreadPoolExecutor(max_workers=256)
+        self.workers = []
+        self.lost_workers = 0
+        self.redispatched = 0
+        self.lock = threading.Lock()
+        self.joined = threading.Condition(self.lock)
+        self.loop = None
+        self.idle_workers = None
+        self.closed = False
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while not self.closed:
+            try:
+                conn = self.listener.accept()
+            except multiprocessing.AuthenticationError as e:
+                logging.warning(f"Rejected a worker: {e}")
+                continue
+            except OSError:
+                if self.closed:
+                    break
+                continue
+            try:
+                if not conn.poll(self.heartbeat_timeout):
+                    raise WorkerLost("No hello")
+                _, host, pid = conn.recv()
+            except (EOFError, OSError, ValueError, WorkerLost) as e:
+                logging.warning(f"A worker failed to join: {e}")
+                conn.close()
+                continue
+            with self.lock:
+                worker = RemoteWorker(conn, len(self.workers), host, pid)
+                self.workers.append(worker)
+                if self.loop is not None:
+                    self.loop.call_soon_threadsafe(self.idle_workers.put_nowait, worker)
+                self.joined.notify_all()
+            logging.info(f"Worker {worker.worker_id} joined from {host} (pid {pid})")
+
+    def _get_idle_queue(self):
+        # The queue must be created inside the running event loop, workers that joined before are added then
+        with self.lock:
+            if self.idle_workers is None:
+                self.loop = asyncio.get_running_loop()
+                self.idle_workers = asyncio.Queue()
+                for worker in self.workers:
+                    if worker.alive:
+                        self.idle_workers.put_nowait(worker)
+        return self.idle_workers
+
+    def wait_for_workers(self, count=None, timeout=None):
+        """Blocks until count workers (default num_workers) are connected, returns how many are"""
+        count = self.num_workers if count is None else count
+        with self.joined:
+            self.joined.wait_for(lambda: sum(worker.alive for worker in self.workers) >= count, timeout)
+            return sum(worker.alive for worker in self.workers)
+
+    async def evaluate(self, script_obj, initial_balance, game_results, params, sequential=None):
+        """Runs a simulation on the next idle worker, same return value as Simulator.run"""
+        idle_workers = self._get_idle_queue()
+        key = context_key(script_obj, initial_balance, game_results)
+        context = (script_obj, initial_balance, game_results)
+        loop = asyncio.get_running_loop()
+
+        attempts = 0
+        while attempts < self.max_attempts:
+            worker = await self._next_worker(idle_workers)
+            if not worker.alive:
+                continue
+            attempts += 1
+            started = time.time()
+            try:
+                result, error, profile = await loop.run_in_executor(self.executor, worker.request, key, context, params, sequential, self.heartbeat_timeout)
+            except WorkerLost as e:
+                logging.warning(f"Lost worker {worker.worker_id} on {worker.host}, dispatching its evaluation again: {e}")
+                worker.close()
+                self.lost_workers += 1
+                self.redispatched += 1
+                continue
+            telemetry.worker_busy(time.time() - started)
+            idle_workers.put_nowait(worker)
+            if profile is not None:
+                profiler.merge(profile)
+            if error is not None:
+                raise Exception(error)
+            return result
+        raise Exception(f"Evaluation failed on {self.max_attempts} workers")
+
+    async def _next_worker(self, idle_workers):
+        """The next idle worker, fails when none is alive and none joins within the heartbeat timeout"""
+        while True:
+            try:
+                return await asyncio.wait_for(idle_workers.get(), self.heartbeat_timeout)
+            except asyncio.TimeoutError:
+                # Busy workers become idle or lost within the heartbeat timeout, so only wait for live ones
+                if not any(worker.alive for worker in self.workers):
+                    raise WorkerLost(f"No worker alive for {self.heartbeat_timeout} seconds")
+
+    def get_stats(self):
+        return [
+            {
+                'worker_id': worker.worker_id,
+                'host': worker.host,
+                'pid': worker.pid,
+                'alive': worker.alive,
+                'evaluations': worker.evaluations,
+                'total_evaluations': worker.total_evaluations,
+                'rss_mb': worker.rss_mb,
+                'recycles': 0,
+            } for worker in self.workers
+        ]
+
+    def close(self):
+        self.closed = True
+        for worker in self.workers:
+            worker.close()
+        self.listener.close()
+        self.executor.shutdown()
+
+
+def start_local_workers(address, authkey, count):
+    """Starts worker processes on this machine, returns them"""
+    mp_context = multiprocessing.get_context('spawn')
+    processes = [mp_context.Process(target=run_worker, args=(address, authkey), daemon=True) for _ in range(count)]
+    for process in processes:
+        process.start()
+    return processes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run simulation workers for a coordinator started with main.py --backend cluster.')
+    parser.add_argument('--connect', required=True, help="The coordinator's address, host:port or the path of a Unix socket.")
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help='Number of worker processes to run. Defaults to the number of CPUs.')
+    parser.add_argument('--authkey', help=f'The shared secret of the cluster. Defaults to ${AUTHKEY_VARIABLE}.')
+    parser.add_argument('--reconnect', action='store_true', help='Connect again whenever the coordinator goes away, instead of exiting.')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    authkey = get_authkey(args.authkey)
+    while True:
+        processes = start_local_workers(args.connect, authkey, args.processes)
+        for process in processes:
+            process.join()
+        if not args.reconnect:
+            break
+        logging.info("Coordinator went away, reconnecting")
+        time.sleep(1)
+
+
+if __name__ == '__main__':
+    main()
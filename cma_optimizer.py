@@ -0,0 +1,292 @@
+import copy
+import logging
+import math
+import random
+import time
+
+import numpy as np
+
+from evaluation import EvaluationService, run_ask_tell
+from storage import Storage
+from telemetry import telemetry
+
+
+class CMAESOptimizer:
+    def __init__(self, script_obj, initial_balance, game_results, parameter_names, space, optimization_id=None, backend=None):
+        self.script_obj = script_obj
+        self.initial_balance = initial_balance
+        self.game_results = game_results
+        self.parameter_names = parameter_names
+        self.space = space
+
+        self.max_iter = 100  # Number of generations, summed over all restarts
+        self.sigma0 = 0.3  # Initial step size, the search runs in the unit cube
+        self.restart_strategy = 'bipop'  # 'ipop', 'bipop' or None
+        self.tol_x = 1e-4
+        self.tol_fun = 1e-9
+
+        self.storage = Storage('optimizations.db')
+        self.optimization_id = optimization_id or self.generate_optimization_id()
+        self.service = EvaluationService(self.script_obj, self.initial_balance, self.game_results, backend=backend, storage=self.storage, optimization_id=self.optimization_id, space=self.space)
+
+        self.dimension = len(self.parameter_names)
+        self.default_population_size = 4 + int(3 * math.log(self.dimension))
+        self.current_iteration = 0
+        self.gbest_value = float('inf')
+        self.gbest_position = {key: 0.0 for key in self.parameter_names}
+        self.rng = np.random.default_rng()
+        self.restarts = 0
+        self.large_population_size = self.default_population_size
+        self.large_budget = 0
+        self.small_budget = 0
+        self.regime = 'large'
+        self.start_run(self.default_population_size, self.sigma0)
+        self.load_optimization_state()
+
+    def generate_optimization_id(self):
+        while True:
+            optimization_id = f"opt_{int(time.time() * 1000)}_{random.randint(1000, 9999)}"
+            if not self.storage.optimization_exists(optimization_id):
+                return optimization_id
+
+    def start_run(self, population_size, sigma):
+        """(Re)initializes the strategy parameters and the search distribution"""
+        n = self.dimension
+        self.population_size = population_size
+        self.mu = population_size // 2
+        weights = math.log(self.mu + 0.5) - np.log(np.arange(1, self.mu + 1))
+        self.weights = weights / weights.sum()
+        self.mueff = 1 / np.sum(self.weights ** 2)
+        self.cc = (4 + self.mueff / n) / (n + 4 + 2 * self.mueff / n)
+        self.cs = (self.mueff + 2) / (n + self.mueff + 5)
+        self.c1 = 2 / ((n + 1.3) ** 2 + self.mueff)
+        self.cmu = min(1 - self.c1, 2 * (self.mueff - 2 + 1 / self.mueff) / ((n + 2) ** 2 + self.mueff))
+        self.damps = 1 + 2 * max(0, math.sqrt((self.mueff - 1) / (n + 1)) - 1) + self.cs
+        self.chi_n = math.sqrt(n) * (1 - 1 / (4 * n) + 1 / (21 * n ** 2))
+
+        self.mean = self.rng.random(n)
+        self.sigma = sigma
+        self.C = np.eye(n)
+        self.pc = np.zeros(n)
+        self.ps = np.zeros(n)
+        self.run_generation = 0
+        self.run_best_history = []
+        self.samples = None
+
+    # Encoding: every parameter lives in [0, 1], payouts on a log scale
+
+    def decode_value(self, param_name, x):
+        param_details = self.space.get(param_name, {})
+        param_type = param_details.get('type')
+        param_range = param_details.get('range')
+        x = min(max(float(x), 0.0), 1.0)
+
+        if param_type == 'balance':
+            value = param_range[0] + x * (param_range[1] - param_range[0])
+            return max(min(round(value / 100) * 100, param_range[1]), param_range[0])
+        elif param_type in ('number', 'integer', 'continuous'):
+            value = param_range[0] + x * (param_range[1] - param_range[0])
+            if param_type == 'integer' or param_details.get('is_integer'):
+                return int(round(value))
+            return value
+        elif param_type in ('payout', 'multiplier'):
+            log_min, log_max = math.log(param_range[0]), math.log(param_range[1])
+            return min(max(round(math.exp(log_min + x * (log_max - log_min)), 2), param_range[0]), param_range[1])
+        elif param_type == 'checkbox':
+            return x >= 0.5
+        elif param_type in ('radio', 'categorical'):
+            return param_range[min(int(x * len(param_range)), len(param_range) - 1)]
+        else:
+            raise ValueError(f"Unknown parameter type: {param_type}")
+
+    def encode_value(self, param_name, value):
+        param_details = self.space.get(param_name, {})
+        param_type = param_details.get('type')
+        param_range = param_details.get('range')
+
+        if param_type in ('payout', 'multiplier'):
+            log_min, log_max = math.log(param_range[0]), math.log(param_range[1])
+            return (math.log(value) - log_min) / (log_max - log_min)
+        elif param_type == 'checkbox':
+            return 0.75 if value else 0.25
+        elif param_type in ('radio', 'categorical'):
+            return (list(param_range).index(value) + 0.5) / len(param_range)
+        return (value - param_range[0]) / (param_range[1] - param_range[0])
+
+    def decode(self, x):
+        return {param_name: self.decode_value(param_name, value) for param_name, value in zip(self.parameter_names, x)}
+
+    def encode(self, params):
+        return np.array([self.encode_value(param_name, params[param_name]) for param_name in self.parameter_names])
+
+    # Ask / tell
+
+    def ask(self):
+        """Samples a whole generation at once as a (population_size, dimension) matrix"""
+        eigenvalues, B = np.linalg.eigh(self.C)
+        D = np.sqrt(np.maximum(eigenvalues, 1e-20))
+        z = self.rng.standard_normal((self.population_size, self.dimension))
+        x = self.mean + self.sigma * (z * D) @ B.T
+        # Repair into the box, the update below uses the repaired samples
+        self.samples = np.clip(x, 0.0, 1.0)
+        return [self.decode(row) for row in self.samples]
+
+    def tell(self, candidates, fitnesses):
+        fitnesses = np.asarray(fitnesses, dtype=float)
+        for params, fitness in zip(candidates, fitnesses):
+            if fitness < self.gbest_value:
+                self.gbest_value = float(fitness)
+                self.gbest_position = dict(params)
+
+        order = np.argsort(fitnesses)
+        selected = self.samples[order[:self.mu]]
+        old_mean = self.mean
+        self.mean = self.weights @ selected
+        y_w = (self.mean - old_mean) / self.sigma
+
+        eigenvalues, B = np.linalg.eigh(self.C)
+        D = np.sqrt(np.maximum(eigenvalues, 1e-20))
+        inv_sqrt_C = B @ np.diag(1 / D) @ B.T
+
+        self.run_generation += 1
+        self.ps = (1 - self.cs) * self.ps + math.sqrt(self.cs * (2 - self.cs) * self.mueff) * inv_sqrt_C @ y_w
+        ps_norm = np.linalg.norm(self.ps)
+        hsig = ps_norm / math.sqrt(1 - (1 - self.cs) ** (2 * self.run_generation)) / self.chi_n < 1.4 + 2 / (self.dimension + 1)
+        self.pc = (1 - self.cc) * self.pc + hsig * math.sqrt(self.cc * (2 - self.cc) * self.mueff) * y_w
+
+        steps = (selected - old_mean) / self.sigma
+        self.C = (
+            (1 - self.c1 - self.cmu) * self.C
+            + self.c1 * (np.outer(self.pc, self.pc) + (1 - hsig) * self.cc * (2 - self.cc) * self.C)
+            + self.cmu * steps.T @ np.diag(self.weights) @ steps
+        )
+        self.C = (self.C + self.C.T) / 2
+        self.sigma *= math.exp((self.cs / self.damps) * (ps_norm / self.chi_n - 1))
+
+        self.run_best_history.append(float(np.min(fitnesses)))
+        if self.regime == 'large':
+            self.large_budget += len(candidates)
+        else:
+            self.small_budget += len(candidates)
+        if self.restart_strategy and self.should_restart(candidates):
+            self.restart()
+
+    def should_restart(self, candidates):
+        eigenvalues = np.linalg.eigvalsh(self.C)
+        if self.sigma * math.sqrt(max(eigenvalues.max(), 0)) < self.tol_x:
+            return True
+        if eigenvalues.min() <= 0 or eigenvalues.max() / eigenvalues.min() > 1e14:
+            return True
+        # Quantized parameters collapse a converged generation onto a single point
+        if len({tuple(sorted(params.items())) for params in candidates}) == 1:
+            return True
+        window = 10 + int(30 * self.dimension / self.population_size)
+        recent = [value for value in self.run_best_history[-window:] if math.isfinite(value)]
+        if len(self.run_best_history) >= window and recent and max(recent) - min(recent) < self.tol_fun:
+            return True
+        return False
+
+    def restart(self):
+        self.restarts += 1
+        if self.restart_strategy == 'ipop':
+            self.large_population_size *= 2
+            population_size, sigma = self.large_population_size, self.sigma0
+        elif self.small_budget < self.large_budget:
+            # BIPOP: spend the small-population regime's budget on short local runs
+            self.regime = 'small'
+            u = self.rng.random()
+            population_size = max(self.default_population_size, int(self.default_population_size * (0.5 * self.large_population_size / self.default_population_size) ** (u ** 2)))
+            sigma = self.sigma0 * 10 ** (-2 * self.rng.random())
+        else:
+            self.regime = 'large'
+            self.large_population_size *= 2
+            population_size, sigma = self.large_population_size, self.sigma0
+        logging.info(f"CMA-ES restart {self.restarts} ({self.regime} regime) with population {population_size} and sigma {sigma:.4f}")
+        self.start_run(population_size, sigma)
+
+    # Persistence
+
+    def get_state(self):
+        return {
+            'mean': self.mean.tolist(),
+            'sigma': self.sigma,
+            'C': self.C.tolist(),
+            'pc': self.pc.tolist(),
+            'ps': self.ps.tolist(),
+            'population_size': self.population_size,
+            'run_generation': self.run_generation,
+            'run_best_history': self.run_best_history,
+            'restarts': self.restarts,
+            'large_population_size': self.large_population_size,
+            'large_budget': self.large_budget,
+            'small_budget': self.small_budget,
+            'regime': self.regime,
+            'rng': self.rng.bit_generator.state,
+        }
+
+    def set_state(self, state):
+        self.start_run(state['population_size'], state['sigma'])
+        self.mean = np.array(state['mean'])
+        self.C = np.array(state['C'])
+        self.pc = np.array(state['pc'])
+        self.ps = np.array(state['ps'])
+        self.run_generation = state['run_generation']
+        self.run_best_history = state['run_best_history']
+        self.restarts = state['restarts']
+        self.large_population_size = state['large_population_size']
+        self.large_budget = state['large_budget']
+        self.small_budget = state['small_budget']
+        self.regime = state['regime']
+        self.rng.bit_generator.state = state['rng']
+
+    def load_optimization_state(self):
+        loaded_state = self.storage.load_optimization(self.optimization_id)
+        if not loaded_state:
+            return
+        self.gbest_value = loaded_state['gbest_value']
+        self.gbest_position = loaded_state['gbest_position']
+        optimizer_state = self.storage.load_optimizer_state(self.optimization_id)
+        if optimizer_state:
+            self.set_state(optimizer_state['state'])
+            self.current_iteration = optimizer_state['iteration'] + 1
+        logging.info(f"Resumed optimization {self.optimization_id} at generation {self.current_iteration}")
+
+    def save_optimization_state(self, status="in_progress"):
+        optimization_data = {
+            "optimization_id": self.optimization_id,
+            "script_obj": self.script_obj,
+            "initial_balance": self.initial_balance,
+            "num_particles": self.population_size,
+            "max_iter": self.max_iter,
+            "c1": None,
+            "c2": None,
+            "w": None,
+            "damping": None,
+            "gbest_value": self.gbest_value,
+            "gbest_position": self.gbest_position,
+            "status": status,
+            "current_iteration": self.current_iteration
+        }
+        self.service.write(Storage.save_optimization, copy.deepcopy(optimization_data))
+
+    async def optimize(self):
+        telemetry.start('CMAESOptimizer', self.optimization_id, (self.max_iter - self.current_iteration) * self.population_size, self.service.num_workers)
+
+        def on_iteration(iteration):
+            telemetry.set_gbest(self.gbest_value, self.gbest_position)
+            self.current_iteration = iteration
+            self.save_optimization_state()
+            self.service.write(Storage.save_optimizer_state, self.optimization_id, iteration, self.get_state())
+            logging.info(f"Current best fitness: {self.gbest_value}, sigma: {self.sigma:.5f}")
+
+        # The optimization row has to exist before any evaluation referencing it is stored
+        self.save_optimization_state()
+        await run_ask_tell(self, self.service, self.current_iteration, self.max_iter, on_iteration)
+
+        self.save_final_result()
+        await self.service.flush()
+        logging.info(f"Optimization complete. Best position: {self.gbest_position}, Best value: {self.gbest_value}")
+        return {'best_parameters': self.gbest_position, 'best_metric': self.gbest_value}
+
+    def save_final_result(self):
+        self.save_optimization_state(status="completed")
@@ -2,6 +2,7 @@ import asyncio
 import logging
 from collections import deque
 import STPyV8
+from profiling import profiler
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -99,8 +100,10 @@ class Engine(STPyV8.JSClass):
         self._callback_counter += len(self._event_callbacks[event])
         if self._callback_counter > 0:
             self._callback_event.clear()
-        for callback in self._event_callbacks[event]:
-            callback(*args)
+        with profiler.phase('js_callbacks'):
+            for callback in self._event_callbacks[event]:
+                callback(*args)
+        profiler.count('events_emitted')
         if self._callback_counter > 0:
             await self._wait_for_callbacks()
 
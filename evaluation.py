@@ -0,0 +1,429 @@
+import asyncio
+import logging
+import math
+import queue
+import threading
+import time
+
+from analytic import ESTIMATED_OBJECTIVES, estimate, estimated_statistics
+from metrics import mean_and_standard_error, paired_difference
+from objectives import get_objective
+from simulator import Simulator
+from space import canonicalize
+from storage import Storage
+from telemetry import telemetry
+
+
+class InProcessBackend:
+    def __init__(self):
+        """Runs simulations on the event loop of the calling process"""
+        self.num_workers = 1
+        self.simulators = {}
+
+    async def evaluate(self, script_obj, initial_balance, game_results, params, sequential=None):
+        simulator = self.simulators.get(id(script_obj))
+        if simulator is None:
+            simulator = self.simulators[id(script_obj)] = Simulator(script_obj)
+        if sequential is not None:
+            return await simulator.run_sequential(initial_balance, game_results, params, **sequential)
+        return await simulator.run(initial_balance, game_results, params)
+
+    def close(self):
+        self.simulators.clear()
+
+
+def create_backend(name, num_workers=1, **options):
+    """Creates an evaluation backend by name: 'inprocess', 'process' or 'cluster'
+
+    There is no thread backend, STPyV8 aborts when simulations run outside the main thread.
+    """
+    if name == 'inprocess':
+        return InProcessBackend()
+    elif name == 'process':
+        from workers import WorkerPool
+        return WorkerPool(num_workers, **options)
+    elif name == 'cluster':
+        from cluster import ClusterBackend
+        return ClusterBackend(num_workers=num_workers, **options)
+    else:
+        raise ValueError(f"Unknown evaluation backend: {name}")
+
+
+class StorageWriter:
+    def __init__(self, db_path):
+        """Applies storage writes in order on a background thread with its own connection"""
+        self.db_path = db_path
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        storage = Storage(self.db_path)
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    break
+                func, args = item
+                func(storage, *args)
+            except Exception as e:
+                logging.error(f"Background storage write failed: {e}")
+            finally:
+                self.queue.task_done()
+        storage.close()
+
+    def write(self, func, *args):
+        self.queue.put((func, args))
+
+    def flush(self):
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+class EvaluationService:
+    def __init__(self, script_obj, initial_balance, game_results, backend=None, storage=None, optimization_id=None, cache=False, space=None, minimize=True, objective=None):
+        """Evaluates candidate parameter sets on a backend and persists the results in the background
+
+        :param script_obj: The script to simulate
+        :param initial_balance: The initial balance of every simulation
+        :param game_results: The game sets every candidate is simulated on
+        :param backend: An evaluation backend, defaults to simulating in-process
+        :param storage: Storage whose database receives the evaluations (None to not persist)
+        :param optimization_id: The optimization the evaluations belong to
+        :param cache: Reuse the fitness of candidates that were already evaluated, either True for a
+            private cache or a mapping shared with other services (e.g. a multiprocessing Manager dict)
+        :param space: The parameter space, candidates are quantized to its resolutions before being evaluated
+        :param minimize: Whether the optimizer minimizes the fitness, decides which candidate is the incumbent
+        :param objective: Name of the objective used as fitness, defaults to Statistics.get_metric
+        """
+        self.script_obj = script_obj
+        self.initial_balance = initial_balance
+        self.game_results = game_results
+        self.backend = backend or InProcessBackend()
+        self.optimization_id = optimization_id
+        self.writer = StorageWriter(storage.db_path) if storage is not None else None
+        if cache is True:
+            self.cache = {}
+        else:
+            self.cache = cache if cache is not False else None
+        self.space = space
+        # Simulations currently running by candidate, identical candidates wait for the same one
+        self.in_flight = {}
+        self.stats = {'requested': 0, 'simulated': 0, 'cache_hits': 0, 'deduplicated': 0, 'prescreened': 0, 'surrogate_skipped': 0, 'from_storage': 0, 'games': 0}
+        # Metric of every set by candidate, for standard errors and paired comparisons
+        self.set_metrics = {}
+        self.minimize = minimize
+        self.incumbent = None
+        self.sequential = None
+        self.prescreen = None
+        self.surrogate = None
+        self.budget = None
+        self.objective = get_objective(objective) if objective is not None else None
+        # Full statistics by candidate, persisted with the evaluations
+        self.statistics = {}
+        # Statistics loaded from earlier evaluations on the same games, used instead of simulating
+        self.stored_statistics = {}
+
+    @property
+    def num_workers(self):
+        return self.backend.num_workers
+
+    @staticmethod
+    def candidate_key(params):
+        return tuple(sorted(params.items()))
+
+    def fitness(self, statistics, set_statistics=()):
+        """The fitness of simulated Statistics, an objective's value is turned to the direction of the optimizer
+
+        :param set_statistics: The Statistics of every set, for objectives that look at them
+        """
+        if self.objective is None:
+            return statistics.get_metric()
+        value = self.objective(statistics.get_statistics(), [set_stats.get_statistics() for set_stats in set_statistics])
+        return self.objective.oriented(value, self.minimize)
+
+    def stored_fitness(self, statistics):
+        """Fitness of statistics loaded from storage, as dictionaries"""
+        if all(set_statistics['balance'] == 0 for set_statistics in statistics['sets']):
+            return float('inf')
+        if self.objective is None:
+            return get_objective('metric')(statistics['mean'], statistics['sets'])
+        return self.objective.oriented(self.objective(statistics['mean'], statistics['sets']), self.minimize)
+
+    def load_statistics(self, evaluations):
+        """Reuses stored evaluations, from Storage.load_evaluations, instead of simulating the same candidates again
+
+        Only valid for evaluations simulated on the same script, balance and game sets. The fitness is
+        computed again from the statistics, so they can come from a run that optimized another objective.
+        """
+        for evaluation in evaluations:
+            if evaluation.get('statistics') is not None:
+                self.stored_statistics[self.candidate_key(self.canonicalize(evaluation['parameters']))] = evaluation['statistics']
+
+    def enable_sequential(self, min_sets=2, max_sets=None, confidence=0.95):
+        """Simulates candidates one game set at a time until they clearly beat or lose to the incumbent
+
+        :param min_sets: Sets every candidate is simulated on
+        :param max_sets: Most sets a candidate is simulated on, defaults to every set of the bank
+        :param confidence: Confidence level used to separate a candidate from the incumbent
+        """
+        self.sequential = {'min_sets': min_sets, 'max_sets': max_sets, 'confidence': confidence}
+
+    def enable_prescreen(self, margin=0.25, max_ruin_probability=0.99, min_bet_probability=0.001):
+        """Skips simulating candidates whose analytical estimate can't beat the incumbent
+
+        Only applies to scripts declaring a structure the analytic module models. A skipped candidate
+        gets its estimated fitness, infinity when it is almost certainly ruined, or the fitness of a
+        run without bets when its wait streak practically never happens. With an objective
+        the estimates can't compute, only the almost certainly ruined candidates are skipped.
+
+        :param margin: How much worse than the incumbent, relative to it, an estimate has to be to skip the candidate
+        :param max_ruin_probability: Candidates at least this likely to run out of balance are skipped
+        :param min_bet_probability: Candidates less likely to ever see their wait streak are skipped as never betting
+        """
+        self.prescreen = {'margin': margin, 'max_ruin_probability': max_ruin_probability, 'min_bet_probability': min_bet_probability}
+
+    def enable_surrogate(self, surrogate):
+        """Skips candidates a SurrogateFilter predicts to be worse than their threshold, see evaluate_batch"""
+        self.surrogate = surrogate
+
+    def enable_budget(self, budget):
+        """Ends run_ask_tell when a budget.Budget runs out instead of after a number of iterations"""
+        self.budget = budget
+
+    def screen(self, params):
+        """Returns the analytical fitness of a candidate that doesn't need simulating, None otherwise"""
+        estimated = estimate(self.script_obj, params, self.initial_balance, self.game_results.num_games)
+        if estimated is None:
+            return None
+        if estimated['ruin_probability'] >= self.prescreen['max_ruin_probability']:
+            return float('inf')
+        if self.objective is not None and self.objective.name not in ESTIMATED_OBJECTIVES:
+            return None
+        statistics = estimated_statistics(estimated, self.initial_balance)
+        never_bets = estimated['bet_probability'] < self.prescreen['min_bet_probability']
+        if never_bets:
+            # Its wait streak practically never happens within the games, simulating it wouldn't place a bet
+            statistics.update(profit=0.0, total_wagered=0.0, games_played=0.0)
+        if self.objective is None:
+            fitness = get_objective('metric')(statistics)
+        else:
+            fitness = self.objective.oriented(self.objective(statistics), self.minimize)
+        if never_bets:
+            return fitness
+        if self.incumbent is None or not math.isfinite(fitness):
+            return None
+        margin = self.prescreen['margin'] * abs(self.incumbent)
+        if (fitness > self.incumbent + margin) if self.minimize else (fitness < self.incumbent - margin):
+            return fitness
+        return None
+
+    def canonicalize(self, params):
+        return canonicalize(self.space, params) if self.space is not None else params
+
+    def get_stats(self):
+        """Returns the evaluation counters, with the number of simulations saved by the cache, deduplication and filtering"""
+        return dict(self.stats, saved=self.stats['cache_hits'] + self.stats['deduplicated'] + self.stats['prescreened'] + self.stats['surrogate_skipped'] + self.stats['from_storage'])
+
+    async def evaluate(self, params):
+        """Simulates a single candidate and returns its fitness, infinity if the simulation failed
+
+        A candidate identical to one that is still being simulated waits for that simulation
+        instead of starting its own.
+        """
+        params = self.canonicalize(params)
+        key = self.candidate_key(params)
+        self.stats['requested'] += 1
+        if self.cache is not None:
+            if key in self.cache:
+                self.stats['cache_hits'] += 1
+                telemetry.cache_hit()
+                return self.cache[key]
+            telemetry.cache_miss()
+
+        pending = self.in_flight.get(key)
+        if pending is not None:
+            self.stats['deduplicated'] += 1
+            telemetry.evaluation_deduplicated()
+            return await asyncio.shield(pending)
+
+        pending = self.in_flight[key] = asyncio.get_running_loop().create_future()
+        try:
+            fitness = await self._simulate(key, params)
+        except BaseException:
+            pending.cancel()
+            raise
+        else:
+            pending.set_result(fitness)
+        finally:
+            del self.in_flight[key]
+
+        if self.cache is not None:
+            self.cache[key] = fitness
+        return fitness
+
+    async def _simulate(self, key, params):
+        stored = self.stored_statistics.get(key)
+        if stored is not None:
+            self.stats['from_storage'] += 1
+            self.statistics[key] = stored
+            return self.stored_fitness(stored)
+        if self.prescreen is not None:
+            fitness = self.screen(params)
+            if fitness is not None:
+                self.stats['prescreened'] += 1
+                logging.debug(f"Pre-screened {params}: {fitness}")
+                return fitness
+        self.stats['simulated'] += 1
+        started = telemetry.evaluation_started()
+        try:
+            if self.sequential is not None:
+                # The incumbent is a fitness, so sets are compared on the same objective and direction
+                sequential = dict(self.sequential, incumbent=self.incumbent, objective=self.objective.name if self.objective is not None else None, minimize=self.minimize)
+                sim_result = await self.backend.evaluate(self.script_obj, self.initial_balance, self.game_results, params, sequential=sequential)
+            else:
+                sim_result = await self.backend.evaluate(self.script_obj, self.initial_balance, self.game_results, params)
+            fitness = self.fitness(sim_result[0], sim_result[1] or ())
+            num_sets = len(self.game_results.result_sets)
+            if sim_result[1] is not None:
+                self.set_metrics[key] = [self.fitness(statistics, [statistics]) for statistics in sim_result[1]]
+                self.statistics[key] = {'mean': sim_result[0].get_statistics(), 'sets': [statistics.get_statistics() for statistics in sim_result[1]]}
+                num_sets = len(sim_result[1])
+            self.stats['games'] += sim_result[0].games_total * num_sets
+            telemetry.evaluation_finished(started, games=sim_result[0].games_total * num_sets)
+            if math.isfinite(fitness) and (self.incumbent is None or (fitness < self.incumbent if self.minimize else fitness > self.incumbent)):
+                self.incumbent = fitness
+            if self.surrogate is not None:
+                self.surrogate.observe([params], [fitness], self.minimize)
+        except Exception as e:
+            telemetry.evaluation_finished(started, failed=True)
+            logging.error(f"Error evaluating candidate {params}: {e}")
+            fitness = float('inf')
+        return fitness
+
+    def standard_error(self, params):
+        """Returns the standard error of a simulated candidate's fitness across the game sets"""
+        return mean_and_standard_error(self.set_metrics.get(self.candidate_key(self.canonicalize(params)), []))[1]
+
+    def compare(self, params_a, params_b):
+        """Paired comparison of two simulated candidates on the same game sets
+
+        :return: The mean fitness difference a - b and its standard error
+        """
+        metrics_a = self.set_metrics.get(self.candidate_key(self.canonicalize(params_a)), [])
+        metrics_b = self.set_metrics.get(self.candidate_key(self.canonicalize(params_b)), [])
+        return paired_difference(metrics_a, metrics_b)
+
+    async def evaluate_batch(self, candidates, iteration=None, thresholds=None):
+        """Evaluates a batch of candidates, yielding (index, params, fitness) as each one completes
+
+        Once the whole batch is done its results are queued for storage, so persisting them
+        overlaps with whatever the caller does next.
+
+        :param thresholds: The fitness every candidate has to beat to be of use to the optimizer, e.g. a
+            particle's personal best. With a surrogate, candidates predicted to be worse are not simulated
+            and get their predicted fitness. Defaults to the incumbent.
+        """
+        async def run(index, params):
+            return index, params, await self.evaluate(params)
+
+        candidates = [self.canonicalize(params) for params in candidates]
+
+        predicted = [None] * len(candidates)
+        if self.surrogate is not None:
+            predicted = self.surrogate.screen(candidates, thresholds or [self.incumbent] * len(candidates), self.minimize)
+        for index, params in enumerate(candidates):
+            if predicted[index] is not None:
+                self.stats['requested'] += 1
+                self.stats['surrogate_skipped'] += 1
+                yield index, params, predicted[index]
+
+        results = []
+        tasks = [run(index, params) for index, params in enumerate(candidates) if predicted[index] is None]
+        for task in asyncio.as_completed(tasks):
+            index, params, fitness = await task
+            results.append((index, params, fitness))
+            yield index, params, fitness
+
+        # Predictions aren't stored, only simulated candidates are evaluations
+        if self.writer is not None and self.optimization_id is not None and results:
+            results.sort(key=lambda result: result[0])
+            self.write(Storage.save_evaluations, self.optimization_id, iteration, [
+                (params, fitness, self.statistics.get(self.candidate_key(params))) for _, params, fitness in results
+            ])
+
+    async def evaluate_all(self, candidates, iteration=None, thresholds=None):
+        fitnesses = [None] * len(candidates)
+        async for index, _, fitness in self.evaluate_batch(candidates, iteration, thresholds):
+            fitnesses[index] = fitness
+        return fitnesses
+
+    def write(self, func, *args):
+        """Queues a Storage method call, e.g. write(Storage.save_iteration_state, optimization_id, data)"""
+        if self.writer is not None:
+            self.writer.write(func, *args)
+
+    async def flush(self):
+        if self.writer is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self.writer.flush)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+async def run_ask_tell(optimizer, service, start_iteration, max_iter, on_iteration=None):
+    """Drives any optimizer implementing ask() and tell(candidates, fitnesses)
+
+    :param optimizer: The optimizer proposing candidates
+    :param service: The EvaluationService evaluating them
+    :param start_iteration: The first iteration to run (non-zero when resuming)
+    :param max_iter: The number of iterations to run up to
+    :param on_iteration: Called with the iteration number after every tell
+
+    An optimizer can also implement skip_thresholds(candidates), returning the fitness each candidate
+    has to beat to change its state, so a surrogate only skips candidates that wouldn't matter.
+
+    With a budget enabled on the service, max_iter is planned again after every iteration from the
+    measured cost, see budget.Budget, and optimizers with a max_iter attribute store the plan.
+    """
+    budget = service.budget
+    if budget is not None:
+        budget.start(service, max_iter - start_iteration)
+    iteration = start_iteration
+    while iteration < max_iter:
+        if budget is not None and not budget.fits_iteration(service):
+            logging.info(f"Budget: stopping before iteration {iteration + 1}, the {budget.stop_reason} left doesn't cover it")
+            break
+        logging.info(f"Iteration {iteration + 1}")
+        started, games = time.time(), service.stats['games']
+        candidates = optimizer.ask()
+        thresholds = optimizer.skip_thresholds(candidates) if hasattr(optimizer, 'skip_thresholds') else None
+        fitnesses = await service.evaluate_all(candidates, iteration, thresholds)
+        optimizer.tell(candidates, fitnesses)
+        if budget is not None:
+            budget.record(time.time() - started, service.stats['games'] - games, len(candidates))
+            max_iter = budget.plan(optimizer, service, iteration + 1, max_iter)
+            if hasattr(optimizer, 'max_iter'):
+                optimizer.max_iter = max_iter
+            telemetry.set_remaining((max_iter - iteration - 1) * (budget.last_candidates or len(candidates)))
+        # Checkpoints come after planning, so they hold the swarm and max_iter of the next iteration
+        if on_iteration is not None:
+            on_iteration(iteration)
+        finite = [index for index, fitness in enumerate(fitnesses) if math.isfinite(fitness)]
+        if finite:
+            best = (min if service.minimize else max)(finite, key=lambda index: fitnesses[index])
+            logging.info(f"Iteration {iteration + 1} done, best fitness this iteration: {fitnesses[best]} ± {service.standard_error(candidates[best])}")
+        else:
+            logging.info(f"Iteration {iteration + 1} done, no candidate finished")
+        iteration += 1
+    stats = service.get_stats()
+    logging.info(f"Evaluations: {stats['requested']} requested, {stats['simulated']} simulated, {stats['saved']} saved by the cache, deduplication and filtering")
+    if service.surrogate is not None:
+        logging.info(f"Surrogate: {service.surrogate.get_stats()}")
+    if budget is not None:
+        logging.info(budget.format_report(service))
@@ -0,0 +1,236 @@
+import argparse
+import csv
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+from simulator import GameResults, bust_from_hash
+
+ID_COLUMNS = ('id', 'game_id')
+HASH_COLUMNS = ('hash', 'game_hash')
+BUST_COLUMNS = ('bust', 'crash')
+MAX_REPORTED = 20  # Problems listed per kind, all of them are counted
+
+
+class GameStore:
+    def __init__(self, db_path):
+        """Real game history, indexed by game id and by hash
+
+        Games are stored compactly: the id is the row id, the hash 32 bytes and the bust an integer
+        of cents. Ranges of games are read by id, so the history never has to fit in memory.
+
+        :param db_path: The SQLite file of the store
+        """
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.cursor = self.conn.cursor()
+        self.create_tables()
+
+    def create_tables(self):
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS games (
+                id INTEGER PRIMARY KEY,
+                hash BLOB NOT NULL,
+                bust INTEGER NOT NULL
+            )
+        """)
+        self.cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_games_hash ON games (hash)")
+        self.conn.commit()
+
+    def import_games(self, games, batch_size=50000):
+        """Inserts (id, hash, bust) tuples, replacing games already stored with the same id
+
+        :return: The number of games imported
+        """
+        imported = 0
+        batch = []
+        try:
+            for game_id, hash_value, bust in games:
+                batch.append((game_id, bytes.fromhex(hash_value), round(bust * 100)))
+                if len(batch) >= batch_size:
+                    imported += self._insert(batch)
+                    batch = []
+            if batch:
+                imported += self._insert(batch)
+        except sqlite3.Error as e:
+            logging.error(f"An error occurred while importing games: {e}")
+            self.conn.rollback()
+        return imported
+
+    def _insert(self, batch):
+        self.cursor.executemany("INSERT OR REPLACE INTO games (id, hash, bust) VALUES (?, ?, ?)", batch)
+        self.conn.commit()
+        return len(batch)
+
+    def id_range(self):
+        """Returns (first id, last id, number of games), ids of None when the store is empty"""
+        self.cursor.execute("SELECT MIN(id), MAX(id), COUNT(*) FROM games")
+        return self.cursor.fetchone()
+
+    def get_by_hash(self, hash_value):
+        self.cursor.execute("SELECT id, hash, bust FROM games WHERE hash = ?", (bytes.fromhex(hash_value),))
+        row = self.cursor.fetchone()
+        return self._game(row) if row else None
+
+    @staticmethod
+    def _game(row):
+        return {'id': row[0], 'hash': row[1].hex(), 'bust': row[2] / 100}
+
+    def games(self, start_id, end_id):
+        """The games with ids in [start_id, end_id), in the order they were played"""
+        self.cursor.execute("SELECT id, hash, bust FROM games WHERE id >= ? AND id < ? ORDER BY id", (start_id, end_id))
+        return [self._game(row) for row in self.cursor.fetchall()]
+
+    def game_results(self, ranges, required_median=None):
+        """GameResults with one set per (start_id, end_id) range, for the simulator and the optimizers"""
+        return GameResults.from_game_sets([self.games(start_id, end_id) for start_id, end_id in ranges], required_median)
+
+    def close(self):
+        self.cursor.close()
+        self.conn.close()
+
+
+def _column(fieldnames, names, path):
+    for name in names:
+        if name in fieldnames:
+            return name
+    raise ValueError(f"{path} has none of the columns {', '.join(names)}")
+
+
+def read_games(path):
+    """Streams (id, hash, bust) from a CSV, JSON lines or JSON file
+
+    Rows need an id and a hash, the bust is computed from the hash when missing. JSON files hold a
+    list of objects and are read whole, use CSV or JSON lines (.jsonl) for large exports.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        with open(path, 'r', encoding='utf-8', newline='') as file:
+            reader = csv.DictReader(file)
+            yield from _parse_rows(reader, reader.fieldnames or [], path)
+    elif extension in ('.jsonl', '.ndjson'):
+        with open(path, 'r', encoding='utf-8') as file:
+            rows = (json.loads(line) for line in file if line.strip())
+            first = next(rows, None)
+            if first is not None:
+                yield from _parse_rows(_chain(first, rows), list(first), path)
+    elif extension == '.json':
+        with open(path, 'r', encoding='utf-8') as file:
+            rows = json.load(file)
+        if rows:
+            yield from _parse_rows(rows, list(rows[0]), path)
+    else:
+        raise ValueError(f"Unknown game history format: {path}, use .csv, .jsonl or .json")
+
+
+def _chain(first, rows):
+    yield first
+    yield from rows
+
+
+def _parse_rows(rows, fieldnames, path):
+    id_column = _column(fieldnames, ID_COLUMNS, path)
+    hash_column = _column(fieldnames, HASH_COLUMNS, path)
+    bust_column = next((name for name in BUST_COLUMNS if name in fieldnames), None)
+    for row in rows:
+        hash_value = row[hash_column].strip().lower()
+        bust = float(row[bust_column]) if bust_column is not None and row[bust_column] not in (None, '') else bust_from_hash(hash_value)
+        yield int(row[id_column]), hash_value, bust
+
+
+def verify_range(db_path, start_id, end_id, check_busts=True):
+    """Checks the games with ids in [start_id, end_id) against the game chain, runs in a worker process
+
+    Every game's hash must be the SHA-256 of the next game's hash, and with check_busts its bust must
+    be the one computed from its hash. The first game after the range is read to check the last link.
+    Every id of the range that isn't stored counts as missing, also at its edges.
+    """
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    rows = conn.execute("SELECT id, hash, bust FROM games WHERE id >= ? AND id <= ? ORDER BY id", (start_id, end_id)).fetchall()
+    conn.close()
+
+    result = {'checked': 0, 'missing': 0, 'broken_links': [], 'wrong_busts': [], 'broken_link_count': 0, 'wrong_bust_count': 0}
+    previous = None
+    for game_id, hash_bytes, bust in rows:
+        if previous is not None:
+            previous_id, previous_hash = previous
+            # Links across missing games can't be checked
+            if game_id == previous_id + 1 and hashlib.sha256(hash_bytes.hex().encode()).digest() != previous_hash:
+                result['broken_link_count'] += 1
+                if len(result['broken_links']) < MAX_REPORTED:
+                    result['broken_links'].append(previous_id)
+        if game_id < end_id:
+            result['checked'] += 1
+            if check_busts and round(bust_from_hash(hash_bytes.hex()) * 100) != bust:
+                result['wrong_bust_count'] += 1
+                if len(result['wrong_busts']) < MAX_REPORTED:
+                    result['wrong_busts'].append(game_id)
+        previous = (game_id, hash_bytes)
+    result['missing'] = end_id - start_id - result['checked']
+    return result
+
+
+def verify(db_path, workers=None, chunk_size=100000, check_busts=True):
+    """Verifies the whole store in parallel, chunk by chunk
+
+    :return: Totals of the checked games, missing ids, broken chain links and wrong busts, with the
+        first ids of each problem
+    """
+    store = GameStore(db_path)
+    first_id, last_id, _ = store.id_range()
+    store.close()
+    totals = {'checked': 0, 'missing': 0, 'broken_links': [], 'wrong_busts': [], 'broken_link_count': 0, 'wrong_bust_count': 0}
+    if first_id is None:
+        return totals
+
+    chunks = [(start, min(start + chunk_size, last_id + 1)) for start in range(first_id, last_id + 1, chunk_size)]
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = [executor.submit(verify_range, db_path, start, end, check_busts) for start, end in chunks]
+        for future in futures:
+            result = future.result()
+            for key in ('checked', 'missing', 'broken_link_count', 'wrong_bust_count'):
+                totals[key] += result[key]
+            for key in ('broken_links', 'wrong_busts'):
+                totals[key].extend(result[key][:MAX_REPORTED - len(totals[key])])
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import real game history and verify its hash chain.')
+    parser.add_argument('db', help='The game store, a SQLite file.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    import_parser = commands.add_parser('import', help='Import CSV, JSON lines or JSON exports with id, hash and optionally bust.')
+    import_parser.add_argument('files', nargs='+', help='Files to import.')
+
+    verify_parser = commands.add_parser('verify', help='Check every hash chain link and bust, in parallel.')
+    verify_parser.add_argument('--workers', type=int, help='Number of processes. Defaults to the number of CPUs.')
+    verify_parser.add_argument('--chunk-size', type=int, default=100000, help='Games checked per task. Defaults to 100000.')
+    verify_parser.add_argument('--links-only', action='store_true', help='Only check the hash chain, not the busts.')
+
+    commands.add_parser('info', help='Show the range of stored game ids.')
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        store = GameStore(args.db)
+        for path in args.files:
+            print(f"{path}: {store.import_games(read_games(path))} games imported")
+        store.close()
+    elif args.command == 'verify':
+        result = verify(args.db, args.workers, args.chunk_size, not args.links_only)
+        print(json.dumps(result, indent=2))
+        if result['missing'] or result['broken_link_count'] or result['wrong_bust_count']:
+            raise SystemExit(1)
+    else:
+        store = GameStore(args.db)
+        first_id, last_id, count = store.id_range()
+        store.close()
+        print(f"{count} games, ids {first_id} to {last_id}")
+
+
+if __name__ == '__main__':
+    main()
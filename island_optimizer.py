@@ -0,0 +1,235 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import random
+import time
+from math import isfinite
+
+import numpy as np
+
+from optimizer import Optimizer
+from storage import Storage
+from telemetry import telemetry
+
+
+class Island(Optimizer):
+    def __init__(self, script_obj, initial_balance, game_results, parameter_names, space, island, migration_interval, migration_size, inbox, outbox, reports, fitness_cache=None):
+        """A genetic algorithm sub-population that trades its elites with the neighbouring island
+
+        :param island: The index of this island
+        :param migration_interval: Generations between migrations
+        :param migration_size: Number of elites sent to the next island per migration
+        :param inbox: Queue receiving the elites of the previous island
+        :param outbox: Queue delivering this island's elites to the next island
+        :param reports: Queue receiving progress and the final result for the coordinating process
+        :param fitness_cache: Mapping of evaluated candidates shared by all islands
+        """
+        super().__init__(script_obj, initial_balance, game_results, parameter_names, space, fitness_cache=fitness_cache)
+        self.island = island
+        self.migration_interval = migration_interval
+        self.migration_size = migration_size
+        self.inbox = inbox
+        self.outbox = outbox
+        self.reports = reports
+
+    def tell(self, candidates, fitnesses):
+        super().tell(candidates, fitnesses)
+        # Metrics are maximized by the genetic algorithm, failed runs are infinite
+        evaluated = sorted(((fit, params) for params, fit in zip(candidates, fitnesses) if isfinite(fit)), key=lambda result: result[0], reverse=True)
+        if evaluated:
+            self.reports.put(('generation', self.island, self.generation, evaluated[0][0], dict(evaluated[0][1])))
+        if self.generation % self.migration_interval == 0:
+            self.migrate([dict(params) for _, params in evaluated[:self.migration_size]])
+
+    def migrate(self, emigrants):
+        """Sends this generation's elites to the next island and replaces the worst children with arrivals
+
+        Migration is asynchronous, an island never waits for its neighbour and only takes in the
+        elites that arrived since the last migration.
+        """
+        if emigrants:
+            self.outbox.put(emigrants)
+        immigrants = []
+        while True:
+            try:
+                immigrants.extend(self.inbox.get_nowait())
+            except queue.Empty:
+                break
+        # The population is the elite followed by the children, so the children at the end make way
+        for offset, individual in enumerate(immigrants[-self.migration_size:]):
+            self.population[len(self.population) - 1 - offset] = individual
+        if immigrants:
+            logging.debug(f"Island {self.island} generation {self.generation}: {len(immigrants)} immigrants")
+
+
+def _island_main(island, num_islands, script_obj, initial_balance, game_results, parameter_names, space, settings, fitness_cache, inbox, outbox, reports):
+    if settings['seed'] is not None:
+        np.random.seed(settings['seed'] + island)
+    try:
+        optimizer = Island(script_obj, initial_balance, game_results, parameter_names, space, island, settings['migration_interval'], settings['migration_size'], inbox, outbox, reports, fitness_cache=fitness_cache)
+        optimizer.population_size = settings['population_size']
+        optimizer.num_generations = settings['num_generations']
+        # Every island starts from its share of the warm start individuals
+        optimizer.warm_start(settings['warm_start'][island::num_islands])
+        result = asyncio.run(optimizer.run_optimization())
+        reports.put(('done', island, result, None))
+    except Exception as e:
+        logging.exception(f"Island {island} failed")
+        reports.put(('done', island, None, str(e)))
+
+
+class IslandOptimizer:
+    minimize = False  # Metrics are maximized, like Optimizer
+
+    def __init__(self, script_obj, initial_balance, game_results, parameter_names, space, optimization_id=None, backend=None, num_islands=None):
+        """Island model genetic algorithm, every island evolves in its own process
+
+        Islands form a ring: every migration_interval generations each island sends its best
+        individuals to the next one. All islands share one fitness cache so an individual that
+        migrates, or is bred on several islands, is only simulated once.
+
+        :param backend: Only used for its number of workers, which sets the default number of islands
+        :param num_islands: Number of islands, defaults to the number of workers or CPUs
+        """
+        self.script_obj = script_obj
+        self.initial_balance = initial_balance
+        self.game_results = game_results
+        self.parameter_names = parameter_names
+        self.space = space
+
+        if num_islands is None:
+            num_islands = backend.num_workers if backend is not None and backend.num_workers > 1 else os.cpu_count()
+        self.num_islands = max(1, num_islands)
+        self.population_size = 20  # Per island
+        self.num_generations = 30
+        self.migration_interval = 5  # Generations between migrations
+        self.migration_size = 2  # Elites sent to the next island per migration
+        self.seed = None  # Island i is seeded with seed + i when set
+        self.warm_start_individuals = []
+
+        self.storage = Storage('optimizations.db')
+        self.optimization_id = optimization_id or self.generate_optimization_id()
+        self.gbest_value = None
+        self.gbest_position = {key: 0.0 for key in self.parameter_names}
+        self.current_iteration = 0
+
+    def warm_start(self, individuals):
+        """Seeds the initial populations with known good individuals, shared out between the islands"""
+        self.warm_start_individuals = [dict(individual) for individual in individuals]
+
+    def generate_optimization_id(self):
+        while True:
+            optimization_id = f"opt_{int(time.time() * 1000)}_{random.randint(1000, 9999)}"
+            if not self.storage.optimization_exists(optimization_id):
+                return optimization_id
+
+    def save_optimization_state(self, status="in_progress"):
+        self.storage.save_optimization({
+            "optimization_id": self.optimization_id,
+            "script_obj": self.script_obj,
+            "initial_balance": self.initial_balance,
+            "num_particles": self.population_size * self.num_islands,
+            "max_iter": self.num_generations,
+            "c1": None,
+            "c2": None,
+            "w": None,
+            "damping": None,
+            "gbest_value": self.gbest_value,
+            "gbest_position": {key: value.item() if hasattr(value, 'item') else value for key, value in self.gbest_position.items()},
+            "status": status,
+            "current_iteration": self.current_iteration
+        })
+
+    def _collect(self, processes, reports):
+        """Blocks until every island reported its result, returns them by island"""
+        results = {}
+        generations = [0] * self.num_islands
+        while len(results) < self.num_islands:
+            try:
+                message = reports.get(timeout=1)
+            except queue.Empty:
+                for island, process in enumerate(processes):
+                    if island not in results and not process.is_alive():
+                        logging.error(f"Island {island} exited with code {process.exitcode}")
+                        results[island] = None
+                continue
+
+            if message[0] == 'generation':
+                _, island, generation, metric, params = message
+                generations[island] = generation
+                if self.gbest_value is None or metric > self.gbest_value:
+                    self.gbest_value = metric
+                    self.gbest_position = params
+                    telemetry.set_gbest(metric, params)
+                if min(generations) > self.current_iteration:
+                    self.current_iteration = min(generations)
+                    logging.info(f"Generation {self.current_iteration} done on all islands, best metric: {self.gbest_value}")
+                    self.save_optimization_state()
+            else:
+                _, island, result, error = message
+                if error is not None:
+                    logging.error(f"Island {island} failed: {error}")
+                results[island] = result
+        return results
+
+    async def optimize(self):
+        telemetry.start('IslandOptimizer', self.optimization_id, None, self.num_islands)
+        self.save_optimization_state()
+        settings = {
+            'population_size': self.population_size,
+            'num_generations': self.num_generations,
+            'migration_interval': self.migration_interval,
+            'migration_size': self.migration_size,
+            'seed': self.seed,
+            'warm_start': self.warm_start_individuals,
+        }
+
+        context = multiprocessing.get_context('spawn')
+        with context.Manager() as manager:
+            fitness_cache = manager.dict()
+            inboxes = [context.Queue() for _ in range(self.num_islands)]
+            reports = context.Queue()
+            processes = [
+                context.Process(
+                    target=_island_main,
+                    args=(island, self.num_islands, self.script_obj, self.initial_balance, self.game_results, self.parameter_names, self.space, settings, fitness_cache,
+                          inboxes[island], inboxes[(island + 1) % self.num_islands], reports),
+                    daemon=True,
+                )
+                for island in range(self.num_islands)
+            ]
+            for process in processes:
+                process.start()
+            results = await asyncio.get_running_loop().run_in_executor(None, self._collect, processes, reports)
+            for process in processes:
+                process.join()
+            logging.info(f"Islands evaluated {len(fitness_cache)} unique individuals")
+
+        results = [result for result in results.values() if result is not None]
+        if not results:
+            raise RuntimeError("Every island failed")
+
+        best = max(results, key=lambda result: result['best_metric'])
+        if self.gbest_value is None or best['best_metric'] > self.gbest_value:
+            self.gbest_value = best['best_metric']
+            self.gbest_position = best['best_parameters']
+
+        # Merge the islands' top 5, an individual can appear on several islands after migrating
+        top_results = {tuple(sorted(self.gbest_position.items())): {'parameters': self.gbest_position, 'metric': self.gbest_value}}
+        for result in results:
+            for _, entry in result['top_5_results']:
+                top_results.setdefault(tuple(sorted(entry['parameters'].items())), entry)
+        top_5_results = sorted(top_results.values(), key=lambda entry: entry['metric'], reverse=True)[:5]
+
+        logging.info(f"Optimization complete. Best position: {self.gbest_position}, Best value: {self.gbest_value}")
+        return {
+            'best_parameters': self.gbest_position,
+            'best_metric': self.gbest_value,
+            'top_5_results': list(enumerate(top_5_results)),
+        }
+
+    def save_final_result(self):
+        self.current_iteration = self.num_generations
+        self.save_optimization_state(status="completed")
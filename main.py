@@ -2,19 +2,14 @@ import argparse
 import hashlib
 import logging
 import math
-import numpy as np
 import asyncio
-from prettytable import PrettyTable
 from script import Script
-from simulator import GameResults
 from storage import Storage
-# from optimizer import Optimizer
-from ps_optimizer import PSOptimizer as Optimizer
-import gc
-import tracemalloc
-
-tracemalloc.start()
-np.int = np.int64 # Fix for a bug in skopt
+from space import build_space
+from evaluation import create_backend
+from profiling import profiler
+from run_spec import OPTIMIZERS, configure_service, create_game_results, load_optimizer, load_run_spec, normalize_spec
+from telemetry import telemetry, HttpExporter, PrometheusFileExporter
 
 def get_default_range(param_type, default_value):
     if param_type == 'multiplier':
@@ -35,6 +30,7 @@ def get_default_range(param_type, default_value):
         return None
 
 def select_parameters(config):
+    from prettytable import PrettyTable
     parameters = []
     print("Select parameters to optimize:")
     available_params_table = PrettyTable()
@@ -128,41 +124,96 @@ def select_parameters(config):
         except (ValueError, IndexError):
             print('Invalid choice. Please try again.')
     return parameters
+
+
+def spec_from_args(args):
+    """Builds a run spec from the command line, the script and parameters may still be missing"""
+    return {
+        'script': args.script,
+        'params': args.params,
+        'optimizer': args.optimizer,
+        'balance': args.balance,
+        'games': args.games,
+        'sets': args.sets,
+        'seed': args.seed,
+        'bank_size': args.bank_size,
+        'set_selection': args.set_selection,
+        'backend': args.backend,
+        'workers': args.workers,
+        'sequential': args.sequential,
+        'max_sets': args.max_sets,
+        'confidence': args.confidence,
+        'prescreen': args.prescreen,
+        'surrogate': args.surrogate,
+        'objective': args.objective,
+        'reuse_evaluations': args.reuse_evaluations,
+        'history': args.history,
+        'history_ranges': args.history_ranges,
+        'warm_start': args.warm_start,
+        'budget': args.budget,
+    }
+
+
 async def main():
     parser = argparse.ArgumentParser(description='Optimize parameters in a JS script.')
+    parser.add_argument('--spec', help='Run spec file (JSON, TOML or YAML) describing the whole run, see run_spec.py. Runs without any prompt, the other run options are ignored.')
     parser.add_argument('--script', help='Path to the JavaScript file.')
     parser.add_argument('--params', help='Parameters to optimize.')
     parser.add_argument('--games', type=int, default=1000, help='Number of games to simulate. Defaults to 1000.')
     parser.add_argument('--balance', type=float, default=10000, help='Initial balance in bits. Defaults to 10000 bits.')
+    parser.add_argument('--backend', choices=['inprocess', 'process', 'cluster'], help='Where simulations run. Defaults to process when --workers is set, inprocess otherwise.')
+    parser.add_argument('--listen', default='127.0.0.1:7345', help='Address the cluster coordinator listens on, host:port or a Unix socket path. Defaults to 127.0.0.1:7345.')
+    parser.add_argument('--cluster-key', help='Shared secret of the cluster. Defaults to $HYPEROPT_CLUSTER_KEY.')
+    parser.add_argument('--workers', type=int, default=0, help='Number of simulation workers, with --backend cluster the number of workers to wait for. Defaults to 0 (simulate in-process).')
+    parser.add_argument('--worker-max-evals', type=int, default=500, help='Recycle a worker after this many evaluations. Defaults to 500.')
+    parser.add_argument('--worker-max-rss', type=float, default=1024, help='Recycle a worker once its memory exceeds this many MB. Defaults to 1024.')
+    parser.add_argument('--trace-memory', action='store_true', help='Trace Python allocations and print the top allocation sites at the end.')
+    parser.add_argument('--profile', action='store_true', help='Time the simulation hot paths and print a per-phase breakdown at the end.')
+    parser.add_argument('--metrics-port', type=int, help='Serve live metrics over HTTP on this local port (/metrics and /json).')
+    parser.add_argument('--metrics-file', help='Periodically rewrite live metrics to this Prometheus text file.')
+    parser.add_argument('--metrics-interval', type=float, default=15, help='Seconds between metrics file rewrites. Defaults to 15.')
+    parser.add_argument('--sets', type=int, default=3, help='Number of game sets every candidate is simulated on. Defaults to 3.')
+    parser.add_argument('--seed', type=int, help='Seed of the game sets, reuse it to evaluate a resumed optimization on the same games.')
+    parser.add_argument('--bank-size', type=int, help='Generate this many game sets and select --sets of them. Defaults to --sets.')
+    parser.add_argument('--set-selection', choices=['random', 'stratified', 'antithetic'], default='random', help='How sets are selected from the bank. Defaults to random.')
+    parser.add_argument('--history', help='Simulate real games of this game store (see history_store.py) instead of generated sets.')
+    parser.add_argument('--history-ranges', help='Game id ranges of the history simulated as sets, e.g. "1000-2000,2000-3000", ends excluded.')
+    parser.add_argument('--sequential', action='store_true', help='Add game sets to a candidate one at a time until it clearly beats or loses to the best candidate so far.')
+    parser.add_argument('--max-sets', type=int, help='Most sets a candidate is simulated on in sequential mode. Defaults to the whole bank.')
+    parser.add_argument('--confidence', type=float, default=0.95, help='Confidence level of sequential evaluation. Defaults to 0.95.')
+    parser.add_argument('--prescreen', action='store_true', help='Skip simulating candidates whose analytical estimate is clearly worse than the best so far, for scripts declaring an @hyperopt structure.')
+    parser.add_argument('--surrogate', action='store_true', help='Skip simulating candidates a model trained on past evaluations predicts to be worse than needed.')
+    parser.add_argument('--objective', help='Objective used as fitness instead of the default metric, see objectives.py.')
+    parser.add_argument('--reuse-evaluations', metavar='OPTIMIZATION_ID', help='Reuse the stored statistics of an optimization run on the same script, balance and --seed instead of simulating those candidates again.')
+    parser.add_argument('--warm-start', type=int, metavar='K', help='Start a new optimization from the K best stored evaluations of the same script, or of the same parameters, remapped into the new space.')
+    parser.add_argument('--budget', help='Run until a wall time or a number of simulated games is used, e.g. "2h", "90m", "50M games" or "2h,50M games". The swarm size and fidelity adapt to fit it.')
+    parser.add_argument('--optimizer', choices=list(OPTIMIZERS.keys()), default='pso', help='Optimization algorithm to use. Defaults to pso.')
     args = parser.parse_args()
-    num_games = args.games
-    initial_balance = int(args.balance * 100)
-    required_median = 1.98
-    num_sets = 3
+    interactive = not args.spec
+    if args.spec:
+        spec = load_run_spec(args.spec)
+    elif args.script and args.params:
+        spec = normalize_spec(spec_from_args(args))
+    else:
+        spec = None
+
+    exporters = []
+    if args.metrics_port:
+        exporters.append(HttpExporter(telemetry, args.metrics_port))
+    if args.metrics_file:
+        exporters.append(PrometheusFileExporter(telemetry, args.metrics_file, args.metrics_interval))
+    for exporter in exporters:
+        exporter.start()
+    if args.profile:
+        profiler.enable()
+    if args.trace_memory:
+        import tracemalloc
+        tracemalloc.start()
 
     storage = Storage('optimizations.db')
 
-    if args.script and args.params:
-        js_file_path = args.script
-        script_obj = Script(js_file_path)
-        num_games = args.games or 1000
-        params_list = args.params.split(";")
-        parameters = []
-        for param in params_list:
-            param_details = param.split(":")
-            param_name = param_details[0]
-            value_ranges = param_details[1].split(",")
-            param_type = value_ranges[0]
-            if param_type == "checkbox":
-                param_values = [True if value == "True" else False for value in value_ranges[1:]]
-                parameters.append((param_name, param_values, param_type))
-            elif param_type == "radio":
-                param_values = value_ranges[1:]
-                parameters.append((param_name, param_values, param_type))
-            else:
-                min_value = float(value_ranges[1])
-                max_value = float(value_ranges[2])
-                parameters.append((param_name, (min_value, max_value), param_type))
+    if spec is not None:
+        script_obj = Script(spec['script'])
     else:
         js_file_path = input("Enter the path to the JavaScript file: ")
         script_obj = Script(js_file_path)
@@ -184,15 +235,30 @@ async def main():
         num_games = int(num_games) if num_games else 1000
 
         initial_balance = input("Enter the initial balance in bits [default: 10000]: ")
-        initial_balance = int(float(initial_balance) * 100) if initial_balance else 1000000
+        balance = float(initial_balance) if initial_balance else 10000
 
+        spec = normalize_spec(dict(spec_from_args(args), script=script_obj.js_file_path, params=None, parameters=parameters, games=num_games, balance=balance))
+
+    parameters = spec['parameters']
+    num_games = spec['games']
+    initial_balance = int(spec['balance'] * 100)
+
+    backend_name = spec['backend'] or ('process' if spec['workers'] > 0 else 'inprocess')
+    if backend_name == 'process':
+        backend = create_backend(backend_name, max(1, spec['workers']), max_evaluations=args.worker_max_evals, max_rss_mb=args.worker_max_rss)
+    elif backend_name == 'cluster':
+        backend = create_backend(backend_name, max(1, spec['workers']), address=args.listen, authkey=args.cluster_key)
+        print(f"Waiting for {backend.num_workers} workers to connect with: python cluster.py --connect {args.listen}")
+        backend.wait_for_workers()
+    else:
+        backend = create_backend(backend_name, max(1, spec['workers']))
 
     # Create the log file
     logging.basicConfig(filename=f"logs/{hashlib.md5(script_obj.js_file_path.encode()).hexdigest()}.log", level=logging.INFO)
 
-
     # Check if there's an existing optimization to resume
-    existing_optimizations = storage.get_all_optimizations()
+    optimization_id = spec['optimization_id']
+    existing_optimizations = storage.get_all_optimizations() if interactive else None
     if existing_optimizations:
         print("Existing optimizations found:")
         for idx, opt in enumerate(existing_optimizations):
@@ -201,28 +267,18 @@ async def main():
         choice = input("Enter the number of the optimization to resume, or 'n' for a new optimization: ")
         if choice.lower() != 'n':
             optimization_id = existing_optimizations[int(choice) - 1]['id']
-            optimizer = Optimizer(script_obj, initial_balance, GameResults(required_median, num_sets, num_games), [param[0] for param in parameters], {param[0]: {'range': param[1], 'type': param[2]} for param in parameters}, optimization_id=optimization_id)
-        else:
-            # Generate the game result sets for the simulator
-            game_results = GameResults(required_median, num_sets, num_games)
-
-            # Build the parameter space for the optimizer
-            parameter_names = [param[0] for param in parameters]
-            space = {param[0]: {'range': param[1], 'type': param[2]} for param in parameters}
-            # Create the optimizer and run the optimization
-            optimizer = Optimizer(script_obj, initial_balance, GameResults(required_median, num_sets, num_games), [param[0] for param in parameters], {param[0]: {'range': param[1], 'type': param[2]} for param in parameters})
-    else:
-        # Generate the game result sets for the simulator
-        game_results = GameResults(required_median, num_sets, num_games)
 
-        # Build the parameter space for the optimizer
-        parameter_names = [param[0] for param in parameters]
-        space = {param[0]: {'range': param[1], 'type': param[2]} for param in parameters}
-        optimizer = Optimizer(script_obj, initial_balance, GameResults(required_median, num_sets, num_games), [param[0] for param in parameters], {param[0]: {'range': param[1], 'type': param[2]} for param in parameters})
+    # Generate the game result sets for the simulator and create the optimizer
+    game_results = create_game_results(spec)
+    parameter_names, space = build_space(parameters)
+    Optimizer = load_optimizer(spec['optimizer'])
+    optimizer = Optimizer(script_obj, initial_balance, game_results, parameter_names, space, optimization_id=optimization_id, backend=backend)
+    configure_service(optimizer, spec, storage)
 
     # Start the optimization
-    input("\nThe optimization is ready to start. Press enter to begin...")
-    logging.info(f"Starting optimization with {initial_balance / 100} bits for {num_sets} sets of {num_games} games each.")
+    if interactive:
+        input("\nThe optimization is ready to start. Press enter to begin...")
+    logging.info(f"Starting optimization with {initial_balance / 100} bits for {game_results.num_sets} sets of {game_results.num_games} games each.")
     optimization_results = await optimizer.optimize()
 
     # Save the final results
@@ -238,20 +294,33 @@ async def main():
     logging.info(f"Best Parameters: {optimization_results['best_parameters']}")
     logging.info(f"Best Metric: {optimization_results['best_metric']}")
     logging.info("\nTop 5 Optimization Results:")
-    for rank, result in optimization_results['top_5_results']:
+    for rank, result in optimization_results.get('top_5_results', []):
         logging.info(f"Rank {rank + 1}")
         logging.info(f"  Parameters: {result['parameters']}")
         logging.info(f"  Metric: {result['metric']}")
 
+    budget = getattr(getattr(optimizer, 'service', None), 'budget', None)
+    if budget is not None:
+        print(budget.format_report(optimizer.service))
+
     # Close the storage connection
     storage.close()
 
-    snapshot = tracemalloc.take_snapshot()
-    top_stats = snapshot.statistics('lineno')
-    print("\nn[ Top 10 ]")
-    for stat in top_stats[:10]:
-        print(stat)
+    if hasattr(backend, 'get_stats'):
+        for worker_stats in backend.get_stats():
+            logging.info(f"Worker {worker_stats['worker_id']}: {worker_stats['total_evaluations']} evaluations, {worker_stats['recycles']} recycles, {worker_stats['rss_mb']:.1f} MB")
+    backend.close()
+
+    for exporter in exporters:
+        exporter.stop()
+
+    if args.trace_memory:
+        snapshot = tracemalloc.take_snapshot()
+        top_stats = snapshot.statistics('lineno')
+        print("\nn[ Top 10 ]")
+        for stat in top_stats[:10]:
+            print(stat)
 
-    tracemalloc.stop()
+        tracemalloc.stop()
 if __name__ == "__main__":
     asyncio.run(main())
@@ -1,12 +1,27 @@
+import argparse
 import asyncio
+import csv
 from datetime import datetime
+import json
+import logging
+import multiprocessing
 import os
+import re
+import shutil
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
 from prettytable import PrettyTable
 
+from metrics import STATISTICS_KEYS
 from script import Script
 from simulator import GameResults, Simulator
 
+HASH_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+TRACE_COLUMNS = ('bust', 'wager', 'cashed_at', 'balance')
+
+_simulator = None  # The simulator of a replay worker process
+
 
 def get_input(prompt):
     return input(prompt).strip()
@@ -33,45 +48,160 @@ def print_results(results):
     for key, value in results.items():
         table.add_row([key, value])
     print(table)
-    
-def main():
+
+
+def read_hashes(path):
+    """Reads one game hash per line, blank lines and lines starting with # are skipped"""
+    hashes = []
+    with open(path, 'r', encoding='utf-8') as file:
+        for line_number, line in enumerate(file, 1):
+            hash_value = line.strip().lower()
+            if not hash_value or hash_value.startswith('#'):
+                continue
+            if not HASH_PATTERN.match(hash_value):
+                raise ValueError(f"{path}:{line_number} is not a game hash: {hash_value}")
+            hashes.append(hash_value)
+    return hashes
+
+
+async def replay(simulator, initial_balance, hash_value, num_games, script_params, trace=None):
+    """Plays the chain of num_games games ending with the game of hash_value, returns its Statistics"""
+    game_set = GameResults.generate_games(hash_value, num_games)
+    simulator.shouldStop = False
+    statistics, _ = await simulator.run_single_simulation(initial_balance, game_set, script_params, trace)
+    return statistics
+
+
+def _init_worker(script):
+    global _simulator
+    _simulator = Simulator(script)
+
+
+def _replay_batch(hashes, initial_balance, num_games, script_params, with_trace):
+    """Replays a batch of hashes in a worker process, returns (hash, statistics, metric, error, trace) of each"""
+    results = []
+    for hash_value in hashes:
+        trace = [] if with_trace else None
+        try:
+            statistics = asyncio.run(replay(_simulator, initial_balance, hash_value, num_games, script_params, trace))
+            results.append((hash_value, statistics.get_statistics(), statistics.get_metric(), '', trace))
+        except Exception as e:
+            results.append((hash_value, None, float('nan'), str(e), trace))
+    return results
+
+
+def replay_hashes(script, hashes, initial_balance, num_games, script_params=None, workers=None, batch_size=8, with_trace=False):
+    """Replays the chain ending with every hash in parallel worker processes
+
+    :param batch_size: Hashes replayed per task, larger batches cost less overhead, smaller ones balance better
+    :return: A list of (hash, statistics dictionary or None, metric, error message, trace or None), in the order of hashes
+    """
+    batches = [hashes[start:start + batch_size] for start in range(0, len(hashes), batch_size)]
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'), initializer=_init_worker, initargs=(script,)) as executor:
+        futures = [executor.submit(_replay_batch, batch, initial_balance, num_games, script_params or {}, with_trace) for batch in batches]
+        for done, future in enumerate(futures, 1):
+            results.extend(future.result())
+            logging.info(f"Replayed {min(done * batch_size, len(hashes))}/{len(hashes)} hashes")
+    return results
+
+
+def save_columns(path, results):
+    """Writes replay results to one compressed .npz file, a column per statistic
+
+    Columns: hash, error ('' when the replay ran), failed (the balance ran out), metric and every key
+    of STATISTICS_KEYS, in cents like Statistics. With traces also trace_row (the index of the hash),
+    trace_game (the position of the game in its chain) and trace_bust, trace_wager, trace_cashed_at and
+    trace_balance, NaN where no bet was placed or won.
+    """
+    columns = {
+        'hash': np.array([result[0] for result in results], dtype='U64'),
+        'error': np.array([result[3] for result in results], dtype=str),
+        'failed': np.array([result[1] is None or result[1]['balance'] == 0 for result in results]),
+        'metric': np.array([result[2] for result in results], dtype=np.float64),
+    }
+    for key in STATISTICS_KEYS:
+        columns[key] = np.array([result[1][key] if result[1] is not None else np.nan for result in results], dtype=np.float64)
+
+    traces = [result[4] for result in results]
+    if any(trace is not None for trace in traces):
+        traces = [trace or [] for trace in traces]
+        columns['trace_row'] = np.repeat(np.arange(len(traces), dtype=np.int32), [len(trace) for trace in traces])
+        columns['trace_game'] = np.concatenate([np.arange(len(trace), dtype=np.int32) for trace in traces])
+        rows = np.array([row for trace in traces for row in trace], dtype=np.float64).reshape(-1, len(TRACE_COLUMNS))
+        for index, name in enumerate(TRACE_COLUMNS):
+            columns[f'trace_{name}'] = rows[:, index]
+    np.savez_compressed(path, **columns)
+
+
+def run_batch(args):
+    script = Script(args.script)
+    hashes = read_hashes(args.hashes)
+    script_params = json.loads(args.params) if args.params else {}
+    results = replay_hashes(script, hashes, int(args.balance * 100), args.games, script_params, args.workers, args.batch_size, args.trace)
+    save_columns(args.output, results)
+    failed = sum(result[1] is None or result[1]['balance'] == 0 for result in results)
+    print(f"Replayed {len(results)} hashes, {failed} failed, results saved in {args.output}")
+
+
+def run_interactive():
     script_path = get_input("Enter the path to the script: ")
     hash_value = get_input("Enter the hash value: ")
     num_games = get_int_input("Enter the number of games to generate: ")
-    initial_balance = get_float_input("Enter the initial balance: ")
+    initial_balance = get_float_input("Enter the initial balance (bits): ")
 
     script = Script(script_path)
     simulator = Simulator(script)
-    game_results = GameResults(1.98, 1, num_games)
 
     # Create folder with script file name and datetime
     script_name = os.path.basename(script_path)
-    folder_name = f"{script_name}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    folder_name = f"{script_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
     os.makedirs(folder_name)
 
     # Save simulation results to a file
+    trace = []
     results_file_path = os.path.join(folder_name, "results.txt")
     with open(results_file_path, "w") as results_file:
-        loop = asyncio.get_event_loop()
-        simulation_task = loop.create_task(simulator.run(initial_balance, game_results, {}))
-
         try:
-            loop.run_until_complete(simulation_task)
-            results = simulation_task.result()
-            results_file.write(str(results["results"]))
+            statistics = asyncio.run(replay(simulator, int(initial_balance * 100), hash_value, num_games, {}, trace))
+            results_file.write(json.dumps(statistics.get_statistics(), indent=2))
+            print_results(statistics.get_statistics())
         except Exception as e:
             results_file.write(f"Error occurred: {str(e)}")
 
     # Copy script to the folder
-    script_copy_path = os.path.join(folder_name, script_name)
-    os.system(f"cp {script_path} {script_copy_path}")
+    shutil.copy(script_path, os.path.join(folder_name, script_name))
+
+    # Save every game played to a file
+    trace_file_path = os.path.join(folder_name, "games.csv")
+    with open(trace_file_path, "w", newline='') as trace_file:
+        writer = csv.writer(trace_file)
+        writer.writerow(TRACE_COLUMNS)
+        writer.writerows(trace)
 
-    # Save script log output to a file
-    log_file_path = os.path.join(folder_name, "log.txt")
-    with open(log_file_path, "w") as log_file:
-        log_file.write("\n".join(results["output"]))
+    print(f"Simulation results, script copy, and played games saved in folder: {folder_name}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a script on the game chains ending with given hashes. Without --hashes, asks for a single hash interactively.')
+    parser.add_argument('--script', help='Path to the JavaScript file.')
+    parser.add_argument('--hashes', help='File with one game hash per line, each replayed with the games before it.')
+    parser.add_argument('--games', type=int, default=1000, help='Games replayed per hash, the last one being the hash. Defaults to 1000.')
+    parser.add_argument('--balance', type=float, default=10000, help='Initial balance in bits. Defaults to 10000 bits.')
+    parser.add_argument('--params', help='Script parameters as JSON, e.g. \'{"payout": 2.5}\'.')
+    parser.add_argument('--workers', type=int, help='Number of worker processes. Defaults to the number of CPUs.')
+    parser.add_argument('--batch-size', type=int, default=8, help='Hashes replayed per task. Defaults to 8.')
+    parser.add_argument('--trace', action='store_true', help='Also save every game of every replay.')
+    parser.add_argument('--output', default='replays.npz', help='Columnar output file (NumPy .npz). Defaults to replays.npz.')
+    args = parser.parse_args()
 
-    print(f"Simulation results, script copy, and log output saved in folder: {folder_name}")
+    if args.hashes:
+        if not args.script:
+            parser.error('--hashes needs --script')
+        logging.basicConfig(level=logging.INFO)
+        run_batch(args)
+    else:
+        run_interactive()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,4 +1,5 @@
 import math
+from profiling import profiler
 
 class Statistics:
     def __init__(self, initial_balance):
@@ -31,14 +32,27 @@ class Statistics:
         self.total_lost = 0
 
     def update(self, engine):
+        with profiler.phase('statistics_update'):
+            self._update(engine)
+
+    def _update(self, engine):
         lastGame = engine.history.first()
-        self.games_total += 1
-        self.duration += math.log(lastGame['bust']) / 0.00006  # Assuming targetPayout is available in engine
         if lastGame['wager'] is not None:
-            self.games_played += 1
             # update userinfo stats
             engine._userInfo.wagers += 1
             engine._userInfo.wagered += lastGame['wager']
+            if lastGame['cashedAt'] is not None:
+                engine._userInfo.profit += (lastGame['wager'] * (lastGame['cashedAt'] - 1))
+            else:
+                engine._userInfo.profit -= lastGame['wager']
+        self.record(lastGame)
+
+    def record(self, lastGame):
+        """Adds a played or skipped game to the statistics without touching the engine, for windows of a longer run"""
+        self.games_total += 1
+        self.duration += math.log(lastGame['bust']) / 0.00006  # Assuming targetPayout is available in engine
+        if lastGame['wager'] is not None:
+            self.games_played += 1
             # update stats
             self.total_wagered += lastGame['wager']
             if lastGame['wager'] < self.lowest_bet:
@@ -47,8 +61,6 @@ class Statistics:
                 self.highest_bet = lastGame['wager']
 
             if lastGame['cashedAt'] is not None:
-                # update userinfo stats
-                engine._userInfo.profit += (lastGame['wager'] * (lastGame['cashedAt'] - 1))
                 # update stats
                 self.games_won += 1
                 winnings = lastGame['wager'] * lastGame['cashedAt']
@@ -61,8 +73,6 @@ class Statistics:
                     self.longest_win_streak = self.since_last_lose
                     self.longest_streak_gain = self.streak_gain
             else:
-                # update userinfo stats
-                engine._userInfo.profit -= lastGame['wager']
                 # update stats
                 self.games_lost += 1
                 self.total_lost += lastGame['wager']
@@ -86,7 +96,8 @@ class Statistics:
                 self.profit_atl = self.profit
         
             # print(self.duration, self.profit)
-            self.profit_per_hour = self.profit / (self.duration / 3600)
+            # A bust of 1.00 lasts no time, a run or window can start with one
+            self.profit_per_hour = self.profit / (self.duration / 3600) if self.duration else 0
         
         else:
             self.games_skipped += 1
@@ -144,4 +155,28 @@ class Statistics:
 
         
     def __str__(self):
-        return str(self.get_statistics())
\ No newline at end of file
+        return str(self.get_statistics())
+
+# Order of the values when statistics are stored as arrays
+STATISTICS_KEYS = tuple(Statistics(0).get_statistics())
+
+
+def mean_and_standard_error(values):
+    """Returns the mean of the finite values and its standard error, infinite with fewer than two values"""
+    values = [value for value in values if math.isfinite(value)]
+    if not values:
+        return float('inf'), float('inf')
+    mean = sum(values) / len(values)
+    if len(values) < 2:
+        return mean, float('inf')
+    variance = sum((value - mean) ** 2 for value in values) / (len(values) - 1)
+    return mean, math.sqrt(variance / len(values))
+
+
+def paired_difference(metrics_a, metrics_b):
+    """Compares two candidates simulated on the same sets, returns the mean difference a - b and its standard error
+
+    Pairing the sets removes the luck the candidates share, so the standard error of the difference
+    is usually far smaller than the standard errors of the candidates combined.
+    """
+    return mean_and_standard_error([a - b for a, b in zip(metrics_a, metrics_b) if math.isfinite(a) and math.isfinite(b)])
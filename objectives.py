@@ -0,0 +1,162 @@
+import argparse
+import math
+
+from storage import Storage
+
+OBJECTIVES = {}
+
+
+class Objective:
+    def __init__(self, name, func, maximize):
+        """A value computed from the statistics of an evaluation
+
+        :param name: The name the objective is registered under
+        :param func: Called with the averaged statistics and the statistics of every set
+        :param maximize: Whether higher values rank first
+        """
+        self.name = name
+        self.func = func
+        self.maximize = maximize
+
+    def __call__(self, statistics, set_statistics=()):
+        try:
+            value = self.func(statistics, set_statistics)
+        except (KeyError, ZeroDivisionError, ValueError):
+            return float('nan')
+        return float(value)
+
+    def better(self, a, b):
+        return a > b if self.maximize else a < b
+
+    def oriented(self, value, minimize=True):
+        """The value as the fitness of an optimizer, lower is better when minimize, undefined values are infinite like failures"""
+        if not math.isfinite(value):
+            return float('inf')
+        return -value if self.maximize == minimize else value
+
+
+def objective(name, maximize=True):
+    """Registers an objective, e.g. @objective('profit') on def profit(statistics, set_statistics)"""
+    def register(func):
+        OBJECTIVES[name] = Objective(name, func, maximize)
+        return func
+    return register
+
+
+def get_objective(name):
+    if name not in OBJECTIVES:
+        raise ValueError(f"Unknown objective: {name}, available: {', '.join(OBJECTIVES)}")
+    return OBJECTIVES[name]
+
+
+@objective('metric')
+def metric(statistics, set_statistics):
+    """Same value as Statistics.get_metric"""
+    if statistics['total_wagered'] == 0 or statistics['games_played'] == 0:
+        return float('inf')
+    return statistics['profit'] / math.sqrt(statistics['total_wagered'] * statistics['games_played'])
+
+
+@objective('profit')
+def profit(statistics, set_statistics):
+    return statistics['profit']
+
+
+@objective('profit_per_hour')
+def profit_per_hour(statistics, set_statistics):
+    return statistics['profit_per_hour']
+
+
+@objective('drawdown', maximize=False)
+def drawdown(statistics, set_statistics):
+    """How far the balance fell below the starting balance"""
+    return max(0, -statistics['profit_atl'])
+
+
+@objective('longest_streak_cost', maximize=False)
+def longest_streak_cost(statistics, set_statistics):
+    return statistics['longest_streak_cost']
+
+
+@objective('worst_set_profit')
+def worst_set_profit(statistics, set_statistics):
+    """The profit of the unluckiest set, sets that went bust count as losing the whole balance"""
+    if not set_statistics:
+        return statistics['profit']
+    return min(-statistics['starting_balance'] if set_stats['balance'] == 0 else set_stats['profit'] for set_stats in set_statistics)
+
+
+def score(evaluations, objective):
+    """Returns (value, evaluation) for every stored evaluation with statistics, skipping undefined and infinite values"""
+    scored = []
+    for evaluation in evaluations:
+        if evaluation.get('statistics') is None:
+            continue
+        value = objective(evaluation['statistics']['mean'], evaluation['statistics']['sets'])
+        if math.isfinite(value):
+            scored.append((value, evaluation))
+    return scored
+
+
+def unique(evaluations):
+    """Drops repeated evaluations of the same parameters, keeping the first"""
+    seen = set()
+    unique_evaluations = []
+    for evaluation in evaluations:
+        key = tuple(sorted(evaluation['parameters'].items()))
+        if key not in seen:
+            seen.add(key)
+            unique_evaluations.append(evaluation)
+    return unique_evaluations
+
+
+def rank(evaluations, objective, top=None):
+    """Ranks stored evaluations by an objective, best first"""
+    scored = score(unique(evaluations), objective)
+    scored.sort(key=lambda result: objective.oriented(result[0]))
+    return scored[:top] if top else scored
+
+
+def dominates(a, b, objectives):
+    at_least_as_good = all(not objective.better(y, x) for objective, x, y in zip(objectives, a, b))
+    return at_least_as_good and any(objective.better(x, y) for objective, x, y in zip(objectives, a, b))
+
+
+def pareto_front(evaluations, objectives):
+    """Returns (values, evaluation) of every stored evaluation no other one beats on all objectives"""
+    points = []
+    for evaluation in unique(evaluations):
+        if evaluation.get('statistics') is None:
+            continue
+        values = [objective(evaluation['statistics']['mean'], evaluation['statistics']['sets']) for objective in objectives]
+        if all(math.isfinite(value) for value in values):
+            points.append((values, evaluation))
+    return [(values, evaluation) for values, evaluation in points if not any(dominates(other, values, objectives) for other, _ in points)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rank stored evaluations by any objective without simulating again.')
+    parser.add_argument('optimization_id', help='The optimization whose evaluations are ranked.')
+    parser.add_argument('--objective', default='metric', help=f"Objective to rank by, or a comma separated list for a Pareto front. One of: {', '.join(OBJECTIVES)}.")
+    parser.add_argument('--top', type=int, default=10, help='Number of evaluations to show. Defaults to 10.')
+    parser.add_argument('--db', default='optimizations.db', help='The optimizations database. Defaults to optimizations.db.')
+    args = parser.parse_args()
+
+    storage = Storage(args.db)
+    evaluations = storage.load_evaluations(args.optimization_id)
+    storage.close()
+
+    objectives = [get_objective(name.strip()) for name in args.objective.split(',')]
+    if len(objectives) == 1:
+        for position, (value, evaluation) in enumerate(rank(evaluations, objectives[0], args.top)):
+            print(f"{position + 1}. {objectives[0].name}: {value}  {evaluation['parameters']}")
+    else:
+        front = pareto_front(evaluations, objectives)
+        front.sort(key=lambda point: point[0][0], reverse=objectives[0].maximize)
+        print(f"Pareto front of {len(front)} evaluations:")
+        for values, evaluation in front[:args.top]:
+            print(", ".join(f"{objective.name}: {value}" for objective, value in zip(objectives, values)) + f"  {evaluation['parameters']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,18 @@
 import heapq
 import numpy as np
-import asyncio
-from math import exp, log
-from simulator import Simulator
-from prettytable import PrettyTable
+from math import exp, isfinite, log
+from evaluation import EvaluationService, run_ask_tell
 import logging
-from memory_profiler import profile
+from telemetry import telemetry
 
 
 class Optimizer:
-    def __init__(self, script_obj, initial_balance, game_results, parameter_names, space):
+    def __init__(self, script_obj, initial_balance, game_results, parameter_names, space, backend=None, fitness_cache=None):
         self.script_obj = script_obj
         self.initial_balance = initial_balance
         self.game_results = game_results
         self.parameter_names = parameter_names
         self.space = space
-        self.evaluated_params = {}  
         
         self.population_size = 10  # Increased for more diversity
         self.num_generations = 30  # Increased to allow more refinement over time
@@ -26,7 +23,13 @@ class Optimizer:
         self.max_crossover_rate = 0.9  # Kept the same to encourage recombination
         self.min_crossover_rate = 0.1  # Increased floor to ensure enough recombination
         
-        self.simulator = Simulator(self.script_obj)  
+        # Individuals that survive unchanged are looked up in the service's cache instead of simulated again
+        self.service = EvaluationService(self.script_obj, self.initial_balance, self.game_results, backend=backend, cache=fitness_cache if fitness_cache is not None else True, space=self.space, minimize=False)
+        self.population = None
+        self.generation = 0
+        self.results_dict = {}
+        self.top_5_results = []
+        self.unique_individuals = set()  # To store unique individuals
 
 
     def sample_from_space(self, param_name):
@@ -34,13 +37,17 @@ class Optimizer:
         param_type = param_details.get('type')
         param_range = param_details.get('range')
 
-        if param_type == 'continuous':
+        if param_type == 'continuous' or (param_type == 'number' and not param_details.get('is_integer')):
             return np.random.uniform(param_range[0], param_range[1])
-        elif param_type == 'integer':
-            return np.random.randint(param_range[0], param_range[1] + 1)
-        elif param_type == 'categorical':
-            return np.random.choice(param_range)
-        elif param_type == 'payout':
+        elif param_type in ('integer', 'number'):
+            return np.random.randint(int(param_range[0]), int(param_range[1]) + 1)
+        elif param_type == 'balance':
+            # Same rounding as PSOptimizer.enforce_constraint
+            value = round(np.random.randint(int(param_range[0]), int(param_range[1]) + 1) / 100) * 100
+            return max(min(value, param_range[1]), param_range[0])
+        elif param_type in ('categorical', 'radio', 'checkbox'):
+            return param_range[np.random.randint(len(param_range))]
+        elif param_type in ('payout', 'multiplier'):
             u = np.random.random()
             min_val, max_val = param_range
             normalization = 0.99 * log(max_val) - 0.99 * log(min_val)
@@ -53,6 +60,15 @@ class Optimizer:
         ])
         return population
 
+    def warm_start(self, individuals):
+        """Replaces the first individuals of the initial population with known good ones, e.g. from warm_start.find_warm_start"""
+        if self.generation > 0:
+            return
+        if self.population is None:
+            self.population = self.initialize_population()
+        for index, individual in enumerate(individuals[:len(self.population)]):
+            self.population[index] = dict(individual)
+
     def select_parents_tournament(self, population, fitness):
         selected_parents = []
         for _ in range(len(population) - self.elite_size):
@@ -86,99 +102,85 @@ class Optimizer:
     def round_parameters(self, individual):
         """Round the real and payout parameters to three decimal places."""
         for param, details in self.space.items():
-            if details['type'] in ['continuous', 'payout']:
+            if details['type'] in ['continuous', 'payout', 'multiplier']:
                 individual[param] = round(individual[param], 2)
         return individual
 
-    async def evaluate_population(self, population):
-        tasks = []
-        fitness = np.zeros(len(population))
-
-        for i, individual in enumerate(population):
-            individual = self.round_parameters(individual)
-            params_tuple = tuple(individual.items())
-
-            if params_tuple in self.evaluated_params:
-                fitness[i] = -self.evaluated_params[params_tuple]  # Negating the fitness value
-                logging.debug(f"Individual {i} already evaluated. Fitness: {fitness[i]}")
-            else:
-                tasks.append((i, self.simulator.run(self.initial_balance, self.game_results, individual)))
-                logging.debug(f"Individual {i} not evaluated. Adding to tasks.")
-
-        results = await asyncio.gather(*(task for _, task in tasks), return_exceptions=True)
-
-        for (i, _), result in zip(tasks, results):
-            if isinstance(result, Exception):
-                logging.error(f"Error evaluating individual {i}: {result}")
-                fitness[i] = float('inf')  # Setting the fitness to infinity
-            else:
-                fit = result['results'].get_metric()
-                fitness[i] = -fit  # Negating the fitness value
-                self.evaluated_params[tuple(population[i].items())] = fit
-
-        return fitness
+    def ask(self):
+        """Returns the individuals of the current generation, rounded the way they are evaluated"""
+        if self.population is None:
+            self.population = self.initialize_population()
+        for individual in self.population:
+            self.round_parameters(individual)
+        return list(self.population)
+
+    def tell(self, candidates, fitnesses):
+        """Breeds the next generation from the metrics of the individuals returned by ask()"""
+        population = self.population
+        # Negate so higher metrics sort first, failed or betless runs are the worst possible
+        fitness = np.array([-fit if isfinite(fit) else float('inf') for fit in fitnesses])
+
+        mutation_rate = self.max_mutation_rate - (self.generation / self.num_generations) * (self.max_mutation_rate - self.min_mutation_rate)
+        crossover_rate = self.min_crossover_rate + (self.generation / self.num_generations) * (self.max_crossover_rate - self.min_crossover_rate)
+
+        # Debugging to ensure that the best fitness is improving over generations
+        logging.debug(f"Generation {self.generation}: Best Fitness: {-min(fitness)}")
+        telemetry.set_gbest(-min(fitness), population[np.argmin(fitness)])
+
+        # Update top 5 results
+        for individual, fit in zip(population, fitness):
+            if fit != float('inf'):  # Check if the fitness is not infinity
+                individual_tuple = tuple(individual.items())
+
+                if individual_tuple not in self.unique_individuals:
+                    self.unique_individuals.add(individual_tuple)
+
+                    if len(self.top_5_results) < 5:
+                        heapq.heappush(self.top_5_results, (fit, individual))  # Storing the fitness value
+                    elif fit < self.top_5_results[0][0]:  # Getting the actual fitness value
+                        heapq.heappushpop(self.top_5_results, (fit, individual))
+
+                    # Store the individual's parameters in the dictionary using fitness as the key
+                    self.results_dict[fit] = individual
+
+        # Elite selection
+        elite_indices = np.argsort(fitness)[:self.elite_size]  # Sorting in ascending order
+        elite_individuals = population[elite_indices]
+
+        # Tournament selection for parents
+        parents = self.select_parents_tournament(population, fitness)
+
+        # Crossover and mutation to produce children
+        children = []
+        while len(children) < len(population) - self.elite_size:
+            parent1 = np.random.choice(parents)
+            parent2 = np.random.choice(parents)
+            child1, child2 = self.crossover(parent1, parent2, crossover_rate)
+            child1 = self.mutate(child1, mutation_rate)
+            child2 = self.mutate(child2, mutation_rate)
+            children.extend((child1, child2))
+
+        # Next generation becomes the elite and children
+        self.population = np.concatenate((elite_individuals, children[:len(population) - self.elite_size]), axis=0)
+        self.generation += 1
+
     async def run_optimization(self):
-        population = self.initialize_population()
-        results_dict = {}   
-        top_5_results = []  
-        unique_individuals = set()  # To store unique individuals
-        
-        for generation in range(self.num_generations):
-            mutation_rate = self.max_mutation_rate - (generation / self.num_generations) * (self.max_mutation_rate - self.min_mutation_rate)
-            crossover_rate = self.min_crossover_rate + (generation / self.num_generations) * (self.max_crossover_rate - self.min_crossover_rate)
-
-            fitness = await self.evaluate_population(population)
-
-            # Debugging to ensure that the best fitness is improving over generations
-            logging.debug(f"Generation {generation}: Best Fitness: {-min(fitness)}")
-
-            # Update top 5 results
-            for individual, fit in zip(population, fitness):
-                if fit != float('inf'):  # Check if the fitness is not infinity
-                    individual_tuple = tuple(individual.items())
-                    
-                    if individual_tuple not in unique_individuals:
-                        unique_individuals.add(individual_tuple)
-
-                        if len(top_5_results) < 5:
-                            heapq.heappush(top_5_results, (fit, individual))  # Storing the fitness value
-                        elif fit < top_5_results[0][0]:  # Getting the actual fitness value
-                            heapq.heappushpop(top_5_results, (fit, individual))
-
-                        # Store the individual's parameters in the dictionary using fitness as the key
-                        results_dict[fit] = individual
-
-            # Elite selection
-            elite_indices = np.argsort(fitness)[:self.elite_size]  # Sorting in ascending order
-            elite_individuals = population[elite_indices]
-
-            # Tournament selection for parents
-            parents = self.select_parents_tournament(population, fitness)
-
-            # Crossover and mutation to produce children
-            children = []
-            while len(children) < len(population) - self.elite_size:
-                parent1 = np.random.choice(parents)
-                parent2 = np.random.choice(parents)
-                child1, child2 = self.crossover(parent1, parent2, crossover_rate)
-                child1 = self.mutate(child1, mutation_rate)
-                child2 = self.mutate(child2, mutation_rate)
-                children.extend((child1, child2))
-
-            # Next generation becomes the elite and children
-            population = np.concatenate((elite_individuals, children[:len(population) - self.elite_size]), axis=0)
+        telemetry.start('Optimizer', None, (self.num_generations + 1) * self.population_size, self.service.num_workers)
+        await run_ask_tell(self, self.service, self.generation, self.num_generations)
 
         # Final evaluation to update the fitness values
-        fitness = await self.evaluate_population(population)
+        population = self.ask()
+        metrics = await self.service.evaluate_all(population)
+        fitness = np.array([-fit if isfinite(fit) else float('inf') for fit in metrics])
         best_individual_index = np.argmin(fitness)  # Getting the index of the individual with the lowest fitness value
         best_individual = population[best_individual_index]
 
         # Sort the top 5 results in ascending order
-        top_5_results = sorted(top_5_results, key=lambda x: x[0])
+        top_5_results = sorted(self.top_5_results, key=lambda x: x[0])
         top_5_parameters = [(rank, {'parameters': individual, 'metric': -fit}) for rank, (fit, individual) in enumerate(top_5_results)]
 
         return {
             "best_parameters": {param: best_individual[param] for param in self.parameter_names},
             "best_metric": -fitness[best_individual_index],  # Negating the fitness value
             "top_5_results": top_5_parameters
-        }
\ No newline at end of file
+        }
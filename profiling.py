@@ -0,0 +1,193 @@
+import functools
+import json
+import time
+from collections import defaultdict
+
+
+class _NullPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class _Phase:
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = self.profiler._enter(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.add_time(self.name, self.profiler._exit(self) - self.start)
+        return False
+
+
+class Profiler:
+    def __init__(self):
+        """Collects wall time and counters for the simulation hot paths
+
+        Disabled by default, in which case phase() hands back a shared no-op context manager
+        so the instrumented code only pays for an attribute check.
+
+        Phases nest and, with candidates and sets evaluated concurrently, overlap. Besides the
+        inclusive time of every phase, each moment is attributed to the innermost phase entered last
+        (its self time), and the time any phase is active is the profiled wall time. Self times
+        add up to the wall time, so they are shares of it that don't count anything twice.
+        """
+        self.enabled = False
+        self.timings = defaultdict(float)
+        self.self_timings = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.wall = 0.0
+        # Phases being timed, the last one entered gets the time until the next phase starts or ends
+        self._active = []
+        self._last = 0.0
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self.timings.clear()
+        self.self_timings.clear()
+        self.calls.clear()
+        self.counters.clear()
+        self.wall = 0.0
+        self._active.clear()
+
+    def _advance(self, now):
+        if self._active:
+            elapsed = now - self._last
+            self.self_timings[self._active[-1].name] += elapsed
+            self.wall += elapsed
+        self._last = now
+
+    def _enter(self, phase):
+        now = time.perf_counter()
+        self._advance(now)
+        self._active.append(phase)
+        return now
+
+    def _exit(self, phase):
+        now = time.perf_counter()
+        self._advance(now)
+        # Concurrent phases don't necessarily end in the reverse order they started
+        for index in range(len(self._active) - 1, -1, -1):
+            if self._active[index] is phase:
+                del self._active[index]
+                break
+        return now
+
+    def phase(self, name):
+        if not self.enabled:
+            return _NULL_PHASE
+        return _Phase(self, name)
+
+    def timed(self, name):
+        """Decorator that records every call of the wrapped function as the given phase"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with _Phase(self, name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def add_time(self, name, seconds):
+        self.timings[name] += seconds
+        self.calls[name] += 1
+
+    def count(self, name, amount=1):
+        if self.enabled:
+            self.counters[name] += amount
+
+    def snapshot(self):
+        return {
+            'timings': dict(self.timings),
+            'self_timings': dict(self.self_timings),
+            'calls': dict(self.calls),
+            'counters': dict(self.counters),
+            'wall': self.wall,
+        }
+
+    def merge(self, snapshot):
+        """Adds a snapshot taken in another process (e.g. a simulation worker) to this profiler"""
+        for name, seconds in snapshot['timings'].items():
+            self.timings[name] += seconds
+        for name, calls in snapshot['calls'].items():
+            self.calls[name] += calls
+        for name, seconds in snapshot.get('self_timings', {}).items():
+            self.self_timings[name] += seconds
+        for name, amount in snapshot['counters'].items():
+            self.counters[name] += amount
+        self.wall += snapshot.get('wall', 0.0)
+
+    @staticmethod
+    def diff(before, after):
+        diff = {
+            section: {name: value - before[section].get(name, 0) for name, value in after[section].items()}
+            for section in ('timings', 'self_timings', 'calls', 'counters')
+        }
+        diff['wall'] = after['wall'] - before['wall']
+        return diff
+
+
+def build_report(snapshot, iteration_snapshots=None):
+    """Summarizes a profiler snapshot per phase, per evaluation and per iteration
+
+    Percentages are of the profiled wall time (summed over worker processes) and computed from self
+    times, so concurrent evaluations and nested phases aren't counted more than once.
+    """
+    evaluations = snapshot['counters'].get('evaluations', 0)
+    self_timings = snapshot['self_timings']
+    total = snapshot['wall'] or sum(self_timings.values())
+    phases = {}
+    for name, seconds in sorted(snapshot['timings'].items(), key=lambda item: self_timings.get(item[0], 0.0), reverse=True):
+        self_seconds = self_timings.get(name, 0.0)
+        phases[name] = {
+            'seconds': seconds,
+            'self_seconds': self_seconds,
+            'calls': snapshot['calls'].get(name, 0),
+            'percent': 100 * self_seconds / total if total else 0.0,
+            'per_evaluation': seconds / evaluations if evaluations else None,
+        }
+    report = {'wall_seconds': total, 'phases': phases, 'counters': snapshot['counters']}
+    if iteration_snapshots:
+        report['iterations'] = [
+            {'iteration': iteration, 'timings': iteration_snapshot['timings'], 'counters': iteration_snapshot['counters']}
+            for iteration, iteration_snapshot in iteration_snapshots
+        ]
+    return report
+
+
+def format_report(report):
+    lines = [f"Profiled wall time: {report['wall_seconds']:.3f}s", f"{'Phase':<20} {'Seconds':>12} {'Self':>12} {'Calls':>10} {'% time':>8} {'ms/eval':>10}"]
+    for name, phase in report['phases'].items():
+        per_evaluation = f"{phase['per_evaluation'] * 1000:.3f}" if phase['per_evaluation'] is not None else '-'
+        lines.append(f"{name:<20} {phase['seconds']:>12.3f} {phase['self_seconds']:>12.3f} {phase['calls']:>10} {phase['percent']:>7.1f}% {per_evaluation:>10}")
+    for name, amount in sorted(report['counters'].items()):
+        lines.append(f"{name}: {amount}")
+    return "\n".join(lines)
+
+
+def save_report(report, file_path):
+    with open(file_path, 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=2)
+
+
+profiler = Profiler()
@@ -1,12 +1,16 @@
+import copy
 import logging
+import os
 import time
 
 import numpy as np
 import random
 from math import exp, log
 
-from simulator import Simulator
+from evaluation import EvaluationService, run_ask_tell
+from profiling import profiler, build_report, format_report, save_report
 from storage import Storage
+from telemetry import telemetry
 
 
 class Particle:
@@ -21,7 +25,7 @@ class Particle:
 
 
 class PSOptimizer:
-    def __init__(self, script_obj, initial_balance, game_results, parameter_names, space, optimization_id=None):
+    def __init__(self, script_obj, initial_balance, game_results, parameter_names, space, optimization_id=None, backend=None):
         self.script_obj = script_obj
         self.initial_balance = initial_balance
         self.game_results = game_results
@@ -35,10 +39,9 @@ class PSOptimizer:
         self.w = 0.9
         self.damping = 0.5
 
-        self.simulator = Simulator(self.script_obj)
-
         self.storage = Storage('optimizations.db')
         self.optimization_id = optimization_id or self.generate_optimization_id()
+        self.service = EvaluationService(self.script_obj, self.initial_balance, self.game_results, backend=backend, storage=self.storage, optimization_id=self.optimization_id, space=self.space)
         self.current_iteration = 0
         self.load_or_initialize_optimization()
 
@@ -107,7 +110,8 @@ class PSOptimizer:
             "status": "in_progress",
             "current_iteration": self.current_iteration
         }
-        self.storage.save_optimization(optimization_data)
+        # Copied because the writes are applied in the background while the swarm keeps moving
+        self.service.write(Storage.save_optimization, copy.deepcopy(optimization_data))
 
         iteration_data = {
             "iteration": self.current_iteration,
@@ -122,22 +126,46 @@ class PSOptimizer:
             "gbest_position": self.gbest_position,
             "gbest_value": self.gbest_value
         }
-        self.storage.save_iteration_state(self.optimization_id, iteration_data)
+        self.service.write(Storage.save_iteration_state, self.optimization_id, copy.deepcopy(iteration_data))
 
     def initialize_particles(self):
-        self.particles = []
-
-        for _ in range(self.num_particles):
-            # Initialize particle with sampled values
-            position = {}
-            velocity = {}
-            for param_name in self.parameter_names:
-                position[param_name] = self.sample_from_space(param_name)
-                velocity[param_name] = random.uniform(-1, 1)
-
-            # Create a new Particle instance
-            particle = Particle(position, velocity)
-            self.particles.append(particle)
+        self.particles = [self.new_particle() for _ in range(self.num_particles)]
+
+    def new_particle(self):
+        # Initialize particle with sampled values
+        position = {}
+        velocity = {}
+        for param_name in self.parameter_names:
+            position[param_name] = self.sample_from_space(param_name)
+            velocity[param_name] = random.uniform(-1, 1)
+        return Particle(position, velocity)
+
+    def resize(self, num_particles):
+        """Shrinks the swarm to the particles with the best personal bests, or grows it with random particles"""
+        self.particles.sort(key=lambda particle: particle.pbest_value)
+        del self.particles[num_particles:]
+        self.particles.extend(self.new_particle() for _ in range(num_particles - len(self.particles)))
+        self.num_particles = num_particles
+
+    def warm_start(self, positions):
+        """Moves the first particles of a new swarm to known good positions, e.g. from warm_start.find_warm_start
+
+        The other particles keep their random positions, so the swarm still explores. Seeded particles
+        start at rest and the global best position is the best seed, so the first move is towards
+        it and the best seed itself is evaluated as it is. Bests keep an infinite value until they
+        are evaluated on this optimization's games.
+
+        :param positions: Positions, best first
+        """
+        if self.current_iteration > 0:
+            logging.info("Not warm starting an optimization that is being resumed")
+            return
+        for particle, position in zip(self.particles, positions):
+            particle.position = self.enforce_constraints(dict(position))
+            particle.velocity = {key: 0.0 for key in particle.position}
+            particle.pbest_position = particle.position.copy()
+        if positions:
+            self.gbest_position = self.particles[0].position.copy()
 
     def sample_from_space(self, param_name):
         param_details = self.space.get(param_name, {})
@@ -163,17 +191,6 @@ class PSOptimizer:
         else:
             raise ValueError(f"Unknown parameter type: {param_type}")
 
-    async def evaluate_fitness(self, particle):
-        try:
-            decoded_particle = self.enforce_constraints(particle)
-            sim_result = await self.simulator.run(self.initial_balance, self.game_results, decoded_particle)
-            fitness = sim_result[0].get_metric()
-            print(f"Particle: {decoded_particle}, Fitness: {fitness}")
-        except Exception as e:
-            print(f"Error evaluating fitness for particle {particle}: {e}")
-            fitness = float('inf')
-        return fitness
-
     def enforce_constraint(self, param_name, value):
         param_details = self.space.get(param_name, {})
         param_type = param_details.get('type')
@@ -198,7 +215,8 @@ class PSOptimizer:
     def enforce_constraints(self, particle):
         return {param: self.enforce_constraint(param, value) for param, value in particle.items()}
 
-    async def update_particles(self):
+    def ask(self):
+        """Moves every particle and returns the positions to evaluate next"""
         for particle in self.particles:
             # Calculate the inertia component
             inertia = {key: self.w * particle.velocity[key] for key in particle.position.keys()}
@@ -220,9 +238,16 @@ class PSOptimizer:
                 particle.position[key] += particle.velocity[key]
                 particle.position[key] = self.enforce_constraint(key, particle.position[key])
 
-            # Evaluate the fitness of the particle
-            fitness = await self.evaluate_fitness(particle.position)
-            print(f"Particle has a fitness of {fitness}")  # Debugging log
+        return [self.enforce_constraints(particle.position) for particle in self.particles]
+
+    def skip_thresholds(self, candidates):
+        """A position only matters if it beats its particle's personal best"""
+        return [particle.pbest_value for particle in self.particles]
+
+    def tell(self, candidates, fitnesses):
+        """Updates the personal and global bests with the fitness of the positions returned by ask()"""
+        for particle, candidate, fitness in zip(self.particles, candidates, fitnesses):
+            print(f"Particle: {candidate}, Fitness: {fitness}")  # Debugging log
 
             # Update personal and global bests
             if fitness < particle.pbest_value:
@@ -233,19 +258,47 @@ class PSOptimizer:
                 self.gbest_position = particle.position.copy()
                 self.gbest_value = fitness
 
+        telemetry.set_gbest(self.gbest_value, self.gbest_position)
         logging.info(f"Current best fitness: {self.gbest_value}")
 
+    async def update_particles(self, iteration=None):
+        candidates = self.ask()
+        fitnesses = await self.service.evaluate_all(candidates, iteration)
+        self.tell(candidates, fitnesses)
+
     async def optimize(self):
-        for iter_num in range(self.current_iteration, self.max_iter):
-            self.current_iteration = iter_num
-            logging.info(f"Iteration {iter_num + 1}")
-            await self.update_particles()
+        iteration_profiles = []
+        last_snapshot = profiler.snapshot()
+        telemetry.start('PSOptimizer', self.optimization_id, (self.max_iter - self.current_iteration) * self.num_particles, self.service.num_workers)
+
+        def on_iteration(iteration):
+            nonlocal last_snapshot
+            self.current_iteration = iteration
             self.save_optimization_state()
+            if profiler.enabled:
+                snapshot = profiler.snapshot()
+                iteration_profiles.append((iteration, profiler.diff(last_snapshot, snapshot)))
+                last_snapshot = snapshot
+
+        # The optimization row has to exist before any evaluation referencing it is stored
+        self.save_optimization_state()
+        await run_ask_tell(self, self.service, self.current_iteration, self.max_iter, on_iteration)
+        await self.service.flush()
 
         self.save_final_result()
+        if profiler.enabled:
+            self.report_profile(iteration_profiles)
         logging.info(f"Optimization complete. Best position: {self.gbest_position}, Best value: {self.gbest_value}")
         return {'best_parameters': self.gbest_position, 'best_metric': self.gbest_value}
 
+    def report_profile(self, iteration_profiles):
+        report = build_report(profiler.snapshot(), iteration_profiles)
+        print(format_report(report))
+        os.makedirs('logs', exist_ok=True)
+        report_path = os.path.join('logs', f"{self.optimization_id}_profile.json")
+        save_report(report, report_path)
+        logging.info(f"Profile report saved to {report_path}")
+
     def save_final_result(self):
         final_state = {
             "optimization_id": self.optimization_id,
@@ -262,4 +315,4 @@ class PSOptimizer:
             "status": "completed",
             "current_iteration": self.current_iteration
         }
-        self.storage.update_optimization(self.optimization_id, final_state)
+        self.storage.save_optimization(final_state)
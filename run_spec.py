@@ -0,0 +1,209 @@
+import importlib
+import json
+import logging
+import os
+
+from objectives import get_objective
+from simulator import GameResults
+from space import parse_parameters
+
+# Optimizers by name, imported when used so a run only pays for the one it needs (skopt takes a second)
+OPTIMIZERS = {
+    'pso': ('ps_optimizer', 'PSOptimizer'),
+    'bayes': ('bayes_optimizer', 'BayesOptimizer'),
+    'cma': ('cma_optimizer', 'CMAESOptimizer'),
+    'island': ('island_optimizer', 'IslandOptimizer'),
+}
+
+SPEC_DEFAULTS = {
+    'optimizer': 'pso',
+    'balance': 10000,
+    'games': 1000,
+    'sets': 3,
+    'required_median': 1.98,
+    'seed': None,
+    'bank_size': None,
+    'set_selection': 'random',
+    'backend': None,
+    'workers': 0,
+    'sequential': False,
+    'max_sets': None,
+    'confidence': 0.95,
+    'prescreen': False,
+    'surrogate': False,
+    'objective': None,
+    'reuse_evaluations': None,
+    'optimization_id': None,
+    'history': None,  # A game store of history_store.py to simulate real games from
+    'history_ranges': None,  # [start_id, end_id) of every set taken from the history
+    'warm_start': None,  # Number of the best stored evaluations a new optimization starts from, see warm_start.py
+    'budget': None,  # Time and/or games the run may use instead of a number of iterations, e.g. '2h' or '50M games', see budget.py
+}
+
+
+def load_optimizer(name):
+    """Returns the optimizer class registered under a name"""
+    if name not in OPTIMIZERS:
+        raise ValueError(f"Unknown optimizer: {name}, available: {', '.join(OPTIMIZERS)}")
+    module_name, class_name = OPTIMIZERS[name]
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def read_spec_file(path):
+    """Reads a run spec from a JSON, TOML or YAML file, by extension"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.json':
+        with open(path, 'r', encoding='utf-8') as file:
+            return json.load(file)
+    elif extension == '.toml':
+        import tomllib
+        with open(path, 'rb') as file:
+            return tomllib.load(file)
+    elif extension in ('.yaml', '.yml'):
+        try:
+            import yaml
+        except ImportError:
+            raise ValueError("Reading YAML run specs needs PyYAML, use JSON or TOML instead") from None
+        with open(path, 'r', encoding='utf-8') as file:
+            return yaml.safe_load(file)
+    else:
+        raise ValueError(f"Unknown run spec format: {path}, use .json, .toml or .yaml")
+
+
+def space_to_parameters(space):
+    """Converts the space of a spec, {name: {'type': ..., 'range': [min, max] or 'options': [...]}}, to parameters"""
+    parameters = []
+    for param_name, param_details in space.items():
+        param_type = param_details['type']
+        if param_type in ('checkbox', 'radio'):
+            values = param_details.get('options', [True, False] if param_type == 'checkbox' else None)
+            if values is None:
+                raise ValueError(f"Parameter {param_name} of type radio needs its options")
+            parameters.append((param_name, list(values), param_type))
+        else:
+            minimum, maximum = param_details['range']
+            parameters.append((param_name, (float(minimum), float(maximum)), param_type))
+    return parameters
+
+
+def parse_ranges(text):
+    """Parses game id ranges like '1000-2000,2000-3000' into [(1000, 2000), (2000, 3000)], ends excluded"""
+    ranges = []
+    for part in text.split(','):
+        start, _, end = part.strip().partition('-')
+        ranges.append((int(start), int(end)))
+    return ranges
+
+
+def normalize_spec(spec):
+    """Fills in the defaults of a run spec and parses its space into 'parameters'
+
+    A spec names the script, the parameters to optimize, either as a 'space' mapping or a 'params'
+    string in the format of main.py --params, and optionally anything of SPEC_DEFAULTS.
+    """
+    unknown = set(spec) - set(SPEC_DEFAULTS) - {'script', 'space', 'params', 'parameters'}
+    if unknown:
+        raise ValueError(f"Unknown run spec fields: {', '.join(sorted(unknown))}")
+    if not spec.get('script'):
+        raise ValueError("The run spec doesn't name a script")
+    normalized = dict(SPEC_DEFAULTS)
+    normalized.update(spec)
+    if spec.get('parameters') is None:
+        if spec.get('space'):
+            normalized['parameters'] = space_to_parameters(spec['space'])
+        elif spec.get('params'):
+            normalized['parameters'] = parse_parameters(spec['params'])
+        else:
+            raise ValueError("The run spec has neither a space nor params")
+    if normalized['optimizer'] not in OPTIMIZERS:
+        raise ValueError(f"Unknown optimizer: {normalized['optimizer']}, available: {', '.join(OPTIMIZERS)}")
+    if normalized['objective']:
+        get_objective(normalized['objective'])
+    if normalized['history'] and not normalized['history_ranges']:
+        raise ValueError("A run spec simulating history needs its history_ranges")
+    if normalized['budget']:
+        from budget import parse_budget
+        parse_budget(normalized['budget'])
+    if isinstance(normalized['history_ranges'], str):
+        normalized['history_ranges'] = parse_ranges(normalized['history_ranges'])
+    return normalized
+
+
+def load_run_spec(path):
+    return normalize_spec(read_spec_file(path))
+
+
+def create_game_results(spec):
+    """The game sets of a spec: ranges of real history, or sets generated from the seed"""
+    if spec['history']:
+        from history_store import GameStore
+        store = GameStore(spec['history'])
+        game_results = store.game_results(spec['history_ranges'], spec['required_median'])
+        store.close()
+        return game_results
+    return GameResults(spec['required_median'], spec['sets'], spec['games'], seed=spec['seed'], bank_size=spec['bank_size'], selection=spec['set_selection'])
+
+
+def configure_service(optimizer, spec, storage):
+    """Applies the evaluation options of a spec to an optimizer's evaluation service
+
+    :param optimizer: The optimizer, optimizers without a service only log what they don't support
+    :param spec: A normalized run spec
+    :param storage: Storage to load reused and past evaluations from
+    """
+    optimizer_name = spec['optimizer']
+    service = getattr(optimizer, 'service', None)
+    if spec['objective'] or spec['reuse_evaluations']:
+        if service is not None:
+            if spec['objective']:
+                service.objective = get_objective(spec['objective'])
+            if spec['reuse_evaluations']:
+                service.load_statistics(storage.load_evaluations(spec['reuse_evaluations']))
+        else:
+            logging.warning(f"The {optimizer_name} optimizer doesn't support objectives or reusing evaluations")
+
+    if spec['sequential']:
+        if service is not None:
+            service.enable_sequential(min_sets=spec['sets'], max_sets=spec['max_sets'], confidence=spec['confidence'])
+        else:
+            logging.warning(f"The {optimizer_name} optimizer doesn't support sequential evaluation, simulating every set")
+
+    if spec['prescreen']:
+        if service is not None and optimizer.script_obj.structure:
+            from analytic import ESTIMATED_OBJECTIVES
+            service.enable_prescreen()
+            if service.objective is not None and service.objective.name not in ESTIMATED_OBJECTIVES:
+                logging.warning(f"Pre-screening can't estimate the {service.objective.name} objective, only skipping candidates that are almost certainly ruined")
+        else:
+            logging.warning("Pre-screening needs a script declaring an @hyperopt structure and an optimizer evaluating in this process")
+
+    if spec['surrogate']:
+        if service is not None:
+            from surrogate import SurrogateFilter
+            surrogate = SurrogateFilter(optimizer.space, optimizer.parameter_names)
+            if getattr(optimizer, 'optimization_id', None):
+                surrogate.observe_evaluations(storage.load_evaluations(optimizer.optimization_id))
+            service.enable_surrogate(surrogate)
+        else:
+            logging.warning(f"The {optimizer_name} optimizer doesn't support the surrogate filter")
+
+    if spec['warm_start']:
+        if hasattr(optimizer, 'warm_start'):
+            from warm_start import find_warm_start, matching_evaluations
+            minimize = service.minimize if service is not None else optimizer.minimize
+            evaluations = matching_evaluations(storage, optimizer.script_obj, optimizer.parameter_names, optimizer.space, spec['objective'], minimize)
+            seeds = find_warm_start(evaluations, spec['warm_start'], minimize)
+            logging.info(f"Warm starting from {len(seeds)} of {len(evaluations)} matching stored evaluations")
+            optimizer.warm_start([params for params, _ in seeds])
+            if service is not None and service.surrogate is not None:
+                # The surrogate learns from every matching evaluation, not only the best ones
+                service.surrogate.observe([params for params, _, _ in evaluations], [fitness for _, fitness, _ in evaluations], minimize)
+        else:
+            logging.warning(f"The {optimizer_name} optimizer doesn't support warm starts")
+
+    if spec['budget']:
+        if service is not None:
+            from budget import parse_budget
+            service.enable_budget(parse_budget(spec['budget']))
+        else:
+            logging.warning(f"The {optimizer_name} optimizer doesn't support budgets, running its planned iterations")
@@ -0,0 +1,311 @@
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import random
+import time
+from collections import defaultdict, deque
+
+from evaluation import create_backend
+from run_spec import OPTIMIZERS, configure_service, create_game_results, load_optimizer, normalize_spec, read_spec_file
+from script import Script
+from simulator import SET_SELECTIONS
+from space import build_space
+from storage import Storage
+
+# The island optimizer runs its own processes and can't share the evaluation pool
+SCHEDULED_OPTIMIZERS = [name for name in OPTIMIZERS if name != 'island']
+POLICIES = ('fair', 'priority')
+
+
+class SharedBackend:
+    def __init__(self, backend, policy='fair'):
+        """Shares one evaluation backend between jobs, handing out its workers by a scheduling policy
+
+        At most num_workers evaluations run at once. When a worker frees up it goes to a waiting job:
+        with 'fair' the one with the fewest evaluations running, with 'priority' the one with the
+        highest priority. Ties go to the request that has waited longest.
+
+        :param backend: The backend every job evaluates on
+        :param policy: 'fair' or 'priority'
+        """
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown scheduling policy: {policy}")
+        self.backend = backend
+        self.policy = policy
+        self.num_workers = backend.num_workers
+        self.free = backend.num_workers
+        self.waiting = defaultdict(deque)  # Job to its (sequence, future) waiting for a worker
+        self.running = defaultdict(int)
+        self.priorities = {}
+        self.sequence = itertools.count()
+
+    def for_job(self, job_id, priority=0):
+        self.priorities[job_id] = priority
+        return JobBackend(self, job_id)
+
+    def _next_job(self):
+        waiting = [job_id for job_id, requests in self.waiting.items() if requests]
+        if not waiting:
+            return None
+        if self.policy == 'priority':
+            return min(waiting, key=lambda job_id: (-self.priorities.get(job_id, 0), self.waiting[job_id][0][0]))
+        return min(waiting, key=lambda job_id: (self.running[job_id], self.waiting[job_id][0][0]))
+
+    async def acquire(self, job_id):
+        if self.free > 0 and not any(self.waiting.values()):
+            self.free -= 1
+            self.running[job_id] += 1
+            return
+        request = (next(self.sequence), asyncio.get_running_loop().create_future())
+        self.waiting[job_id].append(request)
+        try:
+            await request[1]
+        except asyncio.CancelledError:
+            if request[1].done() and not request[1].cancelled():
+                # The worker was handed over right before the cancellation, pass it on
+                self.release(job_id)
+            else:
+                self.waiting[job_id].remove(request)
+            raise
+
+    def release(self, job_id):
+        self.running[job_id] -= 1
+        next_job = self._next_job()
+        if next_job is None:
+            self.free += 1
+            return
+        _, future = self.waiting[next_job].popleft()
+        self.running[next_job] += 1
+        future.set_result(None)
+
+    def get_stats(self):
+        return {job_id: {'running': self.running[job_id], 'waiting': len(self.waiting[job_id])} for job_id in self.priorities}
+
+
+class JobBackend:
+    def __init__(self, shared, job_id):
+        """The view of a SharedBackend a single job's optimizer evaluates on"""
+        self.shared = shared
+        self.job_id = job_id
+        self.num_workers = shared.num_workers
+
+    async def evaluate(self, script_obj, initial_balance, game_results, params, sequential=None):
+        await self.shared.acquire(self.job_id)
+        try:
+            return await self.shared.backend.evaluate(script_obj, initial_balance, game_results, params, sequential=sequential)
+        finally:
+            self.shared.release(self.job_id)
+
+    def close(self):
+        """The shared backend outlives the job, the scheduler closes it"""
+
+
+class GameSetCache:
+    def __init__(self):
+        """Hands every job asking for the same game sets the same GameResults
+
+        Workers keep one context per content hash, so jobs sharing game sets also share them there.
+        Unseeded sets are shared as well, jobs queued together are compared on the same games.
+        """
+        self.game_results = {}
+
+    def get(self, spec):
+        history_ranges = tuple(map(tuple, spec['history_ranges'])) if spec['history'] else None
+        key = (spec['required_median'], spec['sets'], spec['games'], spec['seed'], spec['bank_size'], spec['set_selection'], spec['history'], history_ranges)
+        game_results = self.game_results.get(key)
+        if game_results is None:
+            game_results = self.game_results[key] = create_game_results(spec)
+        return game_results
+
+
+class Scheduler:
+    def __init__(self, backend, max_jobs=2, policy='fair', poll_interval=None):
+        """Runs the optimizations queued in the optimizations table, several at once over one backend
+
+        Jobs interrupted by a crash are still in_progress and are resumed first, from their saved
+        state. Then pending jobs start by priority and age.
+
+        :param backend: The evaluation backend shared by all jobs
+        :param max_jobs: Most jobs running at the same time
+        :param policy: How workers are shared between running jobs, 'fair' or 'priority'
+        :param poll_interval: Seconds between looking for new jobs once the queue is empty, None to stop then
+        """
+        self.shared = SharedBackend(backend, policy)
+        self.storage = Storage('optimizations.db')
+        self.max_jobs = max(1, max_jobs)
+        self.poll_interval = poll_interval
+        self.game_sets = GameSetCache()
+        self.running = {}
+        self.finished = {}
+
+    def next_jobs(self):
+        return [job for job in self.storage.get_jobs() if job['id'] not in self.running and job['id'] not in self.finished]
+
+    def create_optimizer(self, job):
+        # The job's config is a run spec without its script and balance, those are columns of the job
+        spec = normalize_spec(dict(job['config'], script=job['script_path'], balance=job['initial_balance'] / 100))
+        if spec['optimizer'] not in SCHEDULED_OPTIMIZERS:
+            raise ValueError(f"The {spec['optimizer']} optimizer can't be scheduled, use one of: {', '.join(SCHEDULED_OPTIMIZERS)}")
+        script_obj = Script(spec['script'])
+        parameter_names, space = build_space(spec['parameters'])
+        game_results = self.game_sets.get(spec)
+        backend = self.shared.for_job(job['id'], job['priority'] or 0)
+        optimizer = load_optimizer(spec['optimizer'])(script_obj, job['initial_balance'], game_results, parameter_names, space, optimization_id=job['id'], backend=backend)
+        configure_service(optimizer, spec, self.storage)
+        return optimizer
+
+    async def run_job(self, job):
+        logging.info(f"{'Resuming' if job['status'] == 'in_progress' else 'Starting'} job {job['id']} ({job['script_path']}, priority {job['priority']})")
+        self.storage.update_optimization(job['id'], {'status': 'in_progress'})
+        optimizer = None
+        try:
+            optimizer = self.create_optimizer(job)
+            results = await optimizer.optimize()
+            optimizer.save_final_result()
+            logging.info(f"Job {job['id']} completed, best metric: {results['best_metric']}, best parameters: {results['best_parameters']}")
+            return 'completed'
+        except Exception as e:
+            logging.exception(f"Job {job['id']} failed: {e}")
+            self.storage.update_optimization(job['id'], {'status': 'failed'})
+            return 'failed'
+        finally:
+            if optimizer is not None:
+                optimizer.service.close()
+
+    async def run(self):
+        """Runs jobs until the queue is empty, or forever when polling"""
+        while True:
+            for job in self.next_jobs()[:self.max_jobs - len(self.running)]:
+                self.running[job['id']] = asyncio.create_task(self.run_job(job))
+
+            if not self.running:
+                if self.poll_interval is None:
+                    break
+                await asyncio.sleep(self.poll_interval)
+                continue
+
+            done, _ = await asyncio.wait(self.running.values(), timeout=self.poll_interval, return_when=asyncio.FIRST_COMPLETED)
+            for job_id, task in list(self.running.items()):
+                if task in done:
+                    self.finished[job_id] = task.result()
+                    del self.running[job_id]
+        return self.finished
+
+    def close(self):
+        self.storage.close()
+
+
+def generate_job_id(storage):
+    while True:
+        optimization_id = f"opt_{int(time.time() * 1000)}_{random.randint(1000, 9999)}"
+        if not storage.optimization_exists(optimization_id):
+            return optimization_id
+
+
+def add_job(args):
+    if args.spec:
+        config = read_spec_file(args.spec)
+        script_path = config.pop('script', None)
+        balance = config.pop('balance', 10000)
+    elif args.script and args.params:
+        config = {
+            'optimizer': args.optimizer,
+            'params': args.params,
+            'games': args.games,
+            'sets': args.sets,
+            'seed': args.seed,
+            'bank_size': args.bank_size,
+            'set_selection': args.set_selection,
+            'sequential': args.sequential,
+            'max_sets': args.max_sets,
+            'confidence': args.confidence,
+            'prescreen': args.prescreen,
+            'surrogate': args.surrogate,
+            'objective': args.objective,
+            'warm_start': args.warm_start,
+            'budget': args.budget,
+        }
+        script_path, balance = args.script, args.balance
+    else:
+        raise SystemExit("Queue a job with --spec, or with --script and --params")
+    # Fail before queueing rather than when the job starts
+    normalize_spec(dict(config, script=script_path))
+
+    storage = Storage('optimizations.db')
+    optimization_id = storage.add_job(generate_job_id(storage), script_path, int(balance * 100), config, args.priority)
+    storage.close()
+    print(f"Queued job {optimization_id}")
+
+
+def list_jobs(args):
+    storage = Storage('optimizations.db')
+    for job in storage.get_jobs(('in_progress', 'pending', 'failed', 'completed')):
+        print(f"{job['id']}  {job['status']:<11}  priority {job['priority']}  {job['config'].get('optimizer', 'pso')}  {job['script_path']}  {job['timestamp']}")
+    storage.close()
+
+
+async def run_jobs(args):
+    os.makedirs('logs', exist_ok=True)
+    logging.basicConfig(filename='logs/scheduler.log', level=logging.INFO)
+    if args.workers > 0:
+        backend = create_backend('process', args.workers, max_evaluations=args.worker_max_evals, max_rss_mb=args.worker_max_rss)
+    else:
+        backend = create_backend('inprocess')
+    scheduler = Scheduler(backend, max_jobs=args.jobs, policy=args.policy, poll_interval=args.poll)
+    try:
+        finished = await scheduler.run()
+    finally:
+        scheduler.close()
+        backend.close()
+    for job_id, status in finished.items():
+        print(f"{job_id}: {status}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Queue optimizations and run them several at a time over one worker pool.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    add = commands.add_parser('add', help='Queue an optimization.')
+    add.add_argument('--spec', help='Run spec file (JSON, TOML or YAML) of the job, see run_spec.py. The other job options are ignored.')
+    add.add_argument('--script', help='Path to the JavaScript file.')
+    add.add_argument('--params', help='Parameters to optimize, in the format of main.py --params.')
+    add.add_argument('--optimizer', choices=SCHEDULED_OPTIMIZERS, default='pso', help='Optimization algorithm to use. Defaults to pso.')
+    add.add_argument('--priority', type=int, default=0, help='Higher priority jobs start first and, with --policy priority, get workers first. Defaults to 0.')
+    add.add_argument('--games', type=int, default=1000, help='Number of games to simulate. Defaults to 1000.')
+    add.add_argument('--balance', type=float, default=10000, help='Initial balance in bits. Defaults to 10000 bits.')
+    add.add_argument('--sets', type=int, default=3, help='Number of game sets every candidate is simulated on. Defaults to 3.')
+    add.add_argument('--seed', type=int, help='Seed of the game sets.')
+    add.add_argument('--bank-size', type=int, help='Generate this many game sets and select --sets of them. Defaults to --sets.')
+    add.add_argument('--set-selection', choices=SET_SELECTIONS, default='random', help='How sets are selected from the bank. Defaults to random.')
+    add.add_argument('--sequential', action='store_true', help='Evaluate candidates on game sets one at a time, see main.py.')
+    add.add_argument('--max-sets', type=int, help='Most sets a candidate is simulated on in sequential mode.')
+    add.add_argument('--confidence', type=float, default=0.95, help='Confidence level of sequential evaluation. Defaults to 0.95.')
+    add.add_argument('--prescreen', action='store_true', help='Skip candidates whose analytical estimate is clearly worse than the best so far.')
+    add.add_argument('--surrogate', action='store_true', help='Skip candidates a model trained on past evaluations predicts to be worse than needed.')
+    add.add_argument('--warm-start', type=int, metavar='K', help='Start from the K best stored evaluations of the same script, see main.py.')
+    add.add_argument('--budget', help='Wall time or simulated games the job may use, e.g. "2h" or "50M games", see main.py.')
+    add.add_argument('--objective', help='Objective used as fitness instead of the default metric, see objectives.py.')
+
+    commands.add_parser('list', help='List queued, running and finished jobs.')
+
+    run = commands.add_parser('run', help='Run the queued jobs, resuming interrupted ones first.')
+    run.add_argument('--jobs', type=int, default=2, help='Number of jobs running at the same time. Defaults to 2.')
+    run.add_argument('--policy', choices=POLICIES, default='fair', help='How workers are shared between running jobs. Defaults to fair.')
+    run.add_argument('--workers', type=int, default=0, help='Number of simulation worker processes shared by all jobs. Defaults to 0 (simulate in-process).')
+    run.add_argument('--worker-max-evals', type=int, default=500, help='Recycle a worker after this many evaluations. Defaults to 500.')
+    run.add_argument('--worker-max-rss', type=float, default=1024, help='Recycle a worker once its memory exceeds this many MB. Defaults to 1024.')
+    run.add_argument('--poll', type=float, help='Keep running and check for new jobs every this many seconds.')
+    args = parser.parse_args()
+
+    if args.command == 'add':
+        add_job(args)
+    elif args.command == 'list':
+        list_jobs(args)
+    else:
+        asyncio.run(run_jobs(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 # pylint: disable=import-error, missing-function-docstring, missing-class-docstring, missing-module-docstring
 import STPyV8 as V8
+import hashlib
 import json
 import logging
 from copy import deepcopy
@@ -15,6 +16,7 @@ class Script:
         raw_js_code = self.read_js_file(file_path)
         self.config, self.js_code = self.split_config(raw_js_code)
         self.defaults = self.config.copy()
+        self.structure = self.parse_structure(raw_js_code)
 
     @staticmethod
     def read_js_file(file_path: str):
@@ -52,6 +54,23 @@ class Script:
         return "{ " + ", ".join(items) + " }"
 
 
+    @staticmethod
+    def parse_structure(raw_js_code: str):
+        """Parses the optional `// @hyperopt {...}` comment declaring the script's betting structure
+
+        :param raw_js_code: The raw script code
+        :return: The declared structure as a dictionary, None if the script declares none
+        """
+        for line in raw_js_code.splitlines():
+            line = line.strip()
+            if line.startswith('//') and '@hyperopt' in line:
+                try:
+                    return json.loads(line.split('@hyperopt', 1)[1])
+                except json.JSONDecodeError as e:
+                    logging.warning(f"Ignoring invalid @hyperopt declaration: {e}")
+                    return None
+        return None
+
     def split_config(self, raw_js_code: str):
         """Parses the script contents and splits the config object from the rest of the script
 
@@ -108,6 +127,10 @@ class Script:
                 updated_config[key]['value'] = value
         return updated_config
 
+    def content_hash(self):
+        """Returns a hash of the script code without its config, unchanged when only default values are edited"""
+        return hashlib.sha256(self.js_code.encode()).hexdigest()
+
     def merge_config(self):
         """Returns the full script code with the config object merged in
 
@@ -3,6 +3,7 @@ var config = {
     payout: { type: 'multiplier', label: 'Payout', value: 2 },
     waitNum: { type: 'number', label: 'Wait Skips', value: 3 }
 };
+// @hyperopt {"model": "wait_martingale", "payout": "payout", "base_bet": "baseBet", "wait": "waitNum", "multiplier": "recover"}
 Object.entries(config).forEach((c) => (globalThis[c[0]] = c[1].value));
 log(config);
 //log(`Script is running with baseBet: ${baseBet}, payout: ${payout}, waitNum: ${waitNum}`);
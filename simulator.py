@@ -3,36 +3,133 @@ import hashlib
 import hmac
 import math
 import random
+import re
+from bust_index import bust_index
 from metrics import Statistics
-from statistics import median
+from objectives import get_objective
+from statistics import NormalDist, median
 from engine import Engine, History, UserInfo
 from script import Script
+from profiling import profiler
 import STPyV8
 import asyncio
 
+SET_SELECTIONS = ('random', 'stratified', 'antithetic')
+SALT = '0000000000000000004d6ec16dafe9d8370958664c1dc422f452892264c59526'.encode()
+
+
+def bust_from_hash(hash_value):
+    """The bust of the game with a hash: the first 52 bits of its HMAC with the salt, as in every game chain of this repo"""
+    digest = hmac.digest(SALT, binascii.unhexlify(hash_value), 'sha256')
+    intversion = int.from_bytes(digest[:7], 'big') >> 4
+    return round(max(1, math.floor(100 / (1 - (intversion / (2 ** 52)))) / 101), 2)
+
+
+def game_result_from_hash(hash_value, game_id=None):
+    return {'id': game_id, 'hash': hash_value, 'bust': bust_from_hash(hash_value)}
+
+
 class GameResults:
-    def __init__(self, required_median: float, num_sets: int, num_games: int):
+    def __init__(self, required_median: float, num_sets: int, num_games: int, seed=None, bank_size=None, selection='random'):
+        """The game sets every candidate is simulated on
+
+        Every candidate plays the exact same sets, so differences in fitness between candidates come
+        from the parameters rather than from luck. With a seed the bank of sets is reproducible, so a
+        resumed or repeated optimization is evaluated on the same games.
+
+        :param required_median: The median bust every set must have
+        :param num_sets: Number of sets every candidate is simulated on
+        :param num_games: Number of games per set
+        :param seed: Seed of the set bank, None for fresh random sets
+        :param bank_size: Number of sets generated to select the num_sets from, defaults to num_sets
+        :param selection: How sets are selected from the bank: 'random', 'stratified' by difficulty, or
+            'antithetic' pairs of sets from opposite ends of the difficulty range
+        """
+        if selection not in SET_SELECTIONS:
+            raise ValueError(f"Unknown set selection: {selection}")
         self.required_median = required_median
         self.num_sets = num_sets
         self.num_games = num_games
-        self.result_sets = [self.generate_sim_results() for _ in range(self.num_sets)]
+        self.seed = seed
+        self.selection = selection
+        self.rng = random.Random(seed)
+        self.bank = [self.generate_sim_results() for _ in range(max(bank_size or num_sets, num_sets))]
+        self.result_sets = self.select_sets(num_sets, selection)
+        self._content_hash = None
+
+    @classmethod
+    def from_game_sets(cls, game_sets, required_median=None):
+        """GameResults simulating exactly the given sets, e.g. ranges of real history from history_store.py"""
+        game_results = cls.__new__(cls)
+        game_results.required_median = required_median
+        game_results.num_sets = len(game_sets)
+        game_results.num_games = max((len(game_set) for game_set in game_sets), default=0)
+        game_results.seed = None
+        game_results.selection = 'random'
+        game_results.rng = random.Random()
+        game_results.bank = list(game_sets)
+        game_results.result_sets = list(game_sets)
+        game_results._content_hash = None
+        return game_results
+
+    @staticmethod
+    def set_difficulty(game_set, target=2.0):
+        """Orders sets by how hard they are on a progression: the longest streak of busts below the target,
+        ties broken by the number of busts below it"""
+        index = bust_index(game_set)
+        return index.longest_streak(target), index.num_games - index.count_at_least(target)
+
+    def select_sets(self, num_sets, selection='random'):
+        if selection == 'random' or num_sets >= len(self.bank):
+            return self.rng.sample(self.bank, num_sets) if num_sets < len(self.bank) else list(self.bank)
+
+        ranked = sorted(self.bank, key=self.set_difficulty)
+        if selection == 'stratified':
+            # One set from each of num_sets equally sized strata of difficulty
+            bounds = [round(stratum * len(ranked) / num_sets) for stratum in range(num_sets + 1)]
+            return [ranked[self.rng.randrange(bounds[stratum], bounds[stratum + 1])] for stratum in range(num_sets)]
+
+        # Antithetic: every easy set is paired with its mirror among the hard ones, so the errors of a pair cancel out
+        selected = []
+        for index in self.rng.sample(range((len(ranked) - 1) // 2), num_sets // 2):
+            selected.extend((ranked[index], ranked[len(ranked) - 1 - index]))
+        if num_sets % 2:
+            selected.append(ranked[len(ranked) // 2])
+        return selected
+
+    def set_sequence(self):
+        """Returns the selected sets followed by the rest of the bank, the order sets are added in sequential evaluation"""
+        return self.result_sets + [game_set for game_set in self.bank if not any(game_set is selected for selected in self.result_sets)]
+
+    def content_hash(self):
+        """Returns a hash identifying the exact games in every selected set, in order, and in the bank"""
+        if self._content_hash is None:
+            digest = hashlib.sha256()
+            for game_set in self.result_sets + self.bank:
+                for game in game_set:
+                    digest.update(game['hash'].encode())
+                digest.update(b'|')
+            self._content_hash = digest.hexdigest()
+        return self._content_hash
 
-    def generate_games(self, hash_value, num_games):
-        salt = '0000000000000000004d6ec16dafe9d8370958664c1dc422f452892264c59526'.encode()
-        hashobj = hmac.new(salt, binascii.unhexlify(hash_value), hashlib.sha256)
+    @staticmethod
+    def generate_games(hash_value, num_games):
+        """Generates a chain of games from its last hash, in the order they are played
+
+        Every game's hash is the SHA-256 of the hash of the game played after it, like a real game chain.
+        """
         game_results = []
         for i in range(num_games):
-            intversion = int(hashobj.hexdigest()[:52 // 4], 16)
-            number = max(1, math.floor(100 / (1 - (intversion / (2 ** 52)))) / 101)
-            game_results.append({'id': i + 1, 'hash': hash_value, 'bust': round(number, 2)})
+            game_results.append({'id': i + 1, 'hash': hash_value, 'bust': bust_from_hash(hash_value)})
             hash_value = hashlib.sha256(hash_value.encode()).hexdigest()
-            hashobj = hmac.new(salt, binascii.unhexlify(hash_value), hashlib.sha256)
         return game_results[::-1]
 
     def generate_sim_results(self):
         while True:
-            game_hash = hashlib.sha256(str(random.random()).encode()).hexdigest()
-            generated_results = self.generate_games(game_hash, self.num_games)
+            game_hash = hashlib.sha256(str(self.rng.random()).encode()).hexdigest()
+            with profiler.phase('game_generation'):
+                generated_results = self.generate_games(game_hash, self.num_games)
+            profiler.count('games_generated', self.num_games)
             busts = [game['bust'] for game in generated_results]
             median_bust = median(busts)
             if round(median_bust, 2) == self.required_median:
@@ -44,11 +141,8 @@ class Simulator:
         self.shouldStop = False
         self.shouldStopReason = None
 
-    async def run_single_simulation(self, initial_balance, game_set, script_params):
-        userInfo = UserInfo("Player", initial_balance)
-        engine = Engine(userInfo)
-        statistics = Statistics(initial_balance)
-
+    def _load_script(self, js_context, engine, userInfo, script_params):
+        """Exposes the engine API to the script in an entered context and evaluates it"""
         def stop(reason):
             self.shouldStop = True
             engine.stopping = True
@@ -60,36 +154,189 @@ class Simulator:
             return hashlib.sha256(text.encode()).hexdigest()
 
         def gameResultFromHash(game_hash: str):
-            return GameResults.generate_games(game_hash, 1)[0]
-
-        with STPyV8.JSContext() as js_context:
-            js_context.locals.engine = engine
-            js_context.locals.userInfo = userInfo
-            js_context.locals.stop = stop
-            js_context.locals.log = lambda *msgs: None  # Discard log messages
-            js_context.locals.SHA256 = SHA256
-            js_context.locals.gameResultFromHash = gameResultFromHash
-            js_context.locals.config = self.script.get_config(script_params)
+            return game_result_from_hash(game_hash)
+
+        js_context.locals.engine = engine
+        js_context.locals.userInfo = userInfo
+        js_context.locals.stop = stop
+        js_context.locals.log = lambda *msgs: None  # Discard log messages
+        js_context.locals.SHA256 = SHA256
+        js_context.locals.gameResultFromHash = gameResultFromHash
+        js_context.locals.config = self.script.get_config(script_params)
+        with profiler.phase('script_eval'):
             js_context.eval(self.script.js_code)
 
+    def balance_dependent(self):
+        """Whether the script's bets may depend on its balance, so bankrolls can't share one simulation
+
+        Scripts declare it with "uses_balance" in their @hyperopt comment. Without a declaration any
+        balance property read outside of comments, like userInfo.balance, counts as depending on it.
+        """
+        structure = self.script.structure or {}
+        if 'uses_balance' in structure:
+            return bool(structure['uses_balance'])
+        code = re.sub(r'/\*.*?\*/|//[^\n]*', '', self.script.js_code, flags=re.S)
+        return re.search(r'\.\s*balance\b', code) is not None
+
+    @staticmethod
+    def statistics_from_trace(initial_balance, trace):
+        """Statistics of a bankroll placing the bets of a trace, those of a failed simulation when it can't afford one"""
+        statistics = Statistics(initial_balance)
+        balance = initial_balance
+        for bust, wager, cashed_at, _ in trace:
+            if wager is not None:
+                # Same checks and arithmetic as the engine, so a bankroll fails on the same bet it would in its own simulation
+                if balance < wager:
+                    return Statistics(0)
+                balance -= wager
+                if cashed_at is not None:
+                    balance += wager * cashed_at
+            statistics.record({'bust': bust, 'wager': wager, 'cashedAt': cashed_at})
+        return statistics
+
+    async def run_single_simulation(self, initial_balance, game_set, script_params, trace=None):
+        """Plays a game set, returns its Statistics and None
+
+        :param trace: A list receiving (bust, wager, cashed at, balance) of every game, wager and
+            cashed at are None when no bet was placed or it was lost
+        """
+        userInfo = UserInfo("Player", initial_balance)
+        engine = Engine(userInfo)
+        statistics = Statistics(initial_balance)
+
+        with profiler.phase('context_creation'):
+            js_context = STPyV8.JSContext()
+
+        with js_context:
+            self._load_script(js_context, engine, userInfo, script_params)
+
             try:
                 for game in game_set:
-                    await engine._nextGame(game)
+                    with profiler.phase('event_dispatch'):
+                        await engine._nextGame(game)
                     statistics.update(engine)
+                    if trace is not None:
+                        last_game = engine.history.first()
+                        trace.append((last_game['bust'], last_game['wager'], last_game['cashedAt'], userInfo.balance))
                     if self.shouldStop:
                         break
             except ValueError as e:  # Catch the insufficient balance error
                 return Statistics(0), None  # Return a Statistics object with a very low balance to indicate failure
+            finally:
+                profiler.count('games_simulated', statistics.games_total)
 
             return statistics, None
 
+    async def iter_windows(self, initial_balance, game_set, script_params, windows):
+        """Plays a long game set once and yields the statistics of every window as soon as it ends
+
+        Windows may overlap, every game is recorded in each window open at that time, so rolling
+        windows and train/validate splits of a chain cost a single simulation. A window starts from
+        the balance reached when its first game begins. When the balance runs out the open windows
+        end with a balance of 0, like a failed simulation, and later windows are never reached.
+
+        :param windows: (start, end) game indexes, end excluded, see walk_forward.py
+        :return: An async iterator of ((start, end), Statistics), then (None, Statistics) of the whole set
+        """
+        userInfo = UserInfo("Player", initial_balance)
+        engine = Engine(userInfo)
+        statistics = Statistics(initial_balance)
+        starts, ends = {}, {}
+        for window in set(windows):
+            starts.setdefault(window[0], []).append(window)
+            ends.setdefault(window[1], []).append(window)
+        open_windows = {}
+
+        with profiler.phase('context_creation'):
+            js_context = STPyV8.JSContext()
+
+        with js_context:
+            self.shouldStop = False
+            self._load_script(js_context, engine, userInfo, script_params)
+
+            try:
+                for position, game in enumerate(game_set):
+                    for window in starts.get(position, ()):
+                        open_windows[window] = Statistics(statistics.balance)
+                    with profiler.phase('event_dispatch'):
+                        await engine._nextGame(game)
+                    statistics.update(engine)
+                    last_game = engine.history.first()
+                    for window_statistics in open_windows.values():
+                        window_statistics.record(last_game)
+                    for window in ends.get(position + 1, ()):
+                        yield window, open_windows.pop(window)
+                    if self.shouldStop:
+                        break
+            except ValueError:  # Insufficient balance, the windows it happened in failed
+                for window, window_statistics in open_windows.items():
+                    window_statistics.balance = 0
+                    yield window, window_statistics
+                statistics.balance = 0
+            finally:
+                profiler.count('games_simulated', statistics.games_total)
+
+        yield None, statistics
+
+    async def run_windows(self, initial_balance, game_set, script_params, windows):
+        """Runs iter_windows to the end, returns the statistics of the whole set and a dictionary of window to statistics"""
+        profiler.count('evaluations')
+        results = {}
+        with profiler.phase('evaluation'):
+            async for window, statistics in self.iter_windows(initial_balance, game_set, script_params, windows):
+                if window is None:
+                    whole = statistics
+                else:
+                    results[window] = statistics
+        return whole, results
+
+    async def run_single_bankrolls(self, initial_balances, game_set, script_params):
+        """Statistics of every initial balance on one game set, in the order of the balances
+
+        When the script's bets don't depend on its balance every bankroll places the same bets until
+        it can't afford one, so a single simulation with the largest bankroll serves them all. Scripts
+        that do depend on it are simulated once per bankroll.
+        """
+        if self.balance_dependent():
+            results = await asyncio.gather(*[self.run_single_simulation(initial_balance, game_set, script_params) for initial_balance in initial_balances])
+            return [result[0] for result in results]
+
+        trace = []
+        statistics, _ = await self.run_single_simulation(max(initial_balances), game_set, script_params, trace)
+        if statistics.balance == 0:
+            # The largest bankroll ran out of balance, the smaller ones did no later
+            return [Statistics(0) for _ in initial_balances]
+        profiler.count('bankrolls_shared', len(initial_balances) - 1)
+        return [self.statistics_from_trace(initial_balance, trace) for initial_balance in initial_balances]
+
+    async def run_bankrolls(self, initial_balances, game_results, script_params):
+        """Evaluates several initial balances on the same game sets, sharing simulations where possible
+
+        :param initial_balances: The initial balances, in cents
+        :return: A list of (averaged Statistics, Statistics of every set) per balance, the averaged
+            statistics are None when the balance ran out on every set
+        """
+        self.shouldStop = False
+        self.shouldStopReason = None
+        profiler.count('evaluations')
+        with profiler.phase('evaluation'):
+            per_set = await asyncio.gather(*[self.run_single_bankrolls(initial_balances, game_set, script_params) for game_set in game_results.result_sets])
+
+        results = []
+        for index in range(len(initial_balances)):
+            set_statistics = [bankrolls[index] for bankrolls in per_set]
+            results.append((Statistics.average_statistics([statistics for statistics in set_statistics if statistics.balance != 0]), set_statistics))
+        return results
+
     async def run(self, initial_balance, game_results, script_params):
         try:
             self.shouldStop = False
             self.shouldStopReason = None
+            profiler.count('evaluations')
 
             tasks = [self.run_single_simulation(initial_balance, game_set, script_params) for game_set in game_results.result_sets]
-            results = await asyncio.gather(*tasks)
+            with profiler.phase('evaluation'):
+                results = await asyncio.gather(*tasks)
 
             if any(result[0] == "SCRIPT_ERROR" for result in results):
                 raise Exception("Script error detected. Discarding all simulations.")
@@ -104,6 +351,57 @@ class Simulator:
 
             averaged_statistics = Statistics.average_statistics(aggregated_statistics)
 
-            return averaged_statistics, None
+            # The statistics of every set, in the order of the sets, for paired comparisons and standard errors
+            return averaged_statistics, [result[0] for result in results]
         except Exception as e:
             raise e
+
+    async def run_sequential(self, initial_balance, game_results, script_params, incumbent=None, min_sets=2, max_sets=None, confidence=0.95, objective=None, minimize=True):
+        """Simulates one set at a time until the fitness is clearly better or worse than the incumbent's
+
+        Sets are added in the order of GameResults.set_sequence, so the bank provides the sets beyond
+        num_sets. A running mean and variance of every set's fitness are kept and no more sets are added
+        once the confidence interval of the mean excludes the incumbent, or max_sets were simulated.
+
+        :param incumbent: The fitness to separate from, None to simulate max_sets
+        :param min_sets: Sets simulated before stopping is considered
+        :param max_sets: Most sets simulated, defaults to the whole sequence
+        :param confidence: Confidence level of the interval
+        :param objective: Name of the objective the fitness is computed with, like EvaluationService, defaults to the metric
+        :param minimize: The direction the objective's values are turned to, see Objective.oriented
+        :return: The averaged statistics and the statistics of every simulated set, like run
+        """
+        profiler.count('evaluations')
+        objective = get_objective(objective) if objective is not None else None
+        sets = game_results.set_sequence()
+        max_sets = min(max_sets or len(sets), len(sets))
+        z = NormalDist().inv_cdf((1 + confidence) / 2)
+        count, mean, m2 = 0, 0.0, 0.0
+        results = []
+        with profiler.phase('evaluation'):
+            for game_set in sets[:max_sets]:
+                self.shouldStop = False
+                statistics, _ = await self.run_single_simulation(initial_balance, game_set, script_params)
+                results.append(statistics)
+                if objective is None:
+                    fitness = statistics.get_metric()
+                elif statistics.balance == 0:
+                    fitness = float('inf')
+                else:
+                    fitness = objective.oriented(objective(statistics.get_statistics(), [statistics.get_statistics()]), minimize)
+                if math.isfinite(fitness):
+                    # Welford's online update of the mean and the sum of squared deviations
+                    count += 1
+                    delta = fitness - mean
+                    mean += delta / count
+                    m2 += delta * (fitness - mean)
+                if incumbent is not None and math.isfinite(incumbent) and count >= max(min_sets, 2):
+                    half_width = z * math.sqrt(m2 / (count - 1) / count)
+                    if abs(mean - incumbent) > half_width:
+                        break
+        profiler.count('sets_simulated', len(results))
+
+        aggregated_statistics = [statistics for statistics in results if statistics.balance != 0]
+        if not aggregated_statistics:
+            raise Exception("All simulations returned None or an empty list. No average statistics available.")
+        return Statistics.average_statistics(aggregated_statistics), results
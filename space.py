@@ -0,0 +1,80 @@
+import math
+
+# Smallest step a parameter of each type can actually take in a script
+RESOLUTIONS = {
+    'balance': 100,  # Bets are placed in whole bits
+    'payout': 0.01,
+    'multiplier': 0.01,
+    'integer': 1,
+}
+
+
+def resolution(param_details):
+    """Returns the resolution of a parameter, None if it is discrete or continuous"""
+    param_type = param_details.get('type')
+    if param_type == 'number' and param_details.get('is_integer'):
+        return 1
+    return RESOLUTIONS.get(param_type)
+
+
+def canonicalize_value(param_details, value):
+    """Quantizes a value to its parameter's resolution and converts NumPy scalars to Python values
+
+    :param param_details: The parameter's entry in the space, with its 'type' and 'range'
+    :param value: The value to canonicalize
+    :return: The canonical value, identical for every value the script can't tell apart
+    """
+    if hasattr(value, 'item'):
+        value = value.item()
+    param_type = param_details.get('type')
+    if param_type == 'checkbox':
+        return bool(value)
+    step = resolution(param_details)
+    if step is None or not isinstance(value, (int, float)) or not math.isfinite(value):
+        return value
+
+    param_range = param_details.get('range')
+    if step >= 1:
+        value = int(round(value / step) * step)
+    else:
+        decimals = round(-math.log10(step))
+        value = round(round(value / step) * step, decimals)
+    if param_range is not None:
+        value = max(min(value, param_range[1]), param_range[0])
+        if step >= 1:
+            value = int(round(value))
+    return value
+
+
+def canonicalize(space, params):
+    """Returns the canonical form of a candidate, parameters missing from the space are kept as they are"""
+    return {param_name: canonicalize_value(space[param_name], value) if param_name in space else value for param_name, value in params.items()}
+
+
+def parse_parameters(spec):
+    """Parses the --params format, e.g. "baseBet:integer,1,100;payout:payout,1.01,10;flag:checkbox,True,False"
+
+    :return: A list of (name, range or options, type)
+    """
+    parameters = []
+    for param in spec.split(";"):
+        param_details = param.split(":")
+        param_name = param_details[0]
+        value_ranges = param_details[1].split(",")
+        param_type = value_ranges[0]
+        if param_type == "checkbox":
+            param_values = [True if value == "True" else False for value in value_ranges[1:]]
+            parameters.append((param_name, param_values, param_type))
+        elif param_type == "radio":
+            param_values = value_ranges[1:]
+            parameters.append((param_name, param_values, param_type))
+        else:
+            min_value = float(value_ranges[1])
+            max_value = float(value_ranges[2])
+            parameters.append((param_name, (min_value, max_value), param_type))
+    return parameters
+
+
+def build_space(parameters):
+    """Returns the parameter names and the space the optimizers take"""
+    return [param[0] for param in parameters], {param[0]: {'range': param[1], 'type': param[2]} for param in parameters}
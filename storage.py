@@ -1,9 +1,12 @@
 import sqlite3
 import json
 import logging
+from metrics import STATISTICS_KEYS
+from profiling import profiler
 
 class Storage:
     def __init__(self, db_path):
+        self.db_path = db_path
         self.conn = sqlite3.connect(db_path, check_same_thread=False)
         self.conn.execute("PRAGMA foreign_keys=ON")
         self.conn.row_factory = sqlite3.Row
@@ -29,6 +32,11 @@ class Storage:
                 timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
             )
         """)
+        # Queued jobs carry their whole run configuration, see scheduler.py
+        self.add_column('optimizations', 'config', 'TEXT')
+        self.add_column('optimizations', 'priority', 'INTEGER DEFAULT 0')
+        # Content hash of the script, to find the evaluations of the same code for warm starts
+        self.add_column('optimizations', 'script_hash', 'TEXT')
         self.cursor.execute("""
             CREATE TABLE IF NOT EXISTS iteration_states (
                 optimization_id TEXT,
@@ -40,6 +48,31 @@ class Storage:
                 FOREIGN KEY (optimization_id) REFERENCES optimizations(id)
             )
         """)
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS evaluations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                optimization_id TEXT,
+                iteration INTEGER,
+                parameters TEXT,
+                fitness REAL,
+                statistics TEXT,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (optimization_id) REFERENCES optimizations(id)
+            )
+        """)
+        self.add_column('evaluations', 'statistics', 'TEXT')
+        self.cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_evaluations_optimization ON evaluations (optimization_id, iteration)
+        """)
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS optimizer_states (
+                optimization_id TEXT,
+                iteration INTEGER,
+                state TEXT,
+                PRIMARY KEY (optimization_id, iteration),
+                FOREIGN KEY (optimization_id) REFERENCES optimizations(id)
+            )
+        """)
         self.cursor.execute("""
             CREATE TABLE IF NOT EXISTS scripts (
                 id TEXT PRIMARY KEY,
@@ -51,15 +84,48 @@ class Storage:
         """)
         self.conn.commit()
 
+    def add_column(self, table, column, column_type):
+        """Adds a column to a table created by an older version"""
+        self.cursor.execute(f"PRAGMA table_info({table})")
+        if column not in [row['name'] for row in self.cursor.fetchall()]:
+            self.cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+    @staticmethod
+    def encode_statistics(statistics):
+        """Stores averaged and per set statistics as arrays in the order of STATISTICS_KEYS"""
+        if statistics is None:
+            return None
+        return json.dumps({
+            'mean': [statistics['mean'][key] for key in STATISTICS_KEYS],
+            'sets': [[set_statistics[key] for key in STATISTICS_KEYS] for set_statistics in statistics['sets']],
+        })
+
+    @staticmethod
+    def decode_statistics(encoded):
+        if encoded is None:
+            return None
+        statistics = json.loads(encoded)
+        return {
+            'mean': dict(zip(STATISTICS_KEYS, statistics['mean'])),
+            'sets': [dict(zip(STATISTICS_KEYS, set_statistics)) for set_statistics in statistics['sets']],
+        }
+
+    @profiler.timed('storage_write')
     def save_optimization(self, optimization_data):
         try:
             self.cursor.execute("""
-                INSERT OR REPLACE INTO optimizations
-                (id, script_path, initial_balance, num_particles, max_iter, c1, c2, w, damping, gbest_value, gbest_position, status, current_iteration)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                INSERT INTO optimizations
+                (id, script_path, script_hash, initial_balance, num_particles, max_iter, c1, c2, w, damping, gbest_value, gbest_position, status, current_iteration)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET
+                script_path = excluded.script_path, script_hash = excluded.script_hash, initial_balance = excluded.initial_balance,
+                num_particles = excluded.num_particles, max_iter = excluded.max_iter, c1 = excluded.c1, c2 = excluded.c2,
+                w = excluded.w, damping = excluded.damping, gbest_value = excluded.gbest_value,
+                gbest_position = excluded.gbest_position, status = excluded.status, current_iteration = excluded.current_iteration
             """, (
                 optimization_data["optimization_id"],
                 optimization_data["script_obj"].js_file_path,
+                optimization_data["script_obj"].content_hash(),
                 optimization_data["initial_balance"],
                 optimization_data["num_particles"],
                 optimization_data["max_iter"],
@@ -89,10 +155,11 @@ class Storage:
             return False
 
     def load_optimization(self, optimization_id):
+        """Returns the saved state of an optimization, None if it doesn't exist or is a job that never saved one"""
         try:
             self.cursor.execute("SELECT * FROM optimizations WHERE id = ?", (optimization_id,))
             row = self.cursor.fetchone()
-            if row:
+            if row and row['current_iteration'] is not None:
                 optimization_data = dict(row)
                 optimization_data["gbest_position"] = json.loads(optimization_data["gbest_position"])
                 return optimization_data
@@ -101,6 +168,7 @@ class Storage:
             logging.error(f"An error occurred: {e}")
             return None
 
+    @profiler.timed('storage_write')
     def update_optimization(self, optimization_id, update_data):
         try:
             update_fields = ", ".join([f"{k} = ?" for k in update_data.keys()])
@@ -112,6 +180,7 @@ class Storage:
             logging.error(f"An error occurred: {e}")
             self.conn.rollback()
 
+    @profiler.timed('storage_write')
     def save_iteration_state(self, optimization_id, iteration_data):
         try:
             self.cursor.execute("""
@@ -147,6 +216,138 @@ class Storage:
             logging.error(f"An error occurred: {e}")
             return None
 
+    @profiler.timed('storage_write')
+    def save_evaluations(self, optimization_id, iteration, evaluations):
+        """Stores evaluations as (parameters, fitness) or (parameters, fitness, statistics) tuples
+
+        The statistics are a dictionary of the averaged 'mean' statistics and the statistics of
+        every set, as returned by Statistics.get_statistics.
+        """
+        try:
+            self.cursor.executemany("""
+                INSERT INTO evaluations
+                (optimization_id, iteration, parameters, fitness, statistics)
+                VALUES (?, ?, ?, ?, ?)
+            """, [
+                (optimization_id, iteration, json.dumps(evaluation[0]), evaluation[1], self.encode_statistics(evaluation[2] if len(evaluation) > 2 else None))
+                for evaluation in evaluations
+            ])
+            self.conn.commit()
+        except sqlite3.Error as e:
+            logging.error(f"An error occurred: {e}")
+            self.conn.rollback()
+
+    def load_evaluations(self, optimization_id):
+        try:
+            self.cursor.execute("""
+                SELECT iteration, parameters, fitness, statistics FROM evaluations
+                WHERE optimization_id = ? ORDER BY id
+            """, (optimization_id,))
+            rows = self.cursor.fetchall()
+            return [
+                {'iteration': row['iteration'], 'parameters': json.loads(row['parameters']), 'fitness': row['fitness'], 'statistics': self.decode_statistics(row['statistics'])}
+                for row in rows
+            ]
+        except sqlite3.Error as e:
+            logging.error(f"An error occurred: {e}")
+            return []
+
+    def load_all_evaluations(self):
+        """Every stored evaluation, with the script path and script hash of its optimization"""
+        try:
+            self.cursor.execute("""
+                SELECT e.optimization_id, o.script_path, o.script_hash, e.parameters, e.fitness, e.statistics
+                FROM evaluations e JOIN optimizations o ON e.optimization_id = o.id ORDER BY e.id
+            """)
+            return [
+                {'optimization_id': row['optimization_id'], 'script_path': row['script_path'], 'script_hash': row['script_hash'],
+                 'parameters': json.loads(row['parameters']), 'fitness': row['fitness'], 'statistics': self.decode_statistics(row['statistics'])}
+                for row in self.cursor.fetchall()
+            ]
+        except sqlite3.Error as e:
+            logging.error(f"An error occurred: {e}")
+            return []
+
+    @profiler.timed('storage_write')
+    def save_optimizer_state(self, optimization_id, iteration, state):
+        try:
+            self.cursor.execute("""
+                INSERT OR REPLACE INTO optimizer_states
+                (optimization_id, iteration, state)
+                VALUES (?, ?, ?)
+            """, (optimization_id, iteration, json.dumps(state)))
+            self.conn.commit()
+        except sqlite3.Error as e:
+            logging.error(f"An error occurred: {e}")
+            self.conn.rollback()
+
+    def load_optimizer_state(self, optimization_id):
+        try:
+            self.cursor.execute("""
+                SELECT iteration, state FROM optimizer_states
+                WHERE optimization_id = ? ORDER BY iteration DESC LIMIT 1
+            """, (optimization_id,))
+            row = self.cursor.fetchone()
+            if row:
+                return {'iteration': row['iteration'], 'state': json.loads(row['state'])}
+            return None
+        except sqlite3.Error as e:
+            logging.error(f"An error occurred: {e}")
+            return None
+
+    @profiler.timed('storage_write')
+    def add_job(self, optimization_id, script_path, initial_balance, config, priority=0, status='pending'):
+        """Queues an optimization for the scheduler, config is the JSON serializable job spec
+
+        Runs the scheduler doesn't pick up, like sweeps, are stored with another status.
+        """
+        try:
+            self.cursor.execute("""
+                INSERT INTO optimizations (id, script_path, initial_balance, status, config, priority)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (optimization_id, script_path, initial_balance, status, json.dumps(config), priority))
+            self.conn.commit()
+            return optimization_id
+        except sqlite3.Error as e:
+            logging.error(f"An error occurred: {e}")
+            self.conn.rollback()
+            return None
+
+    def get_jobs(self, statuses=('in_progress', 'pending')):
+        """Queued optimizations with one of the statuses, interrupted ones first, then by priority and age"""
+        try:
+            self.cursor.execute(f"""
+                SELECT id, script_path, initial_balance, status, config, priority, timestamp FROM optimizations
+                WHERE config IS NOT NULL AND status IN ({', '.join('?' * len(statuses))})
+                ORDER BY status = 'in_progress' DESC, priority DESC, timestamp, id
+            """, tuple(statuses))
+            jobs = []
+            for row in self.cursor.fetchall():
+                job = dict(row)
+                job['config'] = json.loads(job['config'])
+                jobs.append(job)
+            return jobs
+        except sqlite3.Error as e:
+            logging.error(f"An error occurred: {e}")
+            return []
+
+    def get_job(self, optimization_id):
+        """Returns a job with its config, None if there is no such job"""
+        try:
+            self.cursor.execute("""
+                SELECT id, script_path, initial_balance, status, config, priority, timestamp FROM optimizations
+                WHERE id = ? AND config IS NOT NULL
+            """, (optimization_id,))
+            row = self.cursor.fetchone()
+            if row:
+                job = dict(row)
+                job['config'] = json.loads(job['config'])
+                return job
+            return None
+        except sqlite3.Error as e:
+            logging.error(f"An error occurred: {e}")
+            return None
+
     def get_all_optimizations(self):
         try:
             self.cursor.execute(
@@ -164,6 +365,14 @@ class Storage:
                 "DELETE FROM iteration_states WHERE optimization_id = ?",
                 (optimization_id,),
             )
+            self.cursor.execute(
+                "DELETE FROM evaluations WHERE optimization_id = ?",
+                (optimization_id,),
+            )
+            self.cursor.execute(
+                "DELETE FROM optimizer_states WHERE optimization_id = ?",
+                (optimization_id,),
+            )
             self.cursor.execute(
                 "DELETE FROM optimizations WHERE id = ?", (optimization_id,)
             )
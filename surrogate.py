@@ -0,0 +1,135 @@
+import logging
+import math
+import random
+from statistics import NormalDist
+
+import numpy as np
+from sklearn.ensemble import RandomForestRegressor
+
+
+class SurrogateFilter:
+    def __init__(self, space, parameter_names, min_observations=50, retrain_every=20, skip_probability=0.9, audit_fraction=0.1, seed=None):
+        """Predicts candidates from past evaluations and skips the ones that are very likely worse than a threshold
+
+        A random forest is retrained on every simulated candidate once retrain_every new ones came in,
+        the spread of its trees' predictions gives the uncertainty of a prediction. A fraction of the
+        candidates that would be skipped is simulated anyway, so the filter can be audited: the skip
+        rate, the prediction error and how often a skipped candidate would have beaten its threshold.
+
+        :param space: The parameter space
+        :param parameter_names: The parameters, in the order of the features
+        :param min_observations: Simulated candidates needed before anything is skipped
+        :param retrain_every: New observations between retraining the forest
+        :param skip_probability: Skip candidates at least this likely to be worse than their threshold
+        :param audit_fraction: Fraction of the skips simulated anyway
+        :param seed: Seed of the forest and the audits
+        """
+        self.space = space
+        self.parameter_names = parameter_names
+        self.min_observations = min_observations
+        self.retrain_every = retrain_every
+        self.skip_probability = skip_probability
+        self.audit_fraction = audit_fraction
+        self.rng = random.Random(seed)
+        self.seed = seed
+
+        self.features = []
+        self.targets = []
+        self.model = None
+        self.trained_on = 0
+        self.predictions = {}  # Feature vector to predicted fitness, until the candidate is observed
+        self.audits = {}  # Feature vector to the threshold it would have been skipped at
+        self.stats = {'screened': 0, 'skipped': 0, 'audited': 0, 'false_skips': 0, 'absolute_error': 0.0, 'errors': 0}
+
+    def encode(self, params):
+        vector = []
+        for param_name in self.parameter_names:
+            param_details = self.space.get(param_name, {})
+            param_type = param_details.get('type')
+            value = params.get(param_name)
+            if param_type in ('payout', 'multiplier'):
+                vector.append(math.log(value))
+            elif param_type in ('radio', 'categorical'):
+                options = list(param_details.get('range', []))
+                vector.append(options.index(value) if value in options else -1)
+            else:
+                vector.append(float(value))
+        return tuple(vector)
+
+    def observe(self, candidates, fitnesses, minimize=True):
+        """Adds simulated candidates to the training data and audits the predictions made for them"""
+        for params, fitness in zip(candidates, fitnesses):
+            if not math.isfinite(fitness):
+                continue
+            features = self.encode(params)
+            predicted = self.predictions.pop(features, None)
+            if predicted is not None:
+                self.stats['absolute_error'] += abs(predicted - fitness)
+                self.stats['errors'] += 1
+            threshold = self.audits.pop(features, None)
+            if threshold is not None and ((fitness < threshold) if minimize else (fitness > threshold)):
+                self.stats['false_skips'] += 1
+            self.features.append(features)
+            self.targets.append(fitness)
+
+        if len(self.targets) >= self.min_observations and len(self.targets) - self.trained_on >= self.retrain_every:
+            self.train()
+
+    def observe_evaluations(self, evaluations):
+        """Seeds the training data with evaluations loaded from Storage.load_evaluations"""
+        self.observe([evaluation['parameters'] for evaluation in evaluations], [evaluation['fitness'] for evaluation in evaluations])
+
+    def train(self):
+        self.model = RandomForestRegressor(n_estimators=50, min_samples_leaf=3, random_state=self.seed)
+        self.model.fit(np.array(self.features), np.array(self.targets))
+        self.trained_on = len(self.targets)
+        logging.debug(f"Surrogate retrained on {self.trained_on} observations")
+
+    def screen(self, candidates, thresholds, minimize=True):
+        """Decides which candidates to skip
+
+        :param candidates: The candidates about to be simulated
+        :param thresholds: The fitness every candidate has to beat to matter, None to always simulate it
+        :param minimize: Whether lower fitness is better
+        :return: The predicted fitness of every skipped candidate, None for the ones to simulate
+        """
+        if self.model is None:
+            return [None] * len(candidates)
+
+        features = [self.encode(params) for params in candidates]
+        tree_predictions = np.array([tree.predict(np.array(features)) for tree in self.model.estimators_])
+        means = tree_predictions.mean(axis=0)
+        spreads = np.maximum(tree_predictions.std(axis=0), 1e-12)
+
+        decisions = []
+        for vector, mean, spread, threshold in zip(features, means, spreads, thresholds):
+            self.stats['screened'] += 1
+            self.predictions[vector] = float(mean)
+            if threshold is None or not math.isfinite(threshold):
+                decisions.append(None)
+                continue
+            below = NormalDist(mean, spread).cdf(threshold)
+            worse_probability = below if not minimize else 1 - below
+            if worse_probability < self.skip_probability:
+                decisions.append(None)
+            elif self.rng.random() < self.audit_fraction:
+                self.stats['audited'] += 1
+                self.audits[vector] = threshold
+                decisions.append(None)
+            else:
+                self.stats['skipped'] += 1
+                self.predictions.pop(vector, None)
+                decisions.append(float(mean))
+        return decisions
+
+    def get_stats(self):
+        screened = self.stats['screened']
+        return {
+            'observations': len(self.targets),
+            'screened': screened,
+            'skipped': self.stats['skipped'],
+            'skip_rate': self.stats['skipped'] / screened if screened else 0.0,
+            'audited': self.stats['audited'],
+            'false_skip_rate': self.stats['false_skips'] / self.stats['audited'] if self.stats['audited'] else None,
+            'mean_absolute_error': self.stats['absolute_error'] / self.stats['errors'] if self.stats['errors'] else None,
+        }
@@ -0,0 +1,263 @@
+import argparse
+import asyncio
+import csv
+import itertools
+import logging
+import math
+import os
+import random
+import time
+
+import numpy as np
+
+from evaluation import EvaluationService, create_backend
+from objectives import get_objective
+from run_spec import configure_service, create_game_results, normalize_spec, read_spec_file
+from script import Script
+from space import build_space, canonicalize
+from storage import Storage
+
+DESIGNS = ['grid', 'lhs']
+
+
+def parameter_values(param_details, levels):
+    """Values of one parameter in a grid: every option, or `levels` evenly spaced values of its range"""
+    if param_details['type'] in ('checkbox', 'radio'):
+        return list(param_details['range'])
+    minimum, maximum = param_details['range']
+    values = [canonicalize({'value': param_details}, {'value': value})['value'] for value in np.linspace(minimum, maximum, levels)]
+    # Values the script can't tell apart, e.g. integers of a short range, are only evaluated once
+    return list(dict.fromkeys(values))
+
+
+def grid_points(parameter_names, space, levels):
+    """Full-factorial design
+
+    :param levels: Values per numeric parameter, an int or a dictionary by parameter name
+    :return: A list of candidates, the last parameter varying fastest
+    """
+    axes = []
+    for param_name in parameter_names:
+        param_levels = levels.get(param_name, 5) if isinstance(levels, dict) else levels
+        axes.append(parameter_values(space[param_name], param_levels))
+    return [dict(zip(parameter_names, values)) for values in itertools.product(*axes)]
+
+
+def latin_hypercube(parameter_names, space, samples, seed=None):
+    """Latin hypercube design: every parameter's range is split in `samples` strata, each sampled once
+
+    Options of checkbox and radio parameters are taken in equal shares.
+    """
+    rng = np.random.default_rng(seed)
+    points = [{} for _ in range(samples)]
+    for param_name in parameter_names:
+        param_details = space[param_name]
+        strata = (rng.permutation(samples) + rng.random(samples)) / samples
+        for point, position in zip(points, strata):
+            if param_details['type'] in ('checkbox', 'radio'):
+                options = list(param_details['range'])
+                point[param_name] = options[min(int(position * len(options)), len(options) - 1)]
+            else:
+                minimum, maximum = param_details['range']
+                point[param_name] = minimum + position * (maximum - minimum)
+    return [canonicalize(space, point) for point in points]
+
+
+class Sweep:
+    def __init__(self, sweep_id, spec, design='grid', levels=5, samples=50, sweep_seed=None, backend=None, storage=None, batch_size=None):
+        """Evaluates every point of a grid or Latin hypercube over a script's space, to see its landscape
+
+        Points are evaluated in batches on the backend and every result is stored as soon as it is
+        known, so an interrupted sweep resumes without evaluating any stored point again.
+
+        :param sweep_id: The id the sweep and its evaluations are stored under
+        :param spec: A normalized run spec, its parameters are the space swept
+        :param design: 'grid' for a full-factorial design or 'lhs' for a Latin hypercube
+        :param levels: Values per numeric parameter of a grid, an int or a dictionary by parameter name
+        :param samples: Points of a Latin hypercube
+        :param sweep_seed: Seed of the Latin hypercube
+        :param batch_size: Points evaluated at the same time, defaults to twice the backend's workers
+        """
+        if design not in DESIGNS:
+            raise ValueError(f"Unknown sweep design: {design}, available: {', '.join(DESIGNS)}")
+        self.optimization_id = sweep_id
+        self.spec = spec
+        self.design = design
+        self.levels = levels
+        self.samples = samples
+        self.sweep_seed = sweep_seed
+        self.storage = storage
+        self.script_obj = Script(spec['script'])
+        self.initial_balance = int(spec['balance'] * 100)
+        self.parameter_names, self.space = build_space(spec['parameters'])
+        self.game_results = create_game_results(spec)
+        # Fitnesses are the objective's own values, ranked in its direction
+        self.maximize = get_objective(spec['objective'] or 'metric').maximize
+        self.service = EvaluationService(self.script_obj, self.initial_balance, self.game_results, backend=backend, storage=storage, optimization_id=sweep_id, cache=True, space=self.space, minimize=not self.maximize, objective=spec['objective'])
+        self.batch_size = batch_size or 2 * self.service.num_workers
+
+    def points(self):
+        if self.design == 'grid':
+            points = grid_points(self.parameter_names, self.space, self.levels)
+        else:
+            points = latin_hypercube(self.parameter_names, self.space, self.samples, self.sweep_seed)
+        unique = {}
+        for point in points:
+            unique.setdefault(self.service.candidate_key(point), point)
+        return list(unique.values())
+
+    async def run(self):
+        """Evaluates the points not stored yet
+
+        :return: A list of (params, fitness) of every point, best first
+        """
+        stored = {}
+        if self.storage is not None:
+            for evaluation in self.storage.load_evaluations(self.optimization_id):
+                stored[self.service.candidate_key(canonicalize(self.space, evaluation['parameters']))] = evaluation['fitness']
+
+        points = self.points()
+        fitnesses = {}
+        pending = []
+        for index, point in enumerate(points):
+            key = self.service.candidate_key(point)
+            if key in stored:
+                fitnesses[key] = stored[key]
+            else:
+                pending.append((index, point))
+        logging.info(f"Sweep {self.optimization_id}: {len(points)} points, {len(points) - len(pending)} already evaluated")
+
+        async def evaluate(index, point):
+            return index, point, await self.service.evaluate(point)
+
+        started = time.time()
+        for start in range(0, len(pending), self.batch_size):
+            batch = pending[start:start + self.batch_size]
+            for task in asyncio.as_completed([evaluate(index, point) for index, point in batch]):
+                index, point, fitness = await task
+                key = self.service.candidate_key(point)
+                fitnesses[key] = fitness
+                # The point's index is stored as its iteration
+                self.service.write(Storage.save_evaluations, self.optimization_id, index, [(point, fitness, self.service.statistics.get(key))])
+            done = min(start + self.batch_size, len(pending))
+            logging.info(f"Sweep {self.optimization_id}: {done}/{len(pending)} points evaluated in {time.time() - started:.1f}s")
+        await self.service.flush()
+
+        results = [(point, fitnesses[self.service.candidate_key(point)]) for point in points]
+        # Failed points are infinite, they come last in either direction
+        return sorted(results, key=lambda result: result[1] if not self.maximize or not math.isfinite(result[1]) else -result[1])
+
+
+def write_csv(path, parameter_names, results):
+    with open(path, 'w', encoding='utf-8', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(list(parameter_names) + ['fitness'])
+        for params, fitness in results:
+            writer.writerow([params.get(param_name) for param_name in parameter_names] + [fitness])
+
+
+def parse_levels(text):
+    """Parses --levels, either '5' or 'payout=10,waitNum=5'"""
+    if '=' not in text:
+        return int(text)
+    levels = {}
+    for part in text.split(','):
+        param_name, _, value = part.partition('=')
+        levels[param_name.strip()] = int(value)
+    return levels
+
+
+def generate_sweep_id(storage):
+    while True:
+        sweep_id = f"sweep_{int(time.time() * 1000)}_{random.randint(1000, 9999)}"
+        if not storage.optimization_exists(sweep_id):
+            return sweep_id
+
+
+def new_sweep_config(args):
+    """The stored config of a new sweep: its run spec, without script and balance, and its design"""
+    if args.spec:
+        config = read_spec_file(args.spec)
+        script_path = config.pop('script', None)
+        balance = config.pop('balance', 10000)
+    elif args.script and args.params:
+        config = {'params': args.params, 'games': args.games, 'sets': args.sets, 'seed': args.seed, 'objective': args.objective}
+        script_path, balance = args.script, args.balance
+    else:
+        raise SystemExit("Start a sweep with --spec, or with --script and --params")
+    normalize_spec(dict(config, script=script_path))
+    # Seeds are fixed now, so a resumed sweep evaluates the same points on the same games
+    if config.get('seed') is None and not config.get('history'):
+        config['seed'] = random.randrange(2 ** 32)
+    config['sweep'] = {
+        'design': args.design,
+        'levels': parse_levels(args.levels),
+        'samples': args.samples,
+        'sweep_seed': args.sweep_seed if args.sweep_seed is not None else random.randrange(2 ** 32),
+    }
+    return script_path, balance, config
+
+
+async def run(args):
+    os.makedirs('logs', exist_ok=True)
+    logging.basicConfig(filename='logs/sweep.log', level=logging.INFO)
+    storage = Storage('optimizations.db')
+    if args.resume:
+        job = storage.get_job(args.resume)
+        if job is None or 'sweep' not in job['config']:
+            raise SystemExit(f"No sweep {args.resume}")
+        sweep_id, script_path, initial_balance, config = job['id'], job['script_path'], job['initial_balance'], job['config']
+    else:
+        script_path, balance, config = new_sweep_config(args)
+        initial_balance = int(balance * 100)
+        sweep_id = storage.add_job(generate_sweep_id(storage), script_path, initial_balance, config, status='sweeping')
+        print(f"Started sweep {sweep_id}, resume it with: python sweep.py --resume {sweep_id}")
+
+    config = dict(config)
+    options = config.pop('sweep')
+    spec = normalize_spec(dict(config, script=script_path, balance=initial_balance / 100))
+    backend = create_backend('process', args.workers) if args.workers > 0 else create_backend('inprocess')
+    sweep = Sweep(sweep_id, spec, options['design'], options['levels'], options['samples'], options['sweep_seed'], backend=backend, storage=storage, batch_size=args.batch_size)
+    # Sweeps seed warm starts of later optimizations of the same script code
+    storage.update_optimization(sweep_id, {'script_hash': sweep.script_obj.content_hash()})
+    configure_service(sweep, spec, storage)
+    try:
+        results = await sweep.run()
+    finally:
+        sweep.service.close()
+        backend.close()
+    storage.update_optimization(sweep_id, {'status': 'swept'})
+    storage.close()
+
+    if args.output:
+        write_csv(args.output, sweep.parameter_names, results)
+        print(f"Saved {len(results)} points in {args.output}")
+    print(f"Best of {len(results)} points:")
+    for params, fitness in results[:args.top]:
+        print(f"  {fitness:.6f}  {params}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Evaluate a grid or Latin hypercube of parameters, in parallel, to see the landscape before optimizing.')
+    parser.add_argument('--resume', metavar='SWEEP_ID', help='Resume an interrupted sweep, the other sweep options are ignored.')
+    parser.add_argument('--spec', help='Run spec file (JSON, TOML or YAML) of the script, space and games, see run_spec.py.')
+    parser.add_argument('--script', help='Path to the JavaScript file.')
+    parser.add_argument('--params', help='Parameters to sweep, in the format of main.py --params.')
+    parser.add_argument('--games', type=int, default=1000, help='Number of games to simulate. Defaults to 1000.')
+    parser.add_argument('--balance', type=float, default=10000, help='Initial balance in bits. Defaults to 10000 bits.')
+    parser.add_argument('--sets', type=int, default=3, help='Number of game sets every point is simulated on. Defaults to 3.')
+    parser.add_argument('--seed', type=int, help='Seed of the game sets. Defaults to a random seed stored with the sweep.')
+    parser.add_argument('--objective', help='Objective used as fitness instead of the default metric, see objectives.py.')
+    parser.add_argument('--design', choices=DESIGNS, default='grid', help='Full-factorial grid or Latin hypercube. Defaults to grid.')
+    parser.add_argument('--levels', default='5', help='Values per numeric parameter of a grid, e.g. 5 or "payout=10,waitNum=5". Defaults to 5.')
+    parser.add_argument('--samples', type=int, default=50, help='Points of a Latin hypercube. Defaults to 50.')
+    parser.add_argument('--sweep-seed', type=int, help='Seed of the Latin hypercube.')
+    parser.add_argument('--workers', type=int, default=0, help='Number of simulation worker processes. Defaults to 0 (simulate in-process).')
+    parser.add_argument('--batch-size', type=int, help='Points evaluated at the same time. Defaults to twice the number of workers.')
+    parser.add_argument('--output', help='Write every point and its fitness to this CSV file.')
+    parser.add_argument('--top', type=int, default=10, help='Number of best points printed. Defaults to 10.')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Telemetry:
+    def __init__(self, window_seconds=60):
+        """Live counters describing a running optimization
+
+        Updated by the optimizers and the worker pool, read by the exporters from their own threads.
+
+        :param window_seconds: The sliding window used for the current throughput rates
+        """
+        self.window_seconds = window_seconds
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.optimizer = None
+            self.optimization_id = None
+            self.start_time = time.time()
+            self.evaluations = 0
+            self.failed_evaluations = 0
+            self.games_simulated = 0
+            self.cache_hits = 0
+            self.cache_misses = 0
+            self.deduplicated = 0
+            self.in_flight = 0
+            self.num_workers = 1
+            self.busy_seconds = 0.0
+            self.worker_busy_seconds = None
+            self.gbest_value = None
+            self.gbest_position = None
+            self.completed = 0
+            self.total = None
+            self.history = deque()
+
+    def start(self, optimizer, optimization_id, total, num_workers=1):
+        self.reset()
+        with self.lock:
+            self.optimizer = optimizer
+            self.optimization_id = optimization_id
+            self.total = total
+            self.num_workers = max(1, num_workers)
+
+    def evaluation_started(self):
+        with self.lock:
+            self.in_flight += 1
+        return time.time()
+
+    def evaluation_finished(self, started, games=0, failed=False):
+        now = time.time()
+        with self.lock:
+            self.in_flight -= 1
+            self.evaluations += 1
+            self.completed += 1
+            self.games_simulated += games
+            self.busy_seconds += now - started
+            if failed:
+                self.failed_evaluations += 1
+            self.history.append((now, self.evaluations, self.games_simulated))
+            while self.history and self.history[0][0] < now - self.window_seconds:
+                self.history.popleft()
+
+    def cache_hit(self):
+        with self.lock:
+            self.cache_hits += 1
+            self.completed += 1
+
+    def cache_miss(self):
+        with self.lock:
+            self.cache_misses += 1
+
+    def evaluation_deduplicated(self):
+        """An evaluation that shared the simulation of an identical candidate already in flight"""
+        with self.lock:
+            self.deduplicated += 1
+            self.completed += 1
+
+    def worker_busy(self, seconds):
+        """Busy time reported by worker processes, preferred over evaluation wall time"""
+        with self.lock:
+            self.worker_busy_seconds = (self.worker_busy_seconds or 0.0) + seconds
+
+    def set_remaining(self, count):
+        """Sets the evaluations left when a budget plans the run again"""
+        with self.lock:
+            self.total = self.completed + count
+
+    def set_gbest(self, value, position):
+        with self.lock:
+            self.gbest_value = value
+            self.gbest_position = position
+
+    def _window_rates(self, now):
+        if len(self.history) < 2:
+            elapsed = now - self.start_time
+            if elapsed <= 0:
+                return 0.0, 0.0
+            return self.evaluations / elapsed, self.games_simulated / elapsed
+        first_time, first_evaluations, first_games = self.history[0]
+        elapsed = max(now - first_time, 1e-9)
+        return (self.evaluations - first_evaluations) / elapsed, (self.games_simulated - first_games) / elapsed
+
+    def snapshot(self):
+        now = time.time()
+        with self.lock:
+            elapsed = now - self.start_time
+            evaluations_per_second, games_per_second = self._window_rates(now)
+            lookups = self.cache_hits + self.cache_misses
+            busy_seconds = self.worker_busy_seconds if self.worker_busy_seconds is not None else self.busy_seconds
+            utilization = busy_seconds / (self.num_workers * elapsed) if elapsed > 0 else 0.0
+            eta = None
+            if self.total is not None and evaluations_per_second > 0:
+                eta = max(0, self.total - self.completed) / evaluations_per_second
+            return {
+                'optimizer': self.optimizer,
+                'optimization_id': self.optimization_id,
+                'elapsed_seconds': elapsed,
+                'evaluations_total': self.evaluations,
+                'failed_evaluations_total': self.failed_evaluations,
+                'games_simulated_total': self.games_simulated,
+                'evaluations_per_second': evaluations_per_second,
+                'games_per_second': games_per_second,
+                'cache_hits_total': self.cache_hits,
+                'cache_misses_total': self.cache_misses,
+                'cache_hit_rate': self.cache_hits / lookups if lookups else 0.0,
+                'deduplicated_evaluations_total': self.deduplicated,
+                'in_flight_evaluations': self.in_flight,
+                'workers': self.num_workers,
+                'worker_utilization': min(1.0, utilization),
+                'gbest_value': self.gbest_value,
+                'gbest_position': self.gbest_position,
+                'progress_completed': self.completed,
+                'progress_total': self.total,
+                'eta_seconds': eta,
+            }
+
+    def to_prometheus(self):
+        snapshot = self.snapshot()
+        labels = f'optimizer="{snapshot["optimizer"]}",optimization_id="{snapshot["optimization_id"]}"'
+        lines = []
+        for key, value in snapshot.items():
+            if key in ('optimizer', 'optimization_id', 'gbest_position') or value is None:
+                continue
+            name = f"hyperopt_{key}"
+            metric_type = 'counter' if key.endswith('_total') else 'gauge'
+            lines.append(f"# TYPE {name} {metric_type}")
+            lines.append(f"{name}{{{labels}}} {float(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class PrometheusFileExporter:
+    def __init__(self, telemetry, file_path, interval=15):
+        """Periodically rewrites a Prometheus text file, e.g. for the node exporter textfile collector"""
+        self.telemetry = telemetry
+        self.file_path = file_path
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def write(self):
+        temp_path = f"{self.file_path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            file.write(self.telemetry.to_prometheus())
+        # Replace atomically so scrapers never see a half written file
+        os.replace(temp_path, self.file_path)
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                logging.error(f"Could not write metrics file {self.file_path}: {e}")
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        self.write()
+
+
+class HttpExporter:
+    def __init__(self, telemetry, port, host='127.0.0.1'):
+        """Serves the metrics in Prometheus format on /metrics and as JSON on /json"""
+        self.telemetry = telemetry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path == '/metrics':
+                    body, content_type = telemetry.to_prometheus(), 'text/plain; version=0.0.4'
+                elif handler.path == '/json':
+                    body, content_type = json.dumps(telemetry.snapshot(), default=str), 'application/json'
+                else:
+                    handler.send_error(404)
+                    return
+                handler.send_response(200)
+                handler.send_header('Content-Type', content_type)
+                handler.end_headers()
+                handler.wfile.write(body.encode())
+
+            def log_message(handler, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+
+telemetry = Telemetry()
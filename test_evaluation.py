@@ -0,0 +1,301 @@
+import asyncio
+import math
+import os
+import signal
+import tempfile
+import unittest
+from analytic import estimate, longest_streak_probability, win_probability
+from budget import Budget, parse_budget
+from cluster import ClusterBackend, start_local_workers
+from evaluation import EvaluationService, run_ask_tell
+from metrics import Statistics
+from objectives import get_objective, pareto_front
+from scheduler import SharedBackend
+from storage import Storage
+from simulator import GameResults
+from script import Script
+from run_spec import normalize_spec
+from space import canonicalize
+from sweep import Sweep, latin_hypercube
+from optimizer import Optimizer
+from ps_optimizer import PSOptimizer
+from warm_start import find_warm_start, matching_evaluations
+
+
+class CountingBackend:
+    def __init__(self):
+        self.num_workers = 1
+        self.calls = 0
+
+    async def evaluate(self, script_obj, initial_balance, game_results, params):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        raise ValueError("Not simulated")
+
+    def close(self):
+        pass
+
+
+class RecordingBackend:
+    def __init__(self):
+        self.num_workers = 1
+        self.order = []
+
+    async def evaluate(self, script_obj, initial_balance, game_results, params, sequential=None):
+        self.order.append(params)
+        await asyncio.sleep(0.01)
+        return params
+
+    def close(self):
+        pass
+
+
+class RandomSwarm:
+    def __init__(self, size):
+        self.size = size
+        self.max_iter = 100
+
+    def ask(self):
+        return [{'payout': 1.5 + 1.5 * index / self.size} for index in range(self.size)]
+
+    def tell(self, candidates, fitnesses):
+        pass
+
+    def resize(self, size):
+        self.size = size
+
+
+class TestEvaluationService(unittest.TestCase):
+    def setUp(self):
+        self.space = {
+            'baseBet': {'range': (1, 10000), 'type': 'balance'},
+            'payout': {'range': (1.5, 3.0), 'type': 'payout'},
+        }
+
+    def test_canonicalize_quantizes_to_resolution(self):
+        self.assertEqual(canonicalize(self.space, {'baseBet': 149.9, 'payout': 2.004}), {'baseBet': 100, 'payout': 2.0})
+        self.assertEqual(canonicalize(self.space, {'baseBet': 20000, 'payout': 1.0}), {'baseBet': 10000, 'payout': 1.5})
+
+    def test_identical_candidates_share_one_simulation(self):
+        backend = CountingBackend()
+        service = EvaluationService(Script('scripts/example.js'), 1000000, GameResults(1.98, 1, 10), backend=backend, space=self.space)
+        candidates = [{'baseBet': 100, 'payout': 2.0}, {'baseBet': 120, 'payout': 2.001}, {'baseBet': 200, 'payout': 2.0}]
+        fitnesses = asyncio.run(service.evaluate_all(candidates))
+        self.assertEqual(fitnesses, [float('inf')] * 3)
+        self.assertEqual(backend.calls, 2)
+        self.assertEqual(service.get_stats()['deduplicated'], 1)
+
+    def test_shared_backend_hands_workers_out_by_priority(self):
+        backend = RecordingBackend()
+        shared = SharedBackend(backend, policy='priority')
+        low, high = shared.for_job('low', 0), shared.for_job('high', 1)
+
+        async def run():
+            requests = [low.evaluate(None, 0, None, 'low 1'), low.evaluate(None, 0, None, 'low 2'), high.evaluate(None, 0, None, 'high 1')]
+            return await asyncio.gather(*requests)
+
+        self.assertEqual(asyncio.run(run()), ['low 1', 'low 2', 'high 1'])
+        self.assertEqual(backend.order, ['low 1', 'high 1', 'low 2'])
+        self.assertEqual(shared.free, 1)
+
+    def test_cluster_ships_game_sets_once_per_worker(self):
+        with tempfile.TemporaryDirectory() as directory:
+            address = os.path.join(directory, 'cluster.sock')
+            backend = ClusterBackend(address, 'test', num_workers=1)
+            processes = start_local_workers(address, 'test', 1)
+            try:
+                self.assertEqual(backend.wait_for_workers(timeout=60), 1)
+                script, game_results = Script('scripts/example.js'), GameResults(1.98, 2, 50, seed=1)
+
+                async def run():
+                    return await asyncio.gather(*(backend.evaluate(script, 1000000, game_results, {'payout': payout}) for payout in (2.0, 3.0)))
+
+                results = asyncio.run(run())
+                self.assertIsInstance(results[0][0], Statistics)
+                self.assertEqual(len(backend.workers[0].contexts), 1)
+            finally:
+                backend.close()
+                for process in processes:
+                    process.join(timeout=5)
+
+    def test_cluster_dispatches_the_evaluation_of_a_lost_worker_again(self):
+        with tempfile.TemporaryDirectory() as directory:
+            address = os.path.join(directory, 'cluster.sock')
+            backend = ClusterBackend(address, 'test', num_workers=2, heartbeat_timeout=2)
+            processes = start_local_workers(address, 'test', 2)
+            try:
+                self.assertEqual(backend.wait_for_workers(timeout=60), 2)
+                script, game_results = Script('scripts/example.js'), GameResults(1.98, 1, 50000, seed=1)
+
+                async def kill_worker_mid_evaluation():
+                    evaluation = asyncio.ensure_future(backend.evaluate(script, 1000000, game_results, {'waitNum': 1000000}))
+                    # The script never bets, so the simulation plays every game. Idle workers are handed out in the order they joined
+                    await asyncio.sleep(1)
+                    os.kill(backend.workers[0].pid, signal.SIGKILL)
+                    return await evaluation
+
+                result = asyncio.run(kill_worker_mid_evaluation())
+                self.assertEqual(result[0].games_total, 50000)
+                self.assertEqual((backend.lost_workers, backend.redispatched), (1, 1))
+                self.assertEqual(backend.workers[1].total_evaluations, 1)
+
+                # Without any worker left, evaluations fail instead of waiting forever
+                os.kill(backend.workers[1].pid, signal.SIGKILL)
+                processes[1].join(timeout=5)
+                with self.assertRaises(Exception):
+                    asyncio.run(backend.evaluate(script, 1000000, game_results, {'payout': 3.0}))
+            finally:
+                backend.close()
+                for process in processes:
+                    process.join(timeout=5)
+
+
+    def test_analytic_estimate_of_declared_structure(self):
+        busts = [game['bust'] for game in GameResults.__new__(GameResults).generate_games('ab' * 32, 20000)]
+        self.assertAlmostEqual(win_probability(2.0), sum(bust >= 2.0 for bust in busts) / len(busts), delta=0.02)
+        estimated = estimate(Script('scripts/example.js'), {'payout': 2.5, 'waitNum': 3}, 1000000, 500)
+        self.assertGreater(estimated['expected_played'], 0)
+        self.assertLess(estimated['ruin_probability'], 0.1)
+
+
+    def test_prescreen_compares_estimates_on_the_objective_scale(self):
+        params = {'payout': 2.5, 'waitNum': 3}
+        estimated = estimate(Script('scripts/example.js'), params, 1000000, 500)
+        for minimize in (True, False):
+            service = EvaluationService(Script('scripts/example.js'), 1000000, GameResults(1.98, 1, 500, seed=1), minimize=minimize, objective='profit')
+            service.enable_prescreen()
+            fitness = get_objective('profit').oriented(estimated['expected_statistics_profit'], minimize)
+            # An incumbent with the same oriented profit isn't beaten by much, the candidate is simulated
+            service.incumbent = fitness
+            self.assertIsNone(service.screen(params))
+            # A much better incumbent skips it with its oriented profit as fitness
+            service.incumbent = fitness - 2 * abs(fitness) - 1 if minimize else fitness + 2 * abs(fitness) + 1
+            self.assertEqual(service.screen(params), fitness)
+
+        # A wait streak that practically never happens means no bet is ever placed
+        win = win_probability(2.5)
+        self.assertAlmostEqual(longest_streak_probability(win, 3, 2), (1 - win) ** 2 + win * (1 - win) ** 2)
+        self.assertGreater(estimated['bet_probability'], 0.99)
+        never_bets = {'payout': 2.5, 'waitNum': 60}
+        self.assertLess(estimate(Script('scripts/example.js'), never_bets, 1000000, 500)['bet_probability'], 1e-6)
+        self.assertEqual(service.screen(never_bets), 0)
+        service = EvaluationService(Script('scripts/example.js'), 1000000, GameResults(1.98, 1, 500, seed=1))
+        service.enable_prescreen()
+        self.assertEqual(service.screen(never_bets), float('inf'))
+        self.assertIsNone(service.screen(params))
+
+        # Objectives the estimates don't cover are never compared
+        service = EvaluationService(Script('scripts/example.js'), 1000000, GameResults(1.98, 1, 500, seed=1), objective='drawdown')
+        service.enable_prescreen()
+        service.incumbent = -1e12
+        self.assertIsNone(service.screen(params))
+
+
+    def test_stored_statistics_rank_by_any_objective(self):
+        with tempfile.TemporaryDirectory() as directory:
+            storage = Storage(os.path.join(directory, 'test.db'))
+            storage.save_optimization({
+                'optimization_id': 'opt', 'script_obj': Script('scripts/example.js'), 'initial_balance': 1000, 'num_particles': 3, 'max_iter': 1,
+                'c1': None, 'c2': None, 'w': None, 'damping': None, 'gbest_value': None, 'gbest_position': {}, 'status': 'completed', 'current_iteration': 1,
+            })
+            evaluations = []
+            for profit, atl in ((100, -50), (200, -500), (50, -400)):
+                statistics = Statistics(1000).get_statistics()
+                statistics.update(profit=profit, profit_atl=atl, total_wagered=1000, games_played=10)
+                evaluations.append(({'payout': profit / 100}, 0.0, {'mean': statistics, 'sets': [statistics]}))
+            storage.save_evaluations('opt', 0, evaluations)
+            loaded = storage.load_evaluations('opt')
+            storage.close()
+        self.assertEqual(loaded[1]['statistics']['mean']['profit'], 200)
+        self.assertAlmostEqual(get_objective('metric')(loaded[0]['statistics']['mean']), 100 / 100)
+        front = pareto_front(loaded, [get_objective('profit'), get_objective('drawdown')])
+        self.assertEqual(sorted(values[0] for values, _ in front), [100, 200])
+
+    def test_pso_maximizes_a_maximized_objective(self):
+        script_obj = Script(os.path.abspath('scripts/example.js'))
+        space = {'payout': {'range': (1.1, 10.0), 'type': 'payout'}}
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            try:
+                optimizer = PSOptimizer(script_obj, 1000000, GameResults(1.98, 2, 200, seed=1), ['payout'], space)
+                optimizer.num_particles, optimizer.max_iter = 6, 3
+                optimizer.initialize_particles()
+                optimizer.service.objective = get_objective('profit')
+                asyncio.run(optimizer.optimize())
+                optimizer.service.close()
+                optimizer.storage.close()
+            finally:
+                os.chdir(cwd)
+        profits = {key: statistics['mean']['profit'] for key, statistics in optimizer.service.statistics.items() if statistics['mean']['balance'] != 0}
+        best_key = optimizer.service.candidate_key(optimizer.service.canonicalize(optimizer.gbest_position))
+        # The fitness is the negated profit, so the minimizing swarm keeps the most profitable position
+        self.assertEqual(profits[best_key], max(profits.values()))
+        self.assertEqual(optimizer.gbest_value, -max(profits.values()))
+
+    def test_sweep_resumes_without_evaluating_stored_points(self):
+        spec = normalize_spec({'script': 'scripts/example.js', 'params': 'payout:payout,1.5,3;waitNum:integer,1,3', 'games': 100, 'sets': 1, 'seed': 1})
+        with tempfile.TemporaryDirectory() as directory:
+            storage = Storage(os.path.join(directory, 'test.db'))
+            storage.add_job('sweep', spec['script'], 1000000, {}, status='sweeping')
+            sweep = Sweep('sweep', spec, levels={'payout': 3, 'waitNum': 5}, storage=storage)
+            results = asyncio.run(sweep.run())
+            self.assertEqual(len(results), 9)
+            # The metric is maximized, so the best point comes first
+            finite = [fitness for _, fitness in results if math.isfinite(fitness)]
+            self.assertEqual(finite, sorted(finite, reverse=True))
+            storage.cursor.execute("DELETE FROM evaluations WHERE iteration >= 6")
+            storage.conn.commit()
+            resumed = Sweep('sweep', spec, levels={'payout': 3, 'waitNum': 5}, storage=storage)
+            self.assertEqual(asyncio.run(resumed.run()), results)
+            self.assertEqual(resumed.service.get_stats()['simulated'], 3)
+            sweep.service.close()
+            resumed.service.close()
+            storage.close()
+
+        points = latin_hypercube(['payout', 'flag'], {'payout': {'range': (1.0, 2.0), 'type': 'number'}, 'flag': {'range': [True, False], 'type': 'checkbox'}}, 10, seed=1)
+        self.assertEqual(sorted(int((point['payout'] - 1.0) * 10) for point in points), list(range(10)))
+        self.assertEqual(sum(point['flag'] for point in points), 5)
+
+    def test_warm_start_remaps_the_best_stored_evaluations(self):
+        script_obj = Script('scripts/example.js')
+        with tempfile.TemporaryDirectory() as directory:
+            storage = Storage(os.path.join(directory, 'test.db'))
+            storage.save_optimization({
+                'optimization_id': 'opt', 'script_obj': script_obj, 'initial_balance': 1000, 'num_particles': 3, 'max_iter': 1,
+                'c1': None, 'c2': None, 'w': None, 'damping': None, 'gbest_value': None, 'gbest_position': {}, 'status': 'completed', 'current_iteration': 1,
+            })
+            storage.save_evaluations('opt', 0, [({'payout': 4.0}, 1.0), ({'payout': 2.5}, 3.0), ({'payout': 2.504}, 2.0), ({'payout': 1.2}, float('inf'))])
+            space = {'payout': {'range': (1.5, 3.0), 'type': 'payout'}, 'baseBet': {'range': (1, 10000), 'type': 'balance'}}
+            evaluations = matching_evaluations(storage, script_obj, ['payout', 'baseBet'], space)
+            storage.close()
+        # Clamped into the new range, the new parameter takes the script's default of 1 bit, rounded to the resolution of 100
+        self.assertEqual(find_warm_start(evaluations, 2), [({'payout': 3.0, 'baseBet': 1}, 1.0), ({'payout': 2.5, 'baseBet': 1}, 2.0)])
+        self.assertEqual(find_warm_start(evaluations, 1, minimize=False), [({'payout': 2.5, 'baseBet': 1}, 3.0)])
+
+        optimizer = Optimizer(script_obj, 1000000, GameResults(1.98, 1, 10), ['payout', 'baseBet'], space)
+        optimizer.warm_start([params for params, _ in find_warm_start(evaluations, 2)])
+        self.assertEqual(optimizer.ask()[:2], [{'payout': 3.0, 'baseBet': 1}, {'payout': 2.5, 'baseBet': 1}])
+
+    def test_budget_resizes_the_swarm_and_stops_within_its_games(self):
+        self.assertEqual((parse_budget('2h').seconds, parse_budget('2h').games), (7200, None))
+        self.assertEqual((parse_budget('90 minutes, 50M games').seconds, parse_budget('90 minutes, 50M games').games), (5400, 50000000))
+        with self.assertRaises(ValueError):
+            parse_budget('50')
+
+        service = EvaluationService(Script('scripts/example.js'), 1000000, GameResults(1.98, 1, 100, seed=1), space={'payout': {'range': (1.5, 3.0), 'type': 'payout'}})
+        service.enable_budget(Budget(games=5000))
+        swarm = RandomSwarm(10)
+        asyncio.run(run_ask_tell(swarm, service, 0, swarm.max_iter))
+        report = service.budget.report(service)
+        # Two iterations of 10 candidates of 100 games measure the cost, the 3000 games left can't afford 98 more of any swarm
+        self.assertEqual(swarm.size, 5)
+        self.assertEqual(report['stop_reason'], 'games')
+        self.assertLessEqual(report['games_used'], 5000)
+        self.assertGreater(report['games_used'], 5000 - 5 * 100)
+        self.assertEqual(swarm.max_iter, report['iterations'])
+        service.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
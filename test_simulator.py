@@ -1,7 +1,18 @@
 import asyncio
+import os
+import tempfile
+import time
 import unittest
+
+import numpy as np
+from metrics import Statistics
 from simulator import Simulator, GameResults
+from bust_index import bust_index
 from script import Script
+from main_sim_single import replay, save_columns
+from history_store import GameStore, verify, verify_range
+from walk_forward import rolling_windows, train_validate_splits
+from profiling import Profiler, build_report
 
 class TestSimulator(unittest.TestCase):
     def setUp(self):
@@ -11,22 +22,148 @@ class TestSimulator(unittest.TestCase):
 
     def test_run_single_simulation(self):
         initial_balance = 1000000
-        set_index = 0
-        result = asyncio.run(self.simulator.run_single_simulation(initial_balance, self.game_results, set_index))
-        self.assertIsNotNone(result[0])
-        self.assertIsNotNone(result[1])
+        game_set = self.game_results.result_sets[0]
+        result = asyncio.run(self.simulator.run_single_simulation(initial_balance, game_set, {}))
+        self.assertIsInstance(result[0], Statistics)
+        self.assertEqual(result[0].games_total, len(game_set))
 
     def test_run(self):
         initial_balance = 1000000
-        result = asyncio.run(self.simulator.run(initial_balance, self.game_results))
-        self.assertIsNotNone(result["config"])
-        self.assertIsNotNone(result["results"])
-        self.assertIsNotNone(result["output"])
-        print(result["config"])
-        print(result["results"])
-        print(result["output"])
-        
-simulator = TestSimulator()
-simulator.setUp()
-# simulator.test_run_single_simulation()
-simulator.test_run()
+        result = asyncio.run(self.simulator.run(initial_balance, self.game_results, {'payout': 2.5}))
+        self.assertIsInstance(result[0], Statistics)
+        self.assertEqual(result[0].games_total, 100)
+        self.assertEqual(len(result[1]), 3)
+
+    def test_run_sequential_adds_sets_from_the_bank(self):
+        game_results = GameResults(1.98, 2, 100, seed=1, bank_size=4)
+        result = asyncio.run(self.simulator.run_sequential(1000000, game_results, {}, max_sets=3))
+        self.assertEqual(len(result[1]), 3)
+        result = asyncio.run(self.simulator.run_sequential(1000000, game_results, {}, incumbent=1e9))
+        self.assertEqual(len(result[1]), 2)
+        # With an objective, sets are compared on its value turned to the optimizer's direction, not on the metric
+        first_sets = asyncio.run(self.simulator.run_sequential(1000000, game_results, {'payout': 3}, max_sets=2))[1]
+        incumbent = -sum(statistics.profit for statistics in first_sets) / 2
+        result = asyncio.run(self.simulator.run_sequential(1000000, game_results, {'payout': 3}, incumbent=incumbent, objective='profit', minimize=True))
+        self.assertEqual(len(result[1]), 4)
+
+    def test_profile_of_concurrent_evaluations_adds_up_to_wall_time(self):
+        profiler = Profiler()
+        profiler.enable()
+
+        async def evaluate():
+            with profiler.phase('evaluation'):
+                await asyncio.sleep(0.05)
+                with profiler.phase('event_dispatch'):
+                    with profiler.phase('js_callbacks'):
+                        time.sleep(0.02)
+
+        async def evaluate_all():
+            await asyncio.gather(*[evaluate() for _ in range(4)])
+
+        started = time.perf_counter()
+        asyncio.run(evaluate_all())
+        elapsed = time.perf_counter() - started
+        report = build_report(profiler.snapshot())
+        self.assertLessEqual(report['wall_seconds'], elapsed)
+        # Four overlapping evaluations take about four times the wall time, their self times don't
+        self.assertGreater(report['phases']['evaluation']['seconds'], 2 * report['wall_seconds'])
+        self.assertAlmostEqual(sum(phase['percent'] for phase in report['phases'].values()), 100)
+        # The callbacks' time isn't counted again as event dispatch
+        self.assertGreaterEqual(report['phases']['js_callbacks']['self_seconds'], 0.08)
+        self.assertLess(report['phases']['event_dispatch']['self_seconds'], 0.01)
+
+    def test_bust_index_matches_a_game_by_game_count(self):
+        game_set = self.game_results.result_sets[0]
+        index = bust_index(game_set)
+        since, expected = 0, []
+        for game in game_set:
+            expected.append(since)
+            since = since + 1 if game['bust'] < 2.5 else 0
+        self.assertEqual(list(index.since(2.5)), expected)
+        self.assertEqual(index.count_at_least(2.5), sum(game['bust'] >= 2.5 for game in game_set))
+        self.assertIs(bust_index(game_set), index)
+
+    def test_content_hash_identifies_game_sets(self):
+        self.assertEqual(self.game_results.content_hash(), self.game_results.content_hash())
+        self.assertNotEqual(self.game_results.content_hash(), GameResults(1.98, 3, 100).content_hash())
+
+    def test_seeded_bank_is_reproducible(self):
+        for selection in ('random', 'stratified', 'antithetic'):
+            game_results = GameResults(1.98, 3, 100, seed=1, bank_size=8, selection=selection)
+            self.assertEqual(game_results.content_hash(), GameResults(1.98, 3, 100, seed=1, bank_size=8, selection=selection).content_hash())
+            self.assertEqual(len({id(game_set) for game_set in game_results.result_sets}), 3)
+    def test_windows_of_a_single_pass_add_up(self):
+        game_set = GameResults(1.98, 1, 600, seed=2).result_sets[0]
+        windows = rolling_windows(600, 200) + [(100, 300), (0, 600)]
+        whole, results = asyncio.run(self.simulator.run_windows(1000000, game_set, {'payout': 2.0}, windows))
+        self.assertEqual(whole.games_total, 600)
+        self.assertEqual(results[(0, 600)].get_statistics(), whole.get_statistics())
+        self.assertAlmostEqual(sum(results[window].profit for window in rolling_windows(600, 200)), whole.profit)
+        self.assertEqual(results[(100, 300)].games_total, 200)
+        self.assertEqual(train_validate_splits(600, 300, 100), [((0, 300), (300, 400)), ((100, 400), (400, 500)), ((200, 500), (500, 600))])
+
+    def test_bankrolls_share_one_simulation(self):
+        game_results = GameResults(1.98, 2, 1000, seed=5)
+        balances = [20000, 10000000, 100000000]
+        params = {'baseBet': 100, 'payout': 2.0, 'waitNum': 2}
+        self.assertFalse(self.simulator.balance_dependent())
+        shared = asyncio.run(self.simulator.run_bankrolls(balances, game_results, params))
+        for initial_balance, (_, set_statistics) in zip(balances, shared):
+            for game_set, statistics in zip(game_results.result_sets, set_statistics):
+                expected, _ = asyncio.run(self.simulator.run_single_simulation(initial_balance, game_set, params))
+                self.assertEqual(statistics.get_statistics(), expected.get_statistics())
+        self.assertIsNone(shared[0][0])
+        # Bankrolls that can't afford the first bet fail like their own simulations do
+        params = {'baseBet': 1000, 'payout': 2.0, 'waitNum': 0}
+        expected, _ = asyncio.run(self.simulator.run_single_simulation(20000, game_results.result_sets[0], params))
+        self.assertEqual(expected.balance, 0)
+        for _, set_statistics in asyncio.run(self.simulator.run_bankrolls([20000, 50000], game_results, params)):
+            self.assertEqual([statistics.balance for statistics in set_statistics], [0, 0])
+        self.script.structure = dict(self.script.structure, uses_balance=True)
+        self.assertTrue(self.simulator.balance_dependent())
+
+    def test_imported_history_verifies_and_simulates(self):
+        game_set = GameResults(1.98, 1, 300, seed=3).result_sets[0]
+        with tempfile.TemporaryDirectory() as directory:
+            db_path = os.path.join(directory, 'games.db')
+            store = GameStore(db_path)
+            self.assertEqual(store.import_games((1000 + index, game['hash'], game['bust']) for index, game in enumerate(game_set)), 300)
+            self.assertEqual(store.get_by_hash(game_set[5]['hash'])['id'], 1005)
+            game_results = store.game_results([(1000, 1100), (1100, 1300)])
+            self.assertEqual([len(s) for s in game_results.result_sets], [100, 200])
+            self.assertEqual([game['bust'] for game in game_results.result_sets[1]], [game['bust'] for game in game_set[100:]])
+            store.cursor.execute("UPDATE games SET bust = bust + 1 WHERE id = 1042")
+            store.conn.commit()
+            store.close()
+
+            result = verify_range(db_path, 1000, 1300)
+            self.assertEqual((result['checked'], result['missing'], result['broken_link_count']), (300, 0, 0))
+            self.assertEqual(result['wrong_busts'], [1042])
+
+            # A gap crossing chunk boundaries is missing whatever the chunks, chunk 1010-1015 has no game at all
+            store = GameStore(db_path)
+            store.cursor.execute("DELETE FROM games WHERE id >= 1008 AND id < 1017")
+            store.conn.commit()
+            store.close()
+            for chunk_size in (5, 100):
+                self.assertEqual(verify(db_path, workers=1, chunk_size=chunk_size, check_busts=False)['missing'], 9)
+
+    def test_replays_save_statistics_and_traces_as_columns(self):
+        hash_value = 'cd' * 32
+        trace = []
+        statistics = asyncio.run(replay(self.simulator, 1000000, hash_value, 200, {'payout': 2.0}, trace))
+        self.assertEqual(len(trace), 200)
+        self.assertEqual(trace[-1][0], GameResults.generate_games(hash_value, 1)[0]['bust'])
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'replays.npz')
+            save_columns(path, [(hash_value, statistics.get_statistics(), statistics.get_metric(), '', trace), ('ef' * 32, None, float('nan'), 'error', None)])
+            columns = np.load(path)
+            self.assertEqual(list(columns['hash']), [hash_value, 'ef' * 32])
+            self.assertEqual(list(columns['failed']), [False, True])
+            self.assertEqual(columns['profit'][0], statistics.profit)
+            self.assertEqual(len(columns['trace_row']), 200)
+            net = sum(wager * (cashed_at - 1) if cashed_at else -wager for _, wager, cashed_at, _ in trace if wager is not None)
+            self.assertAlmostEqual(columns['trace_balance'][-1], 1000000 + net)
+
+if __name__ == '__main__':
+    unittest.main()
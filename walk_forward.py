@@ -0,0 +1,104 @@
+import argparse
+import asyncio
+import json
+
+from metrics import mean_and_standard_error
+from script import Script
+from simulator import GameResults, Simulator
+from storage import Storage
+
+
+def rolling_windows(num_games, window, stride=None):
+    """Windows of `window` games every `stride` games (default: back to back), as (start, end) with end excluded"""
+    stride = stride or window
+    return [(start, start + window) for start in range(0, num_games - window + 1, stride)]
+
+
+def train_validate_splits(num_games, train, validate, anchored=False):
+    """Walk-forward splits: train on `train` games, validate on the `validate` games after them, move forward by `validate`
+
+    :param anchored: Train windows all start at the first game and grow, instead of rolling forward
+    :return: A list of (train window, validate window)
+    """
+    splits = []
+    start = 0
+    while start + train + validate <= num_games:
+        splits.append(((0 if anchored else start, start + train), (start + train, start + train + validate)))
+        start += validate
+    return splits
+
+
+async def walk_forward(simulator, initial_balance, game_set, script_params, splits):
+    """Evaluates every split with a single simulation of the game set
+
+    :return: The statistics of the whole set and a list of (train statistics, validate statistics)
+    """
+    windows = [window for split in splits for window in split]
+    whole, results = await simulator.run_windows(initial_balance, game_set, script_params, windows)
+    return whole, [(results.get(train), results.get(validate)) for train, validate in splits]
+
+
+def summarize(window_statistics):
+    """Mean metric with its standard error, and the share of windows that made a profit"""
+    metrics = [statistics.get_metric() for statistics in window_statistics if statistics.balance != 0]
+    mean, standard_error = mean_and_standard_error(metrics)
+    profitable = sum(statistics.profit > 0 for statistics in window_statistics if statistics.balance != 0)
+    return {
+        'windows': len(window_statistics),
+        'failed': sum(statistics.balance == 0 for statistics in window_statistics),
+        'mean_metric': mean,
+        'standard_error': standard_error,
+        'profitable_share': profitable / len(window_statistics) if window_statistics else 0.0,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Check parameters out of sample on rolling windows or walk-forward splits of one long chain of games, simulated once.')
+    parser.add_argument('--script', required=True, help='Path to the JavaScript file.')
+    parser.add_argument('--params', help='Parameters as JSON, e.g. \'{"payout": 2.5}\'.')
+    parser.add_argument('--optimization', help='Use the best parameters of this stored optimization.')
+    parser.add_argument('--balance', type=float, default=10000, help='Initial balance in bits. Defaults to 10000 bits.')
+    parser.add_argument('--games', type=int, default=100000, help='Length of the chain of games. Defaults to 100000.')
+    parser.add_argument('--seed', type=int, help='Seed of the chain.')
+    parser.add_argument('--window', type=int, default=1000, help='Games per rolling window. Defaults to 1000.')
+    parser.add_argument('--stride', type=int, help='Games between the starts of rolling windows. Defaults to --window.')
+    parser.add_argument('--train', type=int, help='Games per train window, evaluates walk-forward splits instead of rolling windows.')
+    parser.add_argument('--validate', type=int, default=1000, help='Games per validate window of a split. Defaults to 1000.')
+    parser.add_argument('--anchored', action='store_true', help='Train windows all start at the first game.')
+    args = parser.parse_args()
+
+    if args.optimization:
+        storage = Storage('optimizations.db')
+        optimization = storage.load_optimization(args.optimization)
+        storage.close()
+        if optimization is None:
+            raise SystemExit(f"No saved optimization {args.optimization}")
+        script_params = optimization['gbest_position']
+    else:
+        script_params = json.loads(args.params) if args.params else {}
+
+    simulator = Simulator(Script(args.script))
+    game_set = GameResults(1.98, 1, args.games, seed=args.seed).result_sets[0]
+    initial_balance = int(args.balance * 100)
+
+    if args.train:
+        splits = train_validate_splits(args.games, args.train, args.validate, args.anchored)
+        whole, results = await walk_forward(simulator, initial_balance, game_set, script_params, splits)
+        for (train, validate), (train_statistics, validate_statistics) in zip(splits, results):
+            train_metric = train_statistics.get_metric() if train_statistics else None
+            validate_metric = validate_statistics.get_metric() if validate_statistics else None
+            print(f"train {train[0]}-{train[1]}: {train_metric}  validate {validate[0]}-{validate[1]}: {validate_metric}")
+        print(f"Train: {summarize([train for train, _ in results if train is not None])}")
+        print(f"Validate: {summarize([validate for _, validate in results if validate is not None])}")
+    else:
+        windows = rolling_windows(args.games, args.window, args.stride)
+        whole, results = await simulator.run_windows(initial_balance, game_set, script_params, windows)
+        for window in windows:
+            if window in results:
+                print(f"{window[0]}-{window[1]}: metric {results[window].get_metric()}, profit {results[window].profit / 100} bits")
+        print(f"Windows: {summarize([results[window] for window in windows if window in results])}")
+    print(f"Whole chain: metric {whole.get_metric()}, profit {whole.profit / 100} bits")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
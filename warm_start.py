@@ -0,0 +1,111 @@
+import math
+import os
+
+from objectives import get_objective
+from space import canonicalize
+
+
+def script_default(script_obj, param_name):
+    """The script's default value of a parameter, in the units of candidates, None if it has none"""
+    param_config = script_obj.config.get(param_name) if script_obj is not None else None
+    if not isinstance(param_config, dict) or param_config.get('value') is None:
+        return None
+    # Candidates hold balances in bits, see Script.get_config
+    return param_config['value'] / 100 if param_config.get('type') == 'balance' else param_config['value']
+
+
+def remap(params, parameter_names, space, script_obj=None):
+    """Maps a stored candidate into a space whose ranges or parameters may have changed
+
+    Values are clamped to the new ranges and quantized to their resolutions. Parameters the
+    candidate doesn't have, or options that no longer exist, take the script's default value.
+
+    :return: The candidate in the new space, None if a parameter has neither a value nor a default
+    """
+    remapped = {}
+    for param_name in parameter_names:
+        param_details = space[param_name]
+        value = params.get(param_name)
+        if param_details['type'] in ('checkbox', 'radio'):
+            options = list(param_details['range'])
+            if value not in options:
+                value = script_default(script_obj, param_name)
+                if value not in options:
+                    return None
+        else:
+            if not isinstance(value, (int, float)) or isinstance(value, bool) or not math.isfinite(value):
+                value = script_default(script_obj, param_name)
+                if value is None:
+                    return None
+            minimum, maximum = param_details['range']
+            value = max(min(value, maximum), minimum)
+        remapped[param_name] = value
+    return canonicalize(space, remapped)
+
+
+def matches(evaluation, script_obj, parameter_names):
+    """Whether an evaluation can seed an optimization of the script
+
+    Evaluations of the same script code always match. Others match when they come from the same
+    script file, e.g. before a small edit, or when they have every parameter being optimized.
+    """
+    if evaluation['script_hash'] is not None and evaluation['script_hash'] == script_obj.content_hash():
+        return True
+    if evaluation['script_path'] and os.path.abspath(evaluation['script_path']) == os.path.abspath(script_obj.js_file_path):
+        return True
+    return all(param_name in evaluation['parameters'] for param_name in parameter_names)
+
+
+def stored_fitness(evaluation, objective=None, minimize=True):
+    """Fitness of a stored evaluation as the service of the optimizer computes it, see EvaluationService.stored_fitness
+
+    :return: The fitness, None when it has no statistics to compute the objective from
+    """
+    statistics = evaluation['statistics']
+    if statistics is None:
+        # Evaluations stored before statistics were have the default metric as fitness
+        return evaluation['fitness'] if objective is None else None
+    if all(set_statistics['balance'] == 0 for set_statistics in statistics['sets']):
+        return float('inf')
+    if objective is None:
+        return get_objective('metric')(statistics['mean'], statistics['sets'])
+    objective = get_objective(objective)
+    return objective.oriented(objective(statistics['mean'], statistics['sets']), minimize)
+
+
+def matching_evaluations(storage, script_obj, parameter_names, space, objective=None, minimize=True):
+    """Every stored evaluation that matches the script and has a finite fitness
+
+    Evaluations with statistics get the fitness of the objective in the optimizer's direction, so
+    runs that optimized another objective compare.
+
+    :return: A list of (params remapped into the space, fitness, whether it is of the same script code)
+    """
+    script_hash = script_obj.content_hash()
+    evaluations = []
+    for evaluation in storage.load_all_evaluations():
+        if not matches(evaluation, script_obj, parameter_names):
+            continue
+        fitness = stored_fitness(evaluation, objective, minimize)
+        if fitness is None or not math.isfinite(fitness):
+            continue
+        params = remap(evaluation['parameters'], parameter_names, space, script_obj)
+        if params is not None:
+            evaluations.append((params, fitness, evaluation['script_hash'] == script_hash))
+    return evaluations
+
+
+def find_warm_start(evaluations, count, minimize=True):
+    """The best `count` distinct candidates of matching_evaluations, those of the same script code first
+
+    :param minimize: The direction matching_evaluations turned the fitness to
+
+    :return: A list of (params, fitness), best first
+    """
+    ranked = sorted(evaluations, key=lambda evaluation: (not evaluation[2], evaluation[1] if minimize else -evaluation[1]))
+    seeds = {}
+    for params, fitness, _ in ranked:
+        seeds.setdefault(tuple(sorted(params.items())), (params, fitness))
+        if len(seeds) >= count:
+            break
+    return list(seeds.values())
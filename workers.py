@@ -0,0 +1,207 @@
+import asyncio
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from profiling import profiler
+from telemetry import telemetry
+
+
+def current_rss_mb():
+    """Returns the resident set size of the current process in megabytes."""
+    try:
+        with open('/proc/self/statm', 'r', encoding='utf-8') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        # Peak RSS is the best we can do without /proc, ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def context_key(script_obj, initial_balance, game_results):
+    """Builds a content hash identifying everything a worker needs to run a simulation."""
+    digest = hashlib.sha256()
+    digest.update(script_obj.js_code.encode())
+    digest.update(json.dumps(script_obj.config, sort_keys=True, default=str).encode())
+    digest.update(str(initial_balance).encode())
+    digest.update(game_results.content_hash().encode())
+    return digest.hexdigest()
+
+
+def simulate(simulator, initial_balance, game_results, params, sequential=None):
+    """Runs one evaluation in a worker, returns (result, error message)"""
+    try:
+        if sequential is not None:
+            return asyncio.run(simulator.run_sequential(initial_balance, game_results, params, **sequential)), None
+        return asyncio.run(simulator.run(initial_balance, game_results, params)), None
+    except Exception as e:
+        return None, str(e)
+
+
+def _worker_main(conn):
+    # Imported here so the parent process doesn't need a V8 isolate to manage workers
+    from simulator import Simulator
+
+    contexts = {}
+    evaluations = 0
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+
+        if message[0] == 'stop':
+            break
+        elif message[0] == 'context':
+            _, key, (script_obj, initial_balance, game_results) = message
+            contexts[key] = (Simulator(script_obj), initial_balance, game_results)
+        elif message[0] == 'evaluate':
+            _, key, params, profiling_enabled, sequential = message
+            simulator, initial_balance, game_results = contexts[key]
+            evaluations += 1
+            profiler.enabled = profiling_enabled
+            profiler.reset()
+            result, error = simulate(simulator, initial_balance, game_results, params, sequential)
+            profile = profiler.snapshot() if profiling_enabled else None
+            conn.send(('result', result, error, evaluations, current_rss_mb(), profile))
+    conn.close()
+
+
+class Worker:
+    def __init__(self, mp_context, worker_id):
+        self.mp_context = mp_context
+        self.worker_id = worker_id
+        self.process = None
+        self.conn = None
+        self.contexts = set()
+        self.evaluations = 0
+        self.total_evaluations = 0
+        self.rss_mb = 0.0
+        self.recycles = 0
+        self.start()
+
+    def start(self):
+        parent_conn, child_conn = self.mp_context.Pipe()
+        self.process = self.mp_context.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+        self.contexts = set()
+        self.evaluations = 0
+        self.rss_mb = 0.0
+
+    def stop(self):
+        try:
+            self.conn.send(('stop',))
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.conn.close()
+
+    def restart(self):
+        self.stop()
+        self.recycles += 1
+        self.start()
+
+    def request(self, key, context, params, sequential=None):
+        # Script and game sets are shipped once per worker lifetime, not with every evaluation
+        if key not in self.contexts:
+            self.conn.send(('context', key, context))
+            self.contexts.add(key)
+        self.conn.send(('evaluate', key, params, profiler.enabled, sequential))
+        _, result, error, evaluations, rss_mb, profile = self.conn.recv()
+        self.evaluations = evaluations
+        self.total_evaluations += 1
+        self.rss_mb = rss_mb
+        return result, error, profile
+
+
+class WorkerPool:
+    def __init__(self, num_workers, max_evaluations=500, max_rss_mb=1024):
+        """Pool of simulation worker processes that are recycled before they grow too large
+
+        Every worker owns its own V8 isolate, so recycling a worker returns all of the memory
+        the isolate accumulated to the operating system.
+
+        :param num_workers: The number of worker processes to run
+        :param max_evaluations: Recycle a worker after this many evaluations (None to disable)
+        :param max_rss_mb: Recycle a worker once its resident memory exceeds this (None to disable)
+        """
+        self.num_workers = num_workers
+        self.max_evaluations = max_evaluations
+        self.max_rss_mb = max_rss_mb
+        self.mp_context = multiprocessing.get_context('spawn')
+        self.workers = [Worker(self.mp_context, worker_id) for worker_id in range(num_workers)]
+        self.executor = ThreadPoolExecutor(max_workers=num_workers)
+        self.idle_workers = None
+
+    def _get_idle_queue(self):
+        # The queue must be created inside the running event loop
+        if self.idle_workers is None:
+            self.idle_workers = asyncio.Queue()
+            for worker in self.workers:
+                self.idle_workers.put_nowait(worker)
+        return self.idle_workers
+
+    def should_recycle(self, worker):
+        if self.max_evaluations is not None and worker.evaluations >= self.max_evaluations:
+            return True
+        if self.max_rss_mb is not None and worker.rss_mb >= self.max_rss_mb:
+            return True
+        return False
+
+    async def evaluate(self, script_obj, initial_balance, game_results, params, sequential=None):
+        """Runs a simulation on the next idle worker, same return value as Simulator.run
+
+        :param sequential: Options of Simulator.run_sequential, None to simulate every set
+        """
+        idle_workers = self._get_idle_queue()
+        key = context_key(script_obj, initial_balance, game_results)
+        context = (script_obj, initial_balance, game_results)
+        loop = asyncio.get_running_loop()
+
+        worker = await idle_workers.get()
+        started = time.time()
+        try:
+            result, error, profile = await loop.run_in_executor(self.executor, worker.request, key, context, params, sequential)
+            telemetry.worker_busy(time.time() - started)
+        except (EOFError, OSError) as e:
+            logging.warning(f"Worker {worker.worker_id} died, restarting it: {e}")
+            await loop.run_in_executor(self.executor, worker.restart)
+            raise Exception(f"Worker {worker.worker_id} died during evaluation") from e
+        else:
+            if profile is not None:
+                profiler.merge(profile)
+            if self.should_recycle(worker):
+                logging.info(f"Recycling worker {worker.worker_id} after {worker.evaluations} evaluations ({worker.rss_mb:.1f} MB)")
+                await loop.run_in_executor(self.executor, worker.restart)
+        finally:
+            idle_workers.put_nowait(worker)
+
+        if error is not None:
+            raise Exception(error)
+        return result
+
+    def get_stats(self):
+        return [
+            {
+                'worker_id': worker.worker_id,
+                'pid': worker.process.pid,
+                'evaluations': worker.evaluations,
+                'total_evaluations': worker.total_evaluations,
+                'rss_mb': worker.rss_mb,
+                'recycles': worker.recycles,
+            } for worker in self.workers
+        ]
+
+    def close(self):
+        for worker in self.workers:
+            worker.stop()
+        self.executor.shutdown()